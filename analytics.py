@@ -0,0 +1,184 @@
+from collections import defaultdict
+from datetime import date
+from typing import Dict, NamedTuple
+from sqlalchemy import func, select, update, insert, delete, bindparam
+from sqlalchemy.orm import Session
+import models
+
+# months and parts shown on the admin dashboard
+DASHBOARD_MONTHS = 24
+DASHBOARD_PARTS = 20
+
+STAT_COLUMNS = ("repairs", "confirmed", "duration_days", "revenue")
+
+
+class RepairFacts(NamedTuple):
+    """What a repair contributes to monthly statistics"""
+    month: str | None
+    active: bool
+    duration_days: int
+    money: float
+
+
+def repair_month(start_date: date | None) -> str | None:
+    return start_date.strftime("%Y-%m") if start_date is not None else None
+
+
+def repair_duration(start_date: date | None, end_date: date | None) -> int:
+    """Days of the repair, both ends included, 0 without dates"""
+    if start_date is None or end_date is None:
+        return 0
+    return max(0, (end_date - start_date).days) + 1
+
+
+def repair_facts(repair: models.Repair) -> RepairFacts:
+    return RepairFacts(repair_month(repair.start_date), bool(repair.active),
+                       repair_duration(repair.start_date, repair.end_date), repair.money or 0)
+
+
+def contribution(facts: RepairFacts | None, sign: int) -> Dict[str, float]:
+    if facts is None or facts.month is None:
+        return {}
+    values = {"repairs": sign}
+    if facts.active:
+        values.update(confirmed=sign, duration_days=sign * facts.duration_days,
+                      revenue=sign * facts.money)
+    return values
+
+
+def add_month_stats(db: Session, month: str, values: Dict[str, float]):
+    """Adds values to counters of month, the row is created on first use"""
+    values = {column: value for column, value in values.items() if value}
+    if not values:
+        return
+    table = models.MonthlyRepairStats.__table__
+    changed = db.execute(update(table).where(table.c.month == month).values(
+        {column: table.c[column] + value for column, value in values.items()})).rowcount
+    if not changed:
+        row = dict.fromkeys(STAT_COLUMNS, 0)
+        row.update(values, month=month)
+        db.execute(insert(table).values(row))
+
+
+def update_repair_stats(db: Session, old: RepairFacts | None, new: RepairFacts | None):
+    """Moves contribution of a repair from old to new facts, None stands for
+    repair which did not / does no longer exist"""
+    if old == new:
+        return
+    by_month = defaultdict(lambda: defaultdict(float))
+    for facts, sign in ((old, -1), (new, 1)):
+        for column, value in contribution(facts, sign).items():
+            by_month[facts.month][column] += value
+    for month, values in by_month.items():
+        add_month_stats(db, month, values)
+
+
+def add_repair_revenue(db: Session, repair_id: int, change: float):
+    """Revenue follows Repair.money changed by line items"""
+    if not change:
+        return
+    table = models.Repair.__table__
+    row = db.execute(select(table.c.start_date, table.c.active).where(table.c.id == repair_id)).first()
+    if row is not None and row.active:
+        month = repair_month(row.start_date)
+        if month is not None:
+            add_month_stats(db, month, {"revenue": change})
+
+
+def add_price_revenue(db: Session, price_changes: Dict[int, float]):
+    """Revenue of months with confirmed repairs using parts which changed
+    price by part_id -> price difference"""
+    if not price_changes:
+        return
+    line = models.PartsInRepair.__table__
+    repair = models.Repair.__table__
+    rows = db.execute(select(line.c.part_id, repair.c.start_date, func.sum(line.c.quantity)).join(
+        repair, repair.c.id == line.c.repair_id).where(
+        line.c.part_id.in_(price_changes), repair.c.active == True).group_by(
+        line.c.part_id, repair.c.start_date)).all()
+    revenue = defaultdict(float)
+    for part_id, start_date, quantity in rows:
+        month = repair_month(start_date)
+        if month is not None:
+            revenue[month] += price_changes[part_id] * (quantity or 0)
+    for month, change in revenue.items():
+        add_month_stats(db, month, {"revenue": change})
+
+
+def add_part_usage(db: Session, quantities: Dict[int, int]):
+    """Adds part_id -> pieces used (negative when returned)"""
+    quantities = {part_id: quantity for part_id, quantity in quantities.items() if quantity}
+    if not quantities:
+        return
+    table = models.PartUsageStats.__table__
+    existing = set(db.execute(select(table.c.part_id).where(
+        table.c.part_id.in_(quantities))).scalars())
+    if existing:
+        db.execute(update(table).where(table.c.part_id == bindparam("b_part_id")).values(
+            quantity=table.c.quantity + bindparam("b_quantity")),
+            [{"b_part_id": part_id, "b_quantity": quantities[part_id]} for part_id in existing])
+    missing = [{"part_id": part_id, "quantity": quantity}
+               for part_id, quantity in quantities.items() if part_id not in existing]
+    if missing:
+        db.execute(insert(table), missing)
+
+
+def rebuild_analytics(db: Session):
+    """Recomputes all statistics from repairs and line items. Does not commit."""
+    monthly = models.MonthlyRepairStats.__table__
+    usage = models.PartUsageStats.__table__
+    line = models.PartsInRepair.__table__
+    repair = models.Repair.__table__
+    db.execute(delete(monthly))
+    db.execute(delete(usage))
+
+    db.execute(insert(usage).from_select(["part_id", "quantity"], select(
+        line.c.part_id, func.coalesce(func.sum(line.c.quantity), 0)).where(
+        line.c.part_id.is_not(None)).group_by(line.c.part_id)))
+
+    by_month = defaultdict(lambda: dict.fromkeys(STAT_COLUMNS, 0))
+    result = db.execute(select(repair.c.start_date, repair.c.end_date, repair.c.active,
+                               repair.c.money).execution_options(yield_per=1000))
+    for start_date, end_date, active, money in result:
+        facts = RepairFacts(repair_month(start_date), bool(active),
+                            repair_duration(start_date, end_date), money or 0)
+        for column, value in contribution(facts, 1).items():
+            by_month[facts.month][column] += value
+    if by_month:
+        db.execute(insert(monthly), [dict(values, month=month) for month, values in by_month.items()])
+
+
+def load_analytics(db: Session) -> dict:
+    """Dashboard data, read from the statistics tables only (and parts for
+    their names)"""
+    monthly = models.MonthlyRepairStats
+    usage = models.PartUsageStats
+    # rows of months whose repairs were moved or removed stay, with zeros
+    months = db.execute(select(monthly).where(monthly.repairs > 0).order_by(
+        monthly.month.desc()).limit(DASHBOARD_MONTHS)).scalars().all()
+    totals = db.execute(select(func.coalesce(func.sum(monthly.repairs), 0),
+                               func.coalesce(func.sum(monthly.confirmed), 0),
+                               func.coalesce(func.sum(monthly.duration_days), 0),
+                               func.coalesce(func.sum(monthly.revenue), 0))).one()
+    parts = db.execute(select(models.Part.id, models.Part.name, models.Part.engine_type,
+                              usage.quantity).join(models.Part, models.Part.id == usage.part_id).where(
+        usage.quantity > 0).order_by(usage.quantity.desc()).limit(DASHBOARD_PARTS)).all()
+    engine_types = db.execute(select(models.Part.engine_type, func.sum(usage.quantity)).join(
+        models.Part, models.Part.id == usage.part_id).group_by(models.Part.engine_type).order_by(
+        func.sum(usage.quantity).desc())).all()
+
+    def average_duration(duration_days, confirmed):
+        return round(duration_days / confirmed, 1) if confirmed else None
+
+    return {
+        "totals": {"repairs": totals[0], "confirmed": totals[1], "revenue": round(totals[3], 2),
+                   "average_duration_days": average_duration(totals[2], totals[1])},
+        "months": [{"month": row.month, "repairs": row.repairs, "confirmed": row.confirmed,
+                    "revenue": round(row.revenue, 2),
+                    "average_duration_days": average_duration(row.duration_days, row.confirmed)}
+                   for row in months],
+        "parts": [{"part_id": part_id, "name": name, "engine_type": engine_type, "quantity": quantity}
+                  for part_id, name, engine_type, quantity in parts],
+        "engine_types": [{"engine_type": engine_type, "quantity": quantity}
+                         for engine_type, quantity in engine_types if quantity],
+    }
@@ -0,0 +1,197 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from starlette.datastructures import Headers
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped, gzip is always built
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # images are copied as they are
+    Image = None
+
+STATIC_DIRECTORY = "static"
+
+# output of `python manage.py build-static`, served instead of STATIC_DIRECTORY
+# when it exists
+STATIC_BUILD_DIRECTORY = os.environ.get("STATIC_BUILD_DIR", "static_build")
+MANIFEST_NAME = "manifest.json"
+
+# responses of fingerprinted files never change, browsers may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# files under their source names have to be revalidated
+DEFAULT_CACHE_CONTROL = "public, max-age=0, must-revalidate"
+
+COMPRESSED_EXTENSIONS = {".css", ".js", ".svg", ".html", ".json", ".txt", ".map"}
+# Content-Encoding -> suffix of precompressed file, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# images here get downscaled variants, in their own format and in WebP
+IMAGE_DIRECTORY = "popcorn/photos"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+IMAGE_WIDTHS = (64, 160, 1024)
+WEBP_QUALITY = 80
+
+
+def fingerprint(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def hashed_name(path: str, content: bytes, suffix: str = "", extension: str | None = None) -> str:
+    """'popcorn/css/base.css' -> 'popcorn/css/base.<hash>.css'"""
+    stem, original_extension = os.path.splitext(path)
+    return f"{stem}{suffix}.{fingerprint(content)}{extension or original_extension}"
+
+
+def variant_key(path: str, width: int | None = None, image_format: str | None = None) -> str:
+    """Key of a built file in the manifest, e.g. 'popcorn/photos/trash.png@160w.webp'"""
+    if width is None and image_format is None:
+        return path
+    return f"{path}@{width}w.{image_format}"
+
+
+def write_file(directory: str, path: str, content: bytes):
+    target = os.path.join(directory, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as file:
+        file.write(content)
+
+
+def write_compressed(directory: str, path: str, content: bytes):
+    """Stores gzip and brotli variants next to the file, if they are smaller"""
+    variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(content, quality=11)
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(content):
+            write_file(directory, path + suffix, compressed)
+
+
+def image_variants(path: str, content: bytes):
+    """Yields (width, format, extension, bytes) of downscaled copies of image.
+    Widths larger than the image itself are skipped."""
+    from io import BytesIO
+
+    image = Image.open(BytesIO(content))
+    image.load()
+    extension = os.path.splitext(path)[1].lower()
+    own_format = "png" if extension == ".png" else "jpeg"
+    for width in IMAGE_WIDTHS:
+        if width > image.width:
+            continue
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        for image_format, variant_extension in [(own_format, extension), ("webp", ".webp")]:
+            output = BytesIO()
+            if image_format == "png":
+                resized.save(output, "PNG", optimize=True)
+            elif image_format == "jpeg":
+                resized.convert("RGB").save(output, "JPEG", quality=85, optimize=True, progressive=True)
+            else:
+                resized.save(output, "WEBP", quality=WEBP_QUALITY, method=6)
+            yield width, variant_extension.lstrip("."), variant_extension, output.getvalue()
+
+
+def build_static(source: str = STATIC_DIRECTORY, target: str = STATIC_BUILD_DIRECTORY) -> dict:
+    """Copies static files into target under source and fingerprinted names,
+    with precompressed and downscaled variants. Returns the manifest, which
+    maps source paths (and image variant keys) to fingerprinted paths."""
+    manifest = {}
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    for root, _, files in os.walk(source):
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, source).replace(os.sep, "/")
+            with open(full_path, "rb") as file:
+                content = file.read()
+            extension = os.path.splitext(name)[1].lower()
+
+            built = [(path, content), (hashed_name(path, content), content)]
+            manifest[path] = built[1][0]
+            if (Image is not None and extension in IMAGE_EXTENSIONS
+                    and path.startswith(IMAGE_DIRECTORY + "/")):
+                for width, image_format, variant_extension, variant in image_variants(path, content):
+                    variant_path = hashed_name(path, variant, suffix=f"-{width}w",
+                                               extension=variant_extension)
+                    manifest[variant_key(path, width, image_format)] = variant_path
+                    built.append((variant_path, variant))
+
+            for built_path, built_content in built:
+                write_file(target, built_path, built_content)
+                if extension in COMPRESSED_EXTENSIONS:
+                    write_compressed(target, built_path, built_content)
+
+    write_file(target, MANIFEST_NAME, json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(directory: str = STATIC_BUILD_DIRECTORY) -> dict:
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+manifest = load_manifest()
+
+
+def static_url(path: str, width: int | None = None, format: str | None = None) -> str:
+    """URL of static file, fingerprinted when static files were built. With
+    width (and format, e.g. 'webp') the downscaled variant of an image is
+    used, the original image when such variant does not exist."""
+    path = path.lstrip("/")
+    if width is not None:
+        key = variant_key(path, width, format or os.path.splitext(path)[1].lstrip(".").lower())
+        if key in manifest:
+            return f"/static/{manifest[key]}"
+    return f"/static/{manifest.get(path, path)}"
+
+
+class AssetFiles(StaticFiles):
+    """StaticFiles serving precompressed variants chosen by Accept-Encoding,
+    with long lived cache headers for fingerprinted files"""
+
+    def __init__(self, manifest: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.fingerprinted = {os.path.realpath(os.path.join(self.directory, path))
+                              for path in manifest.values()}
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        accepted = Headers(scope=scope).get("accept-encoding", "")
+        accepted = {value.split(";")[0].strip() for value in accepted.split(",")}
+        encoding = None
+        if os.path.splitext(full_path)[1].lower() in COMPRESSED_EXTENSIONS:
+            for name, suffix in ENCODINGS:
+                if name in accepted and os.path.isfile(full_path + suffix):
+                    encoding = name
+                    compressed_path = full_path + suffix
+                    break
+
+        if encoding is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+        else:
+            response = super().file_response(compressed_path, os.stat(compressed_path),
+                                             scope, status_code)
+            response.headers["content-encoding"] = encoding
+        if os.path.splitext(full_path)[1].lower() in COMPRESSED_EXTENSIONS:
+            response.headers["vary"] = "Accept-Encoding"
+        if os.path.realpath(full_path) in self.fingerprinted:
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["cache-control"] = DEFAULT_CACHE_CONTROL
+        return response
+
+
+def static_files() -> StaticFiles:
+    """Static files app for /static, built files when available"""
+    if manifest:
+        return AssetFiles(manifest, directory=STATIC_BUILD_DIRECTORY)
+    return AssetFiles({}, directory=STATIC_DIRECTORY)
@@ -0,0 +1,99 @@
+"""Admin dashboard statistics: summary tables vs aggregating on demand.
+
+    python benchmarks/bench_analytics.py [--repairs 50000] [--lines 200000]
+
+Runs against a temporary SQLite file with about ten years of repairs and
+their line items. Reports the time of a full rebuild, of reading the
+dashboard from the summary tables and of computing the same numbers with
+grouped queries over repairs and line items.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def per_call(fn, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count
+
+
+def run(args):
+    from sqlalchemy import insert, select, func
+    import migrations
+    import models
+    from database import engine, SessionLocal
+    from analytics import rebuild_analytics, load_analytics
+    from repairs import reconcile_repair_totals
+
+    migrations.upgrade(engine)
+    parts = 2000
+    with engine.begin() as connection:
+        connection.execute(insert(models.Part), [
+            {"name": f"part {index}", "amount_left": 100, "engine_type": random.choice(["1.6", "2.0", "1.8"]),
+             "price": random.randint(10, 500)} for index in range(parts)])
+        first_day = date(2015, 1, 1)
+        repairs = []
+        for index in range(args.repairs):
+            start = first_day + timedelta(days=random.randint(0, 3650))
+            repairs.append({"car_name": f"car {index}", "start_date": start,
+                            "end_date": start + timedelta(days=random.randint(0, 10)),
+                            "active": random.random() < 0.8, "money": 0})
+        connection.execute(insert(models.Repair), repairs)
+        lines = {(random.randint(1, parts), random.randint(1, args.repairs)) for _ in range(args.lines)}
+        connection.execute(insert(models.PartsInRepair), [
+            {"part_id": part_id, "repair_id": repair_id, "quantity": random.randint(1, 5)}
+            for part_id, repair_id in lines])
+
+    db = SessionLocal()
+    reconcile_repair_totals(db)
+    started = time.perf_counter()
+    rebuild_analytics(db)
+    db.commit()
+    rebuild_time = time.perf_counter() - started
+
+    def on_demand():
+        repair = models.Repair
+        line = models.PartsInRepair
+        month = func.strftime("%Y-%m", repair.start_date)
+        db.execute(select(month, func.count(), func.sum(repair.money),
+                          func.avg(func.julianday(repair.end_date) - func.julianday(repair.start_date) + 1)).where(
+            repair.active == True).group_by(month)).all()
+        db.execute(select(models.Part.name, models.Part.engine_type, func.sum(line.quantity)).join(
+            models.Part, models.Part.id == line.part_id).group_by(line.part_id).order_by(
+            func.sum(line.quantity).desc()).limit(20)).all()
+        db.execute(select(models.Part.engine_type, func.sum(line.quantity)).join(
+            models.Part, models.Part.id == line.part_id).group_by(models.Part.engine_type)).all()
+
+    summary_time = per_call(lambda: load_analytics(db), 50)
+    demand_time = per_call(on_demand, 5)
+    db.close()
+    print(f"{args.repairs} repairs, {len(lines)} line items")
+    print(f"rebuild              {rebuild_time * 1000:10.1f} ms")
+    print(f"dashboard (summary)  {summary_time * 1000:10.2f} ms")
+    print(f"dashboard (on demand){demand_time * 1000:10.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repairs", type=int, default=50000)
+    parser.add_argument("--lines", type=int, default=200000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Part lookup by scanned code: SQL query vs catalogue snapshot.
+
+    python benchmarks/bench_catalogue.py [--parts 20000] [--lookups 5000]
+
+Runs against a temporary SQLite file seeded with parts. Reports time of one
+lookup by QR code through the indexed SQL query, through the in-memory
+catalogue, and of the whole /mechanic/storage/scan request.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def per_call(fn, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count
+
+
+async def run(args):
+    import httpx
+    from sqlalchemy import select
+    import migrations
+    import models
+    from database import engine, SessionLocal
+    from main import app
+    from routers.auth import create_access_token
+    from catalogue import get_catalogue
+
+    migrations.upgrade(engine)
+    db = SessionLocal()
+    user = models.User(username="bench", email="bench@popcorn", role="mechanic",
+                       hashed_password="-")
+    db.add(user)
+    db.add_all([models.Part(name=f"part {index}", amount_left=index % 50, engine_type="2.0",
+                            price=index % 500, nr_oem=f"OEM-{index}", qr_code=f"QR{index}")
+                for index in range(args.parts)])
+    db.commit()
+    codes = [f"QR{random.randrange(args.parts)}" for _ in range(args.lookups)]
+
+    def sql_lookup():
+        db.execute(select(models.Part).where(models.Part.qr_code == random.choice(codes))).scalars().all()
+
+    started = time.perf_counter()
+    catalogue = get_catalogue(db)
+    load_time = time.perf_counter() - started
+
+    def catalogue_lookup():
+        catalogue.scan(random.choice(codes))
+
+    sql_time = per_call(sql_lookup, args.lookups)
+    memory_time = per_call(catalogue_lookup, args.lookups)
+    cookie = create_access_token(user)
+    db.close()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 cookies={"access_token": cookie}) as client:
+        started = time.perf_counter()
+        for code in codes[:1000]:
+            response = await client.get("/mechanic/storage/scan", params={"code": code})
+            assert response.status_code == 200 and response.json()
+        request_time = (time.perf_counter() - started) / min(1000, len(codes))
+
+    print(f"catalogue load ({args.parts} parts) {load_time * 1000:10.1f} ms")
+    print(f"SQL lookup                   {sql_time * 1e6:10.1f} us")
+    print(f"catalogue lookup             {memory_time * 1e6:10.1f} us")
+    print(f"scan request                 {request_time * 1e6:10.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parts", type=int, default=20000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    # snapshot is trusted for the whole run, like between changes
+    os.environ.setdefault("CATALOGUE_CHECK_SECONDS", "3600")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Concurrent request throughput of the app in each database mode.
+
+    python benchmarks/bench_concurrency.py [--requests 2000] [--concurrency 50]
+
+Every mode runs in its own interpreter against a fresh SQLite file seeded
+with parts and repairs:
+
+    blocking  sync Session called straight from async handlers, which is
+              how handlers worked before (every query stalls the event loop)
+    threaded  sync Session offloaded to worker threads (DATABASE_ASYNC=0)
+    async     AsyncSession on aiosqlite (DATABASE_ASYNC=1)
+
+SQLite answers in microseconds, so with a local file the thread / driver
+hand-off costs more than it saves. --db-latency-ms adds a sleep to every
+statement inside the connection (like the network round trip of MySQL or
+PostgreSQL would), which is where not blocking the event loop pays off.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ["blocking", "threaded", "async"]
+
+
+def seed(parts: int, repairs: int):
+    import models
+    from database import SessionLocal
+
+    db = SessionLocal()
+    db.add(models.User(username="bench", email="bench@popcorn", first_name="Bench",
+                       last_name="Mechanic", role="mechanic", hashed_password="-"))
+    db.add(models.User(username="client", email="client@popcorn", first_name="Client",
+                       last_name="Customer", role="customer", hashed_password="-"))
+    words = ["filtr", "oleju", "uszczelka", "pasek", "klocki", "tarcza", "sprzeglo", "turbo"]
+    for index in range(parts):
+        db.add(models.Part(name=f"{random.choice(words)} {random.choice(words)} {index}",
+                           amount_left=random.randint(0, 50), engine_type=random.choice(["1.6", "2.0"]),
+                           price=random.randint(10, 500), nr_oem=f"OEM-{index}", qr_code=f"QR{index}"))
+    start = date(2024, 1, 1)
+    for index in range(repairs):
+        first_day = start + timedelta(days=random.randint(0, 365))
+        db.add(models.Repair(car_name=f"car {index}", start_date=first_day,
+                             end_date=first_day + timedelta(days=random.randint(0, 7)),
+                             active=True, customer_id=2))
+    db.commit()
+    db.close()
+
+
+async def fire(app, cookie: str, total: int, concurrency: int):
+    import httpx
+
+    paths = ["/mechanic/storage?search_name=filtr",
+             "/mechanic/storage?sort=price&direction=desc",
+             "/mechanic/calendar/events?start=2024-03-01&end=2024-04-12",
+             "/mechanic/repairs/1?filltered_sentance=turbo"]
+    latencies = []
+    queue = asyncio.Queue()
+    for index in range(total):
+        queue.put_nowait(paths[index % len(paths)])
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 cookies={"access_token": cookie}) as client:
+        async def worker():
+            while not queue.empty():
+                path = queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, (path, response.status_code)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {"requests_per_second": total / elapsed,
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000}
+
+
+def add_latency(database, latency: float):
+    """Every statement sleeps in the thread which runs it, as network IO would"""
+    from sqlalchemy import event
+
+    def trace(statement):
+        time.sleep(latency)
+
+    def on_connect(dbapi_connection, connection_record):
+        if hasattr(dbapi_connection, "set_trace_callback"):
+            dbapi_connection.set_trace_callback(trace)
+        else:
+            # aiosqlite keeps sqlite3 connection in its own thread
+            connection = dbapi_connection._connection
+            dbapi_connection.await_(connection._execute(connection._conn.set_trace_callback, trace))
+
+    for engine in [database.engine, database.async_engine and database.async_engine.sync_engine]:
+        if engine is not None:
+            event.listen(engine, "connect", on_connect)
+
+
+def run_mode(mode: str, args):
+    """Runs inside child interpreter with DATABASE_URL / DATABASE_ASYNC set"""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import database
+
+    if mode == "blocking":
+        async def call_inline(func, *func_args, **kwargs):
+            return func(*func_args, **kwargs)
+        database.run_in_threadpool = call_inline
+
+    import main
+    import migrations
+    from routers.auth import create_access_token
+    import models
+
+    migrations.upgrade(database.engine)
+    random.seed(7)
+    seed(args.parts, args.repairs)
+    db = database.SessionLocal()
+    cookie = create_access_token(db.query(models.User).filter(
+        models.User.username == "bench").first())
+    db.close()
+    if args.db_latency_ms:
+        database.engine.dispose()
+        add_latency(database, args.db_latency_ms / 1000)
+    result = asyncio.run(fire(main.app, cookie, args.requests, args.concurrency))
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--parts", type=int, default=5000)
+    parser.add_argument("--repairs", type=int, default=2000)
+    parser.add_argument("--db-latency-ms", type=float, default=0.0)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args)
+        return
+
+    print(f"{'mode':<10} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, SECRET_KEY=os.environ.get("SECRET_KEY", "bench"),
+                       DATABASE_URL=f"sqlite:///{directory}/bench.db",
+                       DATABASE_ASYNC="1" if mode == "async" else "0")
+            output = subprocess.run([sys.executable, __file__, "--mode", mode] + sys.argv[1:],
+                                    env=env, capture_output=True, text=True, check=True)
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            print(f"{mode:<10} {result['requests_per_second']:>10.1f} "
+                  f"{result['p50_ms']:>10.1f} {result['p99_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
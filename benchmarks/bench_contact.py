@@ -0,0 +1,88 @@
+"""Contact form burst: one commit per message vs buffered batch writer.
+
+    python benchmarks/bench_contact.py [--messages 2000] [--senders 200]
+
+Runs against a temporary SQLite file. Posts a burst of contact messages
+through the app and reports request throughput and the number of write
+transactions, first with every message committed in its own transaction
+(as the form used to do) and then through the buffered inbox. Rate limits
+are raised so that the whole burst is accepted.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def run(args):
+    import httpx
+    from sqlalchemy import func, select
+    import migrations
+    import models
+    from database import engine, new_session
+    from main import app
+    from inbox import inbox
+
+    migrations.upgrade(engine)
+
+    from fastapi import Form, Request
+    from templating import templates
+
+    # the form as it used to be: insert and commit inside the request
+    @app.post("/bench/contact-direct")
+    async def contact_direct(request: Request, email: str = Form(...), message: str = Form(...)):
+        async with new_session() as db:
+            db.add(models.Message(email=email, message=message))
+            await db.commit()
+        return templates.TemplateResponse("contact-form.html",
+                                          {"request": request, "msg": "Message has been sent."})
+
+    async def post_all(client, url):
+        started = time.perf_counter()
+        for index in range(args.messages):
+            response = await client.post(url, data={
+                "email": f"sender{index % args.senders}@bench", "message": f"message {index}"})
+            assert response.status_code == 200, response.status_code
+        return time.perf_counter() - started
+
+    transport = httpx.ASGITransport(app=app)
+    inbox.start()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        direct_time = await post_all(client, "/bench/contact-direct")
+        request_time = await post_all(client, "/contact/")
+    await inbox.stop()
+    stats = inbox.stats()
+
+    async with new_session() as db:
+        count = await db.scalar(select(func.count()).select_from(models.Message))
+    assert count == 2 * args.messages, count
+
+    print(f"{args.messages} messages from {args.senders} senders")
+    print(f"commit per request         {direct_time * 1000:10.1f} ms, {args.messages} transactions")
+    print(f"buffered                   {request_time * 1000:10.1f} ms, {stats['batches']} transactions"
+          f" taking {stats['write_ms']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--senders", type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ["CONTACT_IP_BURST"] = str(args.messages)
+    os.environ["CONTACT_EMAIL_BURST"] = str(args.messages)
+    os.environ["CONTACT_BUFFER_SIZE"] = str(args.messages)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Reorder forecast over the whole consumption history.
+
+    python benchmarks/bench_forecast.py [--parts 5000] [--lines 100000]
+
+Runs against a temporary SQLite file with two years of repairs. Reports
+time of loading line items into arrays, of the vectorised rate computation
+(compared with the same formula in a Python loop over line items), of a
+report computed from scratch and of a report served from cached rates.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def python_rates(part_ids, days, quantities, today, half_life):
+    decay = 0.5 ** (1.0 / half_life)
+    weighted = defaultdict(float)
+    oldest = today
+    for part_id, day, quantity in zip(part_ids.tolist(), days.tolist(), quantities.tolist()):
+        age = max(today - day, 0)
+        weighted[part_id] += quantity * decay ** age
+        oldest = min(oldest, day)
+    weight_of_days = (1.0 - decay ** (today - oldest + 1)) / (1.0 - decay)
+    return {part_id: value / weight_of_days for part_id, value in weighted.items()}
+
+
+def run(args):
+    from sqlalchemy import insert
+    import numpy as np
+    import migrations
+    import models
+    import forecast
+    from database import engine, SessionLocal
+
+    migrations.upgrade(engine)
+    repairs = args.lines // 5
+    today = date.today()
+    with engine.begin() as connection:
+        connection.execute(insert(models.Part), [
+            {"name": f"part {index}", "amount_left": random.randint(0, 40), "price": 10}
+            for index in range(args.parts)])
+        connection.execute(insert(models.Repair), [
+            {"car_name": f"car {index}", "start_date": today - timedelta(days=random.randint(-10, 730)),
+             "end_date": today, "active": True, "money": 0} for index in range(repairs)])
+        lines = set()
+        while len(lines) < args.lines:
+            lines.add((random.randint(1, args.parts), random.randint(1, repairs)))
+        connection.execute(insert(models.PartsInRepair), [
+            {"part_id": part_id, "repair_id": repair_id, "quantity": random.randint(1, 4)}
+            for part_id, repair_id in lines])
+
+    db = SessionLocal()
+    arrays, load_time = timed(lambda: forecast.load_consumption(db))
+    day = (today - forecast.EPOCH).days
+    rates, numpy_time = timed(lambda: forecast.consumption_rates(*arrays, day))
+    loop_rates, loop_time = timed(lambda: python_rates(*arrays, day, forecast.FORECAST_HALF_LIFE_DAYS))
+    assert np.allclose([loop_rates[part_id] for part_id in rates.part_ids.tolist()], rates.daily)
+
+    report, cold_time = timed(lambda: forecast.reorder_report(db))
+    _, warm_time = timed(lambda: forecast.reorder_report(db))
+    db.close()
+    print(f"{args.lines} line items, {args.parts} parts, {len(report)} parts to reorder")
+    print(f"load into arrays        {load_time * 1000:8.1f} ms")
+    print(f"rates (numpy)           {numpy_time * 1000:8.1f} ms")
+    print(f"rates (python loop)     {loop_time * 1000:8.1f} ms")
+    print(f"report, cold            {cold_time * 1000:8.1f} ms")
+    print(f"report, cached rates    {warm_time * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parts", type=int, default=5000)
+    parser.add_argument("--lines", type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
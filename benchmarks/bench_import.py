@@ -0,0 +1,66 @@
+"""Bulk import and streaming export of parts.
+
+    python benchmarks/bench_import.py [--parts 100000]
+
+Runs against a temporary SQLite file. Imports generated CSV twice (inserts,
+then updates of the same parts) and exports it back, reporting rows per
+second and peak Python memory of the export.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate(parts: int, price_shift: int):
+    yield "name,amount_left,engine_type,price,nr_oem,qr_code\n"
+    for index in range(parts):
+        yield f"part {index},{index % 50},2.0,{index % 500 + price_shift},OEM-{index},QR{index}\n"
+
+
+def run(args):
+    import migrations
+    from database import engine, SessionLocal
+    from parts_io import import_parts, export_parts
+
+    migrations.upgrade(engine)
+    db = SessionLocal()
+    for label, shift in (("import (insert)", 0), ("import (update)", 1)):
+        started = time.perf_counter()
+        report = import_parts(db, generate(args.parts, shift), "csv")
+        elapsed = time.perf_counter() - started
+        assert report.error_count == 0, report.as_dict()
+        print(f"{label:16} {args.parts / elapsed:10.0f} rows/s  "
+              f"inserted {report.inserted} updated {report.updated}")
+
+    for file_format in ("csv", "jsonl"):
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = sum(len(chunk) for chunk in export_parts(db, file_format))
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"export {file_format:9} {args.parts / elapsed:10.0f} rows/s  "
+              f"{size / 2**20:.1f} MiB written, peak memory {peak / 2**20:.1f} MiB")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parts", type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
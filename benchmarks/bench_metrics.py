@@ -0,0 +1,102 @@
+"""Cost of request metrics.
+
+    python benchmarks/bench_metrics.py [--requests 2000]
+
+Requests the home page and a repair detail page of a mechanic --requests
+times each, alternately with the metrics middleware, engine hooks and
+template timing switched off and on (twice, so warm-up does not favour
+either), and prints the mean latency of every run. Runs against a temporary SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def measure(client, url: str, requests: int) -> float:
+    started = time.perf_counter()
+    for _ in range(requests):
+        response = await client.get(url)
+        assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - started) / requests
+
+
+def switch_metrics(app, on: bool):
+    from jinja2 import Template
+    from sqlalchemy import event
+    from starlette.middleware import Middleware
+    import database
+    import metrics
+    import templating
+
+    hooks = [("before_cursor_execute", database.start_query_timer),
+             ("after_cursor_execute", database.stop_query_timer)]
+    for name, hook in hooks:
+        if on and not event.contains(database.engine, name, hook):
+            event.listen(database.engine, name, hook)
+        if not on and event.contains(database.engine, name, hook):
+            event.remove(database.engine, name, hook)
+    templating.templates.env.template_class = templating.TimedTemplate if on else Template
+    templating.templates.env.cache.clear()
+    app.user_middleware = [middleware for middleware in app.user_middleware
+                           if middleware.cls is not metrics.MetricsMiddleware]
+    if on:
+        app.user_middleware.insert(0, Middleware(metrics.MetricsMiddleware))
+    app.middleware_stack = app.build_middleware_stack()
+
+
+async def run(requests: int):
+    import httpx
+    import models
+    import migrations
+    from database import SessionLocal, engine
+    from main import app
+    from routers.auth import create_access_token
+
+    migrations.upgrade(engine)
+    db = SessionLocal()
+    mechanic = models.User(username="mechanic", email="mechanic@popcorn", first_name="Jan",
+                           last_name="Kowalski", role="mechanic", hashed_password="x")
+    db.add(mechanic)
+    db.flush()
+    repair = models.Repair(car_name="Golf", customer_id=mechanic.id, active=True)
+    db.add(repair)
+    db.commit()
+    token = create_access_token(mechanic)
+    repair_id = repair.id
+    db.close()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        pages = {"home": ("/", None), "repair": (f"/mechanic/repairs/{repair_id}", token)}
+        for on in (False, True, False, True):
+            switch_metrics(app, on)
+            results = []
+            for name, (url, cookie) in pages.items():
+                client.cookies.clear()
+                if cookie:
+                    client.cookies.set("access_token", cookie)
+                await measure(client, url, 50)
+                results.append(f"{name} {await measure(client, url, requests) * 1000:.3f} ms")
+            print(f"metrics {'on ' if on else 'off'}: " + ", ".join(results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        asyncio.run(run(args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Booking conflict check and free slot finder: bay occupancy vs repairs.
+
+    python benchmarks/bench_scheduling.py [--repairs 50000] [--capacity 80]
+
+Runs against a temporary SQLite file with about ten years of confirmed
+repairs. Reports the time of checking a 5 day booking through the day
+occupancy table and through counting overlapping repairs, and of finding the
+next free slots.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def per_call(fn, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count
+
+
+def run(args):
+    from sqlalchemy import insert, select, func
+    import migrations
+    import models
+    from database import engine, SessionLocal
+    from busy import rebuild_occupancy, days_of
+    from scheduling import first_full_day, free_slots
+
+    migrations.upgrade(engine)
+    first_day = date(2015, 1, 1)
+    with engine.begin() as connection:
+        repairs = []
+        for index in range(args.repairs):
+            start = first_day + timedelta(days=random.randint(0, 3650))
+            repairs.append({"car_name": f"car {index}", "start_date": start,
+                            "end_date": start + timedelta(days=random.randint(0, 10)),
+                            "active": True, "money": 0})
+        connection.execute(insert(models.Repair), repairs)
+
+    db = SessionLocal()
+    started = time.perf_counter()
+    rebuild_occupancy(db)
+    db.commit()
+    rebuild_time = time.perf_counter() - started
+    full_days = db.scalar(select(func.count()).where(models.BayOccupancy.repairs >= args.capacity))
+
+    def period():
+        start = first_day + timedelta(days=random.randint(0, 3650))
+        return start, start + timedelta(days=4)
+
+    def occupancy_check():
+        first_full_day(db, *period(), 1, args.capacity)
+
+    def repairs_check():
+        # repairs overlapping every day of the period, through the start/end index
+        for day in days_of(*period()):
+            count = db.scalar(select(func.count()).where(
+                models.Repair.start_date <= day, models.Repair.end_date >= day,
+                models.Repair.active == True))
+            if count + 1 > args.capacity:
+                break
+
+    def slots():
+        free_slots(db, 5, 10, period()[0], args.capacity)
+
+    occupancy_time = per_call(occupancy_check, 2000)
+    repairs_time = per_call(repairs_check, 50)
+    slots_time = per_call(slots, 500)
+    db.close()
+
+    print(f"{args.repairs} repairs, capacity {args.capacity}, {full_days} full days")
+    print(f"occupancy rebuild          {rebuild_time * 1000:10.1f} ms")
+    print(f"check, occupancy           {occupancy_time * 1e6:10.1f} us")
+    print(f"check, counting repairs    {repairs_time * 1e6:10.1f} us")
+    print(f"next 10 free 5 day slots   {slots_time * 1e6:10.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repairs", type=int, default=50000)
+    parser.add_argument("--capacity", type=int, default=80)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
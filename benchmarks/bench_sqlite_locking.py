@@ -0,0 +1,125 @@
+"""Concurrent writers and readers on SQLite with and without connect pragmas.
+
+    python benchmarks/bench_sqlite_locking.py [--seconds 5] [--writers 4] [--readers 8]
+
+Writer threads change and add repairs (like mechanics), reader threads load
+calendar ranges (like customers). Each configuration runs in its own
+interpreter on a fresh file:
+
+    default   rollback journal, full sync, 5 s busy timeout of pysqlite
+              (previous engine settings)
+    tuned     settings from database.py (WAL, synchronous=NORMAL, ...)
+
+Prints completed operations and "database is locked" errors.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIGURATIONS = {
+    "default": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL",
+                "SQLITE_MMAP_SIZE": "0", "SQLITE_CACHE_SIZE": "-2000"},
+    "tuned": {},
+}
+
+
+def run_configuration(args):
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import select
+    from sqlalchemy.exc import OperationalError
+    import models
+    from database import engine, SessionLocal
+    from repairs import overlapping
+
+    models.Base.metadata.create_all(bind=engine)
+    first_day = date(2024, 1, 1)
+    db = SessionLocal()
+    db.add_all([models.Repair(car_name="car", start_date=first_day, end_date=first_day,
+                              active=True) for _ in range(200)])
+    db.commit()
+    db.close()
+
+    stop = time.time() + args.seconds
+    counts = {"writes": 0, "reads": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def writer():
+        while time.time() < stop:
+            db = SessionLocal()
+            try:
+                start = first_day + timedelta(days=random.randint(0, 365))
+                # like changing repair date: read the repair, then write
+                repair = db.get(models.Repair, random.randint(1, 200))
+                repair.start_date = start
+                repair.end_date = start + timedelta(days=3)
+                db.add(models.Repair(car_name="car", start_date=start,
+                                     end_date=start + timedelta(days=3), active=True))
+                db.commit()
+                count("writes")
+            except OperationalError:
+                count("locked")
+            finally:
+                db.close()
+
+    def reader():
+        while time.time() < stop:
+            db = SessionLocal()
+            try:
+                start = first_day + timedelta(days=random.randint(0, 365))
+                db.scalars(overlapping(select(models.Repair), start,
+                                       start + timedelta(days=42))).all()
+                count("reads")
+            except OperationalError:
+                count("locked")
+            finally:
+                db.close()
+
+    threads = [threading.Thread(target=writer) for _ in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps(counts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--configuration", choices=CONFIGURATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.configuration:
+        run_configuration(args)
+        return
+
+    print(f"{'settings':10} {'writes':>8} {'reads':>8} {'locked':>8}")
+    for name, settings in CONFIGURATIONS.items():
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, **settings,
+                       DATABASE_URL=f"sqlite:///{directory}/bench.db", SECRET_KEY="bench")
+            output = subprocess.run(
+                [sys.executable, __file__, "--configuration", name,
+                 "--seconds", str(args.seconds), "--writers", str(args.writers),
+                 "--readers", str(args.readers)],
+                env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+            counts = json.loads(output.strip().splitlines()[-1])
+            print(f"{name:10} {counts['writes']:8} {counts['reads']:8} {counts['locked']:8}")
+
+
+if __name__ == "__main__":
+    main()
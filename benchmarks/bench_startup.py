@@ -0,0 +1,124 @@
+"""Startup time of the application against a budget.
+
+    python benchmarks/bench_startup.py [--runs 5] [--workers 2]
+        [--boot-budget-ms 2500] [--spawn-budget-ms 5000]
+
+Measured in fresh interpreters against a temporary SQLite file:
+
+    import      `import main` (module level work of every worker)
+    lifespan    schema bootstrap and settings log run by lifespan startup
+    spawn       `uvicorn main:app --workers N` until every worker finished
+                startup and a request was answered,
+                with MIGRATE_ON_STARTUP=0 after `python manage.py migrate`
+                (the setup advised for several workers; gunicorn with
+                uvicorn workers spawns them the same way)
+
+Most of the import time is spent importing FastAPI and pydantic. Exits
+with status 1 when median cold boot (import + lifespan) or spawn is over
+its budget, so it can guard startup time in CI.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOOT_SCRIPT = """
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+async def startup():
+    async with main.lifespan(main.app):
+        pass
+asyncio.run(startup())
+print(json.dumps({"import": imported - started, "lifespan": time.perf_counter() - imported}))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_boot(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-c", BOOT_SCRIPT], env=env, cwd=ROOT,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_spawn(env: dict, workers: int) -> float:
+    """Seconds from starting uvicorn until all workers finished startup and
+    the first request was answered"""
+    port = free_port()
+    env = dict(env, MIGRATE_ON_STARTUP="0")
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "info"],
+        env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        ready = 0
+        while ready < workers:
+            line = server.stderr.readline()
+            if not line:
+                raise RuntimeError("uvicorn exited before workers started")
+            if "Application startup complete" in line:
+                ready += 1
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/login", timeout=1):
+                    return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--boot-budget-ms", type=float, default=2500)
+    parser.add_argument("--spawn-budget-ms", type=float, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{directory}/startup.db",
+                   SECRET_KEY=os.environ.get("SECRET_KEY", "bench"))
+
+        first = measure_boot(env)
+        boots = [measure_boot(env) for _ in range(args.runs)]
+        subprocess.run([sys.executable, "manage.py", "migrate"], env=env, cwd=ROOT,
+                       check=True, capture_output=True)
+        spawns = [measure_spawn(env, args.workers) for _ in range(args.runs)]
+
+    def median_ms(values):
+        return statistics.median(values) * 1000
+
+    import_ms = median_ms([boot["import"] for boot in boots])
+    lifespan_ms = median_ms([boot["lifespan"] for boot in boots])
+    boot_ms = median_ms([boot["import"] + boot["lifespan"] for boot in boots])
+    spawn_ms = median_ms(spawns)
+    print(f"import               {import_ms:8.1f} ms")
+    print(f"lifespan             {lifespan_ms:8.1f} ms "
+          f"(new database: {first['lifespan'] * 1000:.1f} ms)")
+    print(f"cold boot            {boot_ms:8.1f} ms (budget {args.boot_budget_ms:.0f} ms)")
+    print(f"spawn {args.workers} workers      {spawn_ms:8.1f} ms (budget {args.spawn_budget_ms:.0f} ms)")
+
+    if boot_ms > args.boot_budget_ms or spawn_ms > args.spawn_budget_ms:
+        print("startup is over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
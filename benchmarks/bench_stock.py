@@ -0,0 +1,264 @@
+"""Stress test of stock accounting under parallel line item changes.
+
+    python benchmarks/bench_stock.py [--workers 16] [--operations 300] [--requests 1500]
+
+Runs against a temporary SQLite file with a few parts that have little
+stock left, so requests keep competing for the last pieces. Two phases:
+
+    threads   workers call the line item services directly, each operation
+              in its own transaction (retried when the database is locked)
+    http      concurrent POSTs to the mechanic add / change / remove
+              handlers through the ASGI app
+    batch     concurrent batches of 5 operations sent to
+              /mechanic/repairs/{repair_id}/parts, then 15 parts added to a
+              repair one request per part compared with one batch
+
+After each phase every part has to satisfy
+amount_left + pieces used in repairs == initial stock, and amount_left >= 0,
+Repair.money of every repair has to match its line items, and the admin
+statistics have to match a full rebuild.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARTS = 5
+REPAIRS = 4
+STOCK = 20
+BATCH_OPERATIONS = 5
+
+
+def seed():
+    import models
+    from database import SessionLocal
+    from routers.auth import create_access_token
+    from analytics import rebuild_analytics
+
+    db = SessionLocal()
+    user = models.User(username="bench", email="bench@popcorn", role="mechanic", hashed_password="-")
+    db.add(user)
+    db.add_all([models.Part(name=f"part {index}", amount_left=STOCK, price=10)
+                for index in range(PARTS)])
+    db.add_all([models.Repair(car_name=f"car {index}", start_date=date(2024, 1, 1),
+                              end_date=date(2024, 1, 2), active=True)
+                for index in range(REPAIRS)])
+    db.commit()
+    # seeded rows bypass the statistics, like data from before they existed
+    rebuild_analytics(db)
+    db.commit()
+    token = create_access_token(user)
+    ids = ([part.id for part in db.query(models.Part).all()],
+           [repair.id for repair in db.query(models.Repair).all()])
+    db.close()
+    return token, ids
+
+
+def check(phase: str, part_ids):
+    from sqlalchemy import func
+    import models
+    from database import SessionLocal
+    from repairs import reconcile_repair_totals
+    from analytics import load_analytics, rebuild_analytics
+
+    db = SessionLocal()
+    used = dict(db.query(models.PartsInRepair.part_id, func.sum(models.PartsInRepair.quantity)).group_by(
+        models.PartsInRepair.part_id).all())
+    broken = []
+    for part in db.query(models.Part).filter(models.Part.id.in_(part_ids)):
+        if part.amount_left < 0 or part.amount_left + (used.get(part.id) or 0) != STOCK:
+            broken.append((part.id, part.amount_left, used.get(part.id)))
+    drifted = reconcile_repair_totals(db, fix=False)
+    statistics = load_analytics(db)
+    rebuild_analytics(db)
+    statistics_ok = statistics == load_analytics(db)
+    db.rollback()
+    db.close()
+    print(f"{phase:8} stock {'OK' if not broken else f'BROKEN {broken}'}, "
+          f"totals {'OK' if not drifted else f'DRIFTED {drifted}'}, "
+          f"statistics {'OK' if statistics_ok else 'DRIFTED'}")
+    return not broken and not drifted and statistics_ok
+
+
+def random_operation(part_ids, repair_ids):
+    kind = random.choice(["add", "add", "set", "remove"])
+    return kind, random.choice(repair_ids), random.choice(part_ids), random.randint(1, 8)
+
+
+def run_threads(args, part_ids, repair_ids):
+    from sqlalchemy.exc import OperationalError
+    from database import SessionLocal
+    from repairs import add_line_item, set_line_item_quantity, remove_line_item, LineItemError
+
+    counts = {"applied": 0, "rejected": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def worker():
+        db = SessionLocal()
+        for _ in range(args.operations):
+            kind, repair_id, part_id, quantity = random_operation(part_ids, repair_ids)
+            while True:
+                try:
+                    if kind == "add":
+                        add_line_item(db, repair_id, part_id, quantity)
+                    elif kind == "set":
+                        set_line_item_quantity(db, repair_id, part_id, quantity)
+                    else:
+                        remove_line_item(db, repair_id, part_id)
+                    db.commit()
+                    outcome = "applied"
+                except LineItemError:
+                    db.rollback()
+                    outcome = "rejected"
+                except OperationalError:
+                    db.rollback()
+                    with lock:
+                        counts["locked"] += 1
+                    continue
+                break
+            with lock:
+                counts[outcome] += 1
+        db.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    total = args.workers * args.operations
+    print(f"threads  {total} operations in {elapsed:.2f} s ({total / elapsed:.0f}/s), "
+          f"applied {counts['applied']} rejected {counts['rejected']} lock retries {counts['locked']}")
+
+
+async def run_http(args, token, part_ids, repair_ids):
+    import httpx
+    from main import app
+
+    counts = {"applied": 0, "rejected": 0}
+    semaphore = asyncio.Semaphore(args.workers)
+
+    async def one(client):
+        kind, repair_id, part_id, quantity = random_operation(part_ids, repair_ids)
+        if kind == "add":
+            url, data = f"/mechanic/repairs/{repair_id}", {"part_id": part_id, "quantity": quantity}
+        elif kind == "set":
+            url, data = f"/mechanic/repairs/{repair_id}/{part_id}", {"new_amount": quantity}
+        else:
+            url, data = f"/mechanic/repairs/{repair_id}/delete_part/{part_id}", {}
+        async with semaphore:
+            response = await client.post(url, data=data)
+        assert response.status_code == 302, response.text
+        counts["rejected" if "msg=" in response.headers["location"] else "applied"] += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 cookies={"access_token": token}) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client) for _ in range(args.requests)))
+        elapsed = time.perf_counter() - started
+    print(f"http     {args.requests} requests in {elapsed:.2f} s ({args.requests / elapsed:.0f}/s), "
+          f"applied {counts['applied']} rejected {counts['rejected']}")
+
+
+async def run_batch(args, token, part_ids, repair_ids):
+    import httpx
+    from main import app
+
+    counts = {"applied": 0, "rejected": 0}
+    semaphore = asyncio.Semaphore(args.workers)
+
+    def operations():
+        result = []
+        for kind, _, part_id, quantity in (random_operation(part_ids, repair_ids) for _ in range(BATCH_OPERATIONS)):
+            result.append({"op": kind, "part_id": part_id, "quantity": quantity})
+        return result
+
+    async def one(client):
+        async with semaphore:
+            response = await client.post(f"/mechanic/repairs/{random.choice(repair_ids)}/parts",
+                                         json={"operations": operations()})
+        assert response.status_code in (200, 400, 409), response.text
+        counts["applied" if response.status_code == 200 else "rejected"] += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 cookies={"access_token": token}) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client) for _ in range(args.requests // BATCH_OPERATIONS)))
+        elapsed = time.perf_counter() - started
+        print(f"batch    {args.requests // BATCH_OPERATIONS} batches in {elapsed:.2f} s "
+              f"({args.requests / elapsed:.0f} operations/s), "
+              f"applied {counts['applied']} rejected {counts['rejected']}")
+
+        # one repair edited by 15 operations, with all stock back in storage
+        async def empty_repairs():
+            for repair_id in repair_ids:
+                response = await client.post(f"/mechanic/repairs/{repair_id}/parts", json={
+                    "operations": [{"op": "remove", "part_id": part_id} for part_id in part_ids]})
+                assert response.status_code == 200, response.text
+
+        repair_id = repair_ids[0]
+        await empty_repairs()
+        single = [(f"/mechanic/repairs/{repair_id}", {"part_id": part_ids[index % PARTS], "quantity": 1})
+                  for index in range(15)]
+        started = time.perf_counter()
+        for url, data in single:
+            await client.post(url, data=data)
+            await client.get(f"/mechanic/repairs/{repair_id}")
+        single_time = time.perf_counter() - started
+        await empty_repairs()
+        started = time.perf_counter()
+        response = await client.post(f"/mechanic/repairs/{repair_id}/parts", json={"operations": [
+            {"op": "add", "part_id": data["part_id"], "quantity": 1} for _, data in single]})
+        batch_time = time.perf_counter() - started
+        assert response.status_code == 200, response.text
+        print(f"15 parts one by one (POST + redirected page) {single_time * 1000:.1f} ms, "
+              f"one batch {batch_time * 1000:.1f} ms")
+
+
+async def run_requests(args, token, part_ids, repair_ids):
+    # one event loop, the async engine pool is bound to it
+    await run_http(args, token, part_ids, repair_ids)
+    http_ok = check("http", part_ids)
+    await run_batch(args, token, part_ids, repair_ids)
+    return http_ok, check("batch", part_ids)
+
+
+def run(args):
+    import migrations
+    from database import engine
+
+    migrations.upgrade(engine)
+    token, (part_ids, repair_ids) = seed()
+    run_threads(args, part_ids, repair_ids)
+    threads_ok = check("threads", part_ids)
+    results = asyncio.run(run_requests(args, token, part_ids, repair_ids))
+    if not (threads_ok and all(results)):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--operations", type=int, default=300, help="per worker thread")
+    parser.add_argument("--requests", type=int, default=1500)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/bench.db"
+        sys.path.insert(0, ROOT)
+        os.chdir(ROOT)
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
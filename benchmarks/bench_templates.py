@@ -0,0 +1,62 @@
+"""Template compile time in a fresh worker with and without bytecode cache.
+
+    python benchmarks/bench_templates.py [--runs 5]
+
+Every run starts a new interpreter and loads all templates, like the first
+requests after a deploy do:
+
+    no cache     empty bytecode cache directory, every template is parsed
+    warm cache   cache filled by `python manage.py compile-templates`
+    in memory    templates loaded a second time in the same worker (steady state)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOAD_SCRIPT = """
+import json, time
+from templating import templates
+names = templates.env.list_templates(extensions=["html"])
+timings = []
+for attempt in range(2):
+    started = time.perf_counter()
+    for name in names:
+        templates.env.get_template(name)
+    timings.append(time.perf_counter() - started)
+print(json.dumps(timings))
+"""
+
+
+def load(env: dict):
+    output = subprocess.run([sys.executable, "-c", LOAD_SCRIPT], env=env, cwd=ROOT,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    cold, warm, steady = [], [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, TEMPLATE_CACHE_DIR=directory, PYTHONPATH=ROOT)
+            first, second = load(env)
+            cold.append(first)
+            first, second = load(env)
+            warm.append(first)
+            steady.append(second)
+
+    for label, timings in [("no cache", cold), ("warm cache", warm), ("in memory", steady)]:
+        print(f"{label:12} {statistics.median(timings) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
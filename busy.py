@@ -0,0 +1,147 @@
+from collections import Counter
+from datetime import date, timedelta
+from typing import List, Tuple
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.orm import Session
+import models
+from versions import bump_versions
+
+ONE_DAY = timedelta(days=1)
+
+Interval = Tuple[date, date]
+
+
+def busy_period(repair: models.Repair) -> Interval | None:
+    """Dates occupied by the repair, None when repair does not block the shop"""
+    if not repair.active or repair.start_date is None or repair.end_date is None:
+        return None
+    return repair.start_date, max(repair.start_date, repair.end_date)
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    """Merges overlapping and adjacent (next day) intervals"""
+    merged: List[Interval] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + ONE_DAY:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def add_busy(db: Session, start: date, end: date):
+    """Merges [start, end] with busy ranges overlapping or touching it.
+    Only ranges around the new one are read, through the start/end index."""
+    db.flush()
+    touching = db.query(models.BusyRange).filter(
+        models.BusyRange.start_date <= end + ONE_DAY,
+        models.BusyRange.end_date >= start - ONE_DAY).all()
+    for busy_range in touching:
+        start = min(start, busy_range.start_date)
+        end = max(end, busy_range.end_date)
+        db.delete(busy_range)
+    db.add(models.BusyRange(start_date=start, end_date=end))
+
+
+def remove_busy(db: Session, start: date, end: date):
+    """Frees [start, end] of a repair which stopped blocking the shop.
+
+    Every day of a busy range outside [start, end] is still covered by some
+    other repair, so only [start, end] is recomputed from repairs overlapping
+    it."""
+    db.flush()
+    containing = db.query(models.BusyRange).filter(
+        models.BusyRange.start_date <= end,
+        models.BusyRange.end_date >= start).all()
+    if not containing:
+        return
+
+    pieces: List[Interval] = []
+    for busy_range in containing:
+        if busy_range.start_date < start:
+            pieces.append((busy_range.start_date, start - ONE_DAY))
+        if busy_range.end_date > end:
+            pieces.append((end + ONE_DAY, busy_range.end_date))
+        db.delete(busy_range)
+
+    still_busy = db.query(models.Repair).filter(
+        models.Repair.start_date <= end,
+        models.Repair.end_date >= start,
+        models.Repair.active == True).all()
+    for repair in still_busy:
+        period = busy_period(repair)
+        if period is not None:
+            pieces.append((max(period[0], start), min(period[1], end)))
+
+    db.flush()
+    for piece_start, piece_end in merge_intervals(pieces):
+        db.add(models.BusyRange(start_date=piece_start, end_date=piece_end))
+
+
+def days_of(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def change_occupancy(db: Session, start: date, end: date, change: int):
+    """Adds change to repairs counted on every day of [start, end]. Existing
+    counters are updated before missing days are looked up, so the lookup
+    runs in a transaction which already holds the write lock."""
+    table = models.BayOccupancy.__table__
+    period = table.c.day.between(start, end)
+    db.execute(update(table).where(period).values(repairs=table.c.repairs + change))
+    if change > 0:
+        existing = set(db.execute(select(table.c.day).where(period)).scalars())
+        missing = [{"day": day, "repairs": change} for day in days_of(start, end)
+                   if day not in existing]
+        if missing:
+            db.execute(insert(table), missing)
+    else:
+        db.execute(delete(table).where(period, table.c.repairs <= 0))
+
+
+def update_busy(db: Session, old: Interval | None, new: Interval | None):
+    """Moves busy time and bay occupancy of a repair from old to new period,
+    None stands for repair which was not / is no longer blocking the shop"""
+    if old == new:
+        return
+    if old is not None:
+        remove_busy(db, *old)
+        change_occupancy(db, *old, -1)
+    if new is not None:
+        add_busy(db, *new)
+        change_occupancy(db, *new, 1)
+
+
+def rebuild_busy(db: Session):
+    """Recomputes all busy ranges from active repairs"""
+    db.query(models.BusyRange).delete()
+    # bulk delete skips flush, where changes are counted
+    bump_versions(db.connection(), ["busy_range"])
+    active_repairs = db.query(models.Repair).filter(
+        models.Repair.active == True).all()
+    periods = [busy_period(repair) for repair in active_repairs]
+    for start, end in merge_intervals([period for period in periods if period]):
+        db.add(models.BusyRange(start_date=start, end_date=end))
+
+
+def rebuild_occupancy(db: Session):
+    """Recomputes repairs counted on every day from active repairs"""
+    db.execute(delete(models.BayOccupancy.__table__))
+    active_repairs = db.query(models.Repair).filter(
+        models.Repair.active == True).all()
+    counts = Counter()
+    for repair in active_repairs:
+        period = busy_period(repair)
+        if period is not None:
+            counts.update(days_of(*period))
+    if counts:
+        db.execute(insert(models.BayOccupancy.__table__),
+                   [{"day": day, "repairs": repairs} for day, repairs in sorted(counts.items())])
+
+
+def busy_ranges(db: Session, start: date, end: date) -> List[models.BusyRange]:
+    """Busy ranges overlapping [start, end) window"""
+    return db.query(models.BusyRange).filter(
+        models.BusyRange.start_date < end,
+        models.BusyRange.end_date >= start).order_by(models.BusyRange.start_date).all()
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import models
+from versions import read_versions
+
+# how long a snapshot is trusted before its version is compared with the
+# database, changes made by other workers show up after at most this time
+CATALOGUE_CHECK_SECONDS = float(os.environ.get("CATALOGUE_CHECK_SECONDS", 1.0))
+
+
+class CatalogueEntry(NamedTuple):
+    """Part as kept in the catalogue snapshot, same attributes as models.Part"""
+    id: int
+    name: str
+    amount_left: int
+    engine_type: str
+    price: float
+    nr_oem: str
+    qr_code: str
+
+
+def build_index(entries: List[CatalogueEntry], attribute: str) -> Dict[str, Tuple[CatalogueEntry, ...]]:
+    index = {}
+    for entry in entries:
+        key = getattr(entry, attribute)
+        if key:
+            index[key] = index.get(key, ()) + (entry,)
+    return index
+
+
+class Catalogue:
+    """Snapshot of all parts with dictionary indexes on scanned codes"""
+
+    def __init__(self, entries: List[CatalogueEntry], version: int):
+        self.version = version
+        self.by_id = {entry.id: entry for entry in entries}
+        self.by_qr_code = build_index(entries, "qr_code")
+        self.by_nr_oem = build_index(entries, "nr_oem")
+        self.checked_at = time.monotonic()
+
+    def find(self, qr_code: str | None = None, nr_oem: str | None = None) -> Tuple[CatalogueEntry, ...]:
+        if qr_code is not None:
+            return self.by_qr_code.get(qr_code, ())
+        if nr_oem is not None:
+            return self.by_nr_oem.get(nr_oem, ())
+        return ()
+
+    def scan(self, code: str) -> Tuple[CatalogueEntry, ...]:
+        """Parts with scanned code, QR code first then OEM number"""
+        return self.by_qr_code.get(code) or self.by_nr_oem.get(code, ())
+
+
+_catalogue: Catalogue | None = None
+_lock = threading.Lock()
+
+
+def part_version(db: Session) -> int:
+    version, _ = read_versions(db, ["part"]).get("part", (0, None))
+    return version
+
+
+def load_catalogue(db: Session) -> Catalogue:
+    # version is read first, a change committed meanwhile only causes a reload
+    version = part_version(db)
+    rows = db.execute(select(models.Part.id, models.Part.name, models.Part.amount_left,
+                             models.Part.engine_type, models.Part.price,
+                             models.Part.nr_oem, models.Part.qr_code)).all()
+    return Catalogue([CatalogueEntry(*row) for row in rows], version)
+
+
+def cached_catalogue() -> Catalogue | None:
+    """Snapshot when it was checked recently enough to be used without DB"""
+    catalogue = _catalogue
+    if catalogue is not None and time.monotonic() - catalogue.checked_at < CATALOGUE_CHECK_SECONDS:
+        return catalogue
+    return None
+
+
+def get_catalogue(db: Session) -> Catalogue:
+    """Read-through access to the snapshot, reloaded when parts changed"""
+    global _catalogue
+    catalogue = cached_catalogue()
+    if catalogue is not None:
+        return catalogue
+    with _lock:
+        catalogue = _catalogue
+        if catalogue is not None and part_version(db) == catalogue.version:
+            catalogue.checked_at = time.monotonic()
+            return catalogue
+        _catalogue = load_catalogue(db)
+        return _catalogue
+
+
+def invalidate_catalogue():
+    """Drops the snapshot, called after parts are changed by this worker"""
+    global _catalogue
+    _catalogue = None
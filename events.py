@@ -0,0 +1,177 @@
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+from typing import AsyncIterator, Deque, NamedTuple, Set
+from starlette.requests import Request
+import models
+
+# events waiting for one client, a client falling further behind gets "resync"
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 100))
+# open streams per worker, more are refused with 503
+MAX_EVENT_CLIENTS = int(os.environ.get("MAX_EVENT_CLIENTS", 200))
+# recent events replayed to clients reconnecting with Last-Event-ID
+EVENT_HISTORY = 500
+# comment line sent on idle streams, so proxies do not close them
+KEEPALIVE_SECONDS = 15
+# reconnect delay advised to browsers (ms)
+RETRY_MILLISECONDS = 5000
+# a stream is ended after this many seconds and the browser reconnects with
+# Last-Event-ID (nothing is lost), so an open dashboard never holds up a
+# server shutdown for longer: uvicorn waits for running requests before it
+# runs the lifespan shutdown
+EVENT_STREAM_SECONDS = float(os.environ.get("EVENT_STREAM_SECONDS", 30))
+
+# event ids of this process start with it, ids of another worker or of
+# a previous run are not replayed
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+class Event(NamedTuple):
+    id: str
+    kind: str
+    data: dict
+
+    def encode(self) -> str:
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+RESYNC = "resync"
+
+
+class Subscription:
+    """Bounded queue of events for one stream. Instead of blocking publishers
+    (or growing without limit) an overflowing queue is replaced by a single
+    resync event, the client reloads its data then."""
+
+    def __init__(self, maxsize: int = EVENT_QUEUE_SIZE):
+        self.queue: asyncio.Queue[Event | None] = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def push(self, event: Event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(Event(event.id, RESYNC, {}))
+
+    def close(self):
+        """Ends the stream, events still queued are dropped (the client
+        reconnects to a new process, which sends resync anyway)"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class EventBroker:
+    """In-process pub/sub of change events. Publishing never waits, it is
+    called by write handlers after commit on the event loop thread. Streams
+    of one worker see changes made through that worker only."""
+
+    def __init__(self):
+        self.subscribers: Set[Subscription] = set()
+        self.history: Deque[Event] = deque(maxlen=EVENT_HISTORY)
+        self.last_number = 0
+        self.closed = False
+
+    def publish(self, kind: str, data: dict):
+        self.last_number += 1
+        event = Event(f"{BOOT_ID}-{self.last_number}", kind, data)
+        self.history.append(event)
+        for subscription in list(self.subscribers):
+            subscription.push(event)
+
+    def missed_events(self, last_event_id: str) -> list | None:
+        """Events published after last_event_id, None when they are not all
+        in the history any more"""
+        boot_id, _, number = last_event_id.partition("-")
+        if boot_id != BOOT_ID or not number.isdigit() or int(number) > self.last_number:
+            return None
+        number = int(number)
+        oldest = int(self.history[0].id.partition("-")[2]) if self.history else self.last_number + 1
+        if number + 1 < oldest:
+            return None
+        return [event for event in self.history if int(event.id.partition("-")[2]) > number]
+
+    def subscribe(self, last_event_id: str | None = None) -> Subscription | None:
+        """New stream, None when there are already MAX_EVENT_CLIENTS or
+        the broker is closed"""
+        if self.closed or len(self.subscribers) >= MAX_EVENT_CLIENTS:
+            return None
+        subscription = Subscription()
+        if last_event_id:
+            missed = self.missed_events(last_event_id)
+            if missed is None:
+                subscription.push(Event(f"{BOOT_ID}-{self.last_number}", RESYNC, {}))
+            else:
+                for event in missed:
+                    subscription.push(event)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    def open(self):
+        self.closed = False
+
+    def close(self):
+        """Ends all open streams and refuses new ones, called when the
+        worker shuts down"""
+        self.closed = True
+        for subscription in self.subscribers:
+            subscription.close()
+        self.subscribers.clear()
+
+
+broker = EventBroker()
+
+
+async def event_stream(request: Request, subscription: Subscription) -> AsyncIterator[str]:
+    """Server-Sent Events body of one subscription, ends after
+    EVENT_STREAM_SECONDS or when the broker is closed"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + EVENT_STREAM_SECONDS
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), min(KEEPALIVE_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                break
+            yield event.encode()
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def repair_data(repair: models.Repair) -> dict:
+    return {"id": repair.id, "car_name": repair.car_name,
+            "start_date": f"{repair.start_date}", "end_date": f"{repair.end_date}",
+            "active": bool(repair.active), "money": repair.money or 0}
+
+
+def publish_repair(repair: models.Repair, action: str):
+    """action: created, updated or deleted"""
+    broker.publish("repair", {"action": action, "repair": repair_data(repair)})
+
+
+def publish_repair_total(repair_id: int, money: float | None):
+    """Line items of a repair changed"""
+    broker.publish("line_item", {"repair_id": repair_id, "money": money or 0})
+
+
+def publish_message(message: models.Message, action: str):
+    """action: created or deleted"""
+    broker.publish("message", {"action": action, "message": {
+        "id": message.id, "email": message.email, "message": message.message}})
@@ -0,0 +1,133 @@
+import os
+import threading
+from datetime import date
+from typing import List, NamedTuple
+import numpy as np
+from sqlalchemy import select, func, cast, literal, Integer
+from sqlalchemy.orm import Session
+import models
+from versions import read_versions
+from catalogue import get_catalogue
+
+# older consumption counts less, its weight halves every this many days
+FORECAST_HALF_LIFE_DAYS = float(os.environ.get("FORECAST_HALF_LIFE_DAYS", 60))
+# days until ordered parts arrive, parts running out sooner are reordered
+REORDER_LEAD_DAYS = int(os.environ.get("REORDER_LEAD_DAYS", 14))
+# days of consumption the suggested order covers after it arrives
+REORDER_COVER_DAYS = int(os.environ.get("REORDER_COVER_DAYS", 30))
+
+# tables consumption history is read from, rates are recomputed when they change
+CONSUMPTION_TABLES = ["parts_in_repair", "repair"]
+
+EPOCH = date(1970, 1, 1)
+
+
+class ConsumptionRates:
+    """Expected pieces used per day, part_ids sorted for searchsorted"""
+
+    def __init__(self, part_ids: np.ndarray, daily: np.ndarray, key: tuple):
+        self.part_ids = part_ids
+        self.daily = daily
+        self.key = key
+
+    def for_parts(self, part_ids: np.ndarray) -> np.ndarray:
+        """Daily rates of given parts, 0 for parts never used"""
+        if not len(self.part_ids):
+            return np.zeros(len(part_ids))
+        positions = np.searchsorted(self.part_ids, part_ids).clip(0, len(self.part_ids) - 1)
+        return np.where(self.part_ids[positions] == part_ids, self.daily[positions], 0.0)
+
+
+class ReorderSuggestion(NamedTuple):
+    part_id: int
+    name: str
+    amount_left: int
+    daily_usage: float
+    days_left: float | None
+    reorder_quantity: int
+
+
+def day_number(column, dialect: str):
+    """Date column as days since 1970-01-01, computed by the database so
+    rows arrive as plain integers"""
+    if dialect == "sqlite":
+        return cast(func.julianday(column) - 2440587.5, Integer)
+    if dialect == "postgresql":
+        return column - literal(EPOCH)
+    # MySQL, TO_DAYS('1970-01-01') = 719528
+    return func.to_days(column) - 719528
+
+
+def load_consumption(db: Session):
+    """Line items as arrays: part id, day of repair start (days since epoch)
+    and quantity"""
+    line = models.PartsInRepair.__table__
+    repair = models.Repair.__table__
+    day = day_number(repair.c.start_date, db.get_bind().dialect.name)
+    result = db.execute(select(line.c.part_id, day, line.c.quantity).join(
+        repair, repair.c.id == line.c.repair_id).where(
+        repair.c.start_date.is_not(None), line.c.quantity > 0))
+    # flat iterator, numpy builds arrays from Row objects slowly
+    values = np.fromiter((value for row in result.tuples() for value in row), dtype=np.int64)
+    values = values.reshape(-1, 3)
+    return values[:, 0], values[:, 1], values[:, 2].astype(np.float64)
+
+
+def consumption_rates(part_ids: np.ndarray, days: np.ndarray, quantities: np.ndarray,
+                      today: int, half_life: float = FORECAST_HALF_LIFE_DAYS, key: tuple = ()) -> ConsumptionRates:
+    """Exponentially weighted average of pieces used per day over the whole
+    history, computed for all parts at once. Repairs planned for later days
+    count as today's consumption."""
+    if not len(part_ids):
+        return ConsumptionRates(np.array([], dtype=np.int64), np.array([]), key)
+    age = np.maximum(today - days, 0)
+    decay = 0.5 ** (1.0 / half_life)
+    unique_ids, index = np.unique(part_ids, return_inverse=True)
+    weighted = np.bincount(index, weights=quantities * decay ** age, minlength=len(unique_ids))
+    # sum of weights of every day of history, geometric series
+    history_days = int(age.max()) + 1
+    weight_of_days = (1.0 - decay ** history_days) / (1.0 - decay)
+    return ConsumptionRates(unique_ids, weighted / weight_of_days, key)
+
+
+_rates: ConsumptionRates | None = None
+_lock = threading.Lock()
+
+
+def get_consumption_rates(db: Session) -> ConsumptionRates:
+    """Rates cached until line items or repairs change, or the day changes"""
+    global _rates
+    versions = read_versions(db, CONSUMPTION_TABLES)
+    key = (date.today(),) + tuple(versions.get(name, (0, None))[0] for name in CONSUMPTION_TABLES)
+    rates = _rates
+    if rates is not None and rates.key == key:
+        return rates
+    with _lock:
+        if _rates is None or _rates.key != key:
+            today = (date.today() - EPOCH).days
+            _rates = consumption_rates(*load_consumption(db), today, key=key)
+        return _rates
+
+
+def reorder_report(db: Session, only_needed: bool = True) -> List[ReorderSuggestion]:
+    """Parts by days of stock left at the forecast consumption, with quantity
+    to order so stock lasts REORDER_COVER_DAYS after lead time. Stock is taken
+    from the catalogue snapshot."""
+    rates = get_consumption_rates(db)
+    entries = list(get_catalogue(db).by_id.values())
+    if not entries:
+        return []
+    part_ids = np.fromiter((entry.id for entry in entries), dtype=np.int64, count=len(entries))
+    amount_left = np.fromiter((entry.amount_left or 0 for entry in entries), dtype=np.float64,
+                              count=len(entries))
+    daily = rates.for_parts(part_ids)
+    with np.errstate(divide="ignore"):
+        days_left = np.where(daily > 0, amount_left / daily, np.inf)
+    needed = np.ceil(daily * (REORDER_LEAD_DAYS + REORDER_COVER_DAYS) - amount_left).clip(min=0)
+    selected = np.flatnonzero(days_left < REORDER_LEAD_DAYS) if only_needed else np.flatnonzero(daily > 0)
+    selected = selected[np.argsort(days_left[selected], kind="stable")]
+    return [ReorderSuggestion(int(part_ids[i]), entries[i].name, int(amount_left[i]),
+                              float(f"{daily[i]:.3g}"),
+                              round(float(days_left[i]), 1) if np.isfinite(days_left[i]) else None,
+                              int(needed[i]))
+            for i in selected]
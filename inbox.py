@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Deque, List, Tuple
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+import models
+from database import new_session
+from events import publish_message
+
+logger = logging.getLogger("uvicorn.error")
+
+# messages accepted but not written yet, more are shed (503)
+CONTACT_BUFFER_SIZE = int(os.environ.get("CONTACT_BUFFER_SIZE", 1000))
+# messages written in one transaction
+CONTACT_BATCH_SIZE = int(os.environ.get("CONTACT_BATCH_SIZE", 200))
+# longest wait of an accepted message for the writer
+CONTACT_FLUSH_SECONDS = float(os.environ.get("CONTACT_FLUSH_SECONDS", 1.0))
+# longer messages are refused, so the buffer is bounded in bytes too
+CONTACT_MAX_LENGTH = int(os.environ.get("CONTACT_MAX_LENGTH", 5000))
+
+# token buckets: sustained messages per minute and burst, per IP and e-mail
+CONTACT_IP_PER_MINUTE = float(os.environ.get("CONTACT_IP_PER_MINUTE", 6))
+CONTACT_IP_BURST = int(os.environ.get("CONTACT_IP_BURST", 10))
+CONTACT_EMAIL_PER_MINUTE = float(os.environ.get("CONTACT_EMAIL_PER_MINUTE", 2))
+CONTACT_EMAIL_BURST = int(os.environ.get("CONTACT_EMAIL_BURST", 3))
+# messages which could not be written at shutdown, written on the next start
+CONTACT_SPOOL_FILE = os.environ.get("CONTACT_SPOOL_FILE", "contact_spool.jsonl")
+# senders remembered by each limiter, the least recently seen are forgotten
+MAX_TRACKED_SENDERS = int(os.environ.get("MAX_TRACKED_SENDERS", 10000))
+
+ACCEPTED = "accepted"
+RATE_LIMITED = "rate_limited"
+SHED = "shed"
+TOO_LONG = "too_long"
+
+PendingMessage = Tuple[str, str]
+
+
+class TokenBuckets:
+    """Token bucket per key in an LRU table of at most max_keys buckets.
+    A forgotten key starts again with a full bucket, so memory stays bounded
+    at the cost of forgetting the quietest senders first."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = MAX_TRACKED_SENDERS):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def allow(self, key: str, now: float | None = None) -> bool:
+        """Takes a token of key, False when there is none"""
+        now = time.monotonic() if now is None else now
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    def retry_after(self, key: str) -> int:
+        """Seconds until key has a token again"""
+        tokens, _ = self.buckets.get(key, (self.burst, 0))
+        return max(1, int((1 - tokens) / self.rate) + 1) if tokens < 1 else 0
+
+
+def write_messages(db: Session, messages: List[PendingMessage]) -> List[models.Message]:
+    """Inserts messages, returns them with their ids. One executemany with
+    RETURNING where the database has it (SQLite, PostgreSQL), otherwise
+    (MySQL) the ORM inserts row by row and reads each id from the cursor."""
+    if not db.get_bind().dialect.insert_executemany_returning:
+        written = [models.Message(email=email, message=message) for email, message in messages]
+        db.add_all(written)
+        db.flush()
+        return written
+    return list(db.scalars(insert(models.Message).returning(models.Message, sort_by_parameter_order=True),
+                           [{"email": email, "message": message} for email, message in messages]))
+
+
+def spool_messages(messages: List[PendingMessage]):
+    """Appends messages to the spool file, one JSON object per line. The
+    file holds personal data, so only its owner can read it."""
+    descriptor = os.open(CONTACT_SPOOL_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with os.fdopen(descriptor, "a", encoding="utf-8") as spool:
+        for email, message in messages:
+            spool.write(json.dumps({"email": email, "message": message}) + "\n")
+
+
+def take_spooled_messages() -> List[PendingMessage]:
+    """Reads and removes the spool file. It is renamed first, so of workers
+    starting together only one takes the messages. A line cut short by a
+    failed write is skipped."""
+    taken = f"{CONTACT_SPOOL_FILE}.{os.getpid()}"
+    try:
+        os.replace(CONTACT_SPOOL_FILE, taken)
+    except FileNotFoundError:
+        return []
+    messages = []
+    with open(taken, encoding="utf-8") as spool:
+        for line in spool:
+            try:
+                row = json.loads(line)
+                messages.append((row["email"], row["message"]))
+            except (ValueError, KeyError, TypeError):
+                logger.error("Unreadable line of %s skipped", CONTACT_SPOOL_FILE)
+    os.remove(taken)
+    return messages
+
+
+class ContactInbox:
+    """Contact messages accepted into a bounded buffer and written in
+    batches by one background task. start() and stop() are called around
+    serving requests, stop() writes everything still buffered."""
+
+    def __init__(self):
+        self.pending: Deque[PendingMessage] = deque()
+        self.by_ip = TokenBuckets(CONTACT_IP_PER_MINUTE, CONTACT_IP_BURST)
+        self.by_email = TokenBuckets(CONTACT_EMAIL_PER_MINUTE, CONTACT_EMAIL_BURST)
+        self.counters = Counter()
+        self.wakeup = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        self.closed = False
+
+    def offer(self, ip: str, email: str, message: str) -> str:
+        """Decides about one message: ACCEPTED, RATE_LIMITED, SHED or TOO_LONG"""
+        if len(message) > CONTACT_MAX_LENGTH or len(email) > CONTACT_MAX_LENGTH:
+            result = TOO_LONG
+        elif not self.by_ip.allow(ip):
+            result = RATE_LIMITED
+            self.counters["rate_limited_ip"] += 1
+        elif not self.by_email.allow(email.strip().lower()):
+            result = RATE_LIMITED
+            self.counters["rate_limited_email"] += 1
+        elif self.closed or len(self.pending) >= CONTACT_BUFFER_SIZE:
+            result = SHED
+        else:
+            result = ACCEPTED
+            self.pending.append((email, message))
+            if len(self.pending) >= CONTACT_BATCH_SIZE:
+                self.wakeup.set()
+        self.counters[result] += 1
+        return result
+
+    def retry_after(self, ip: str, email: str) -> int:
+        return max(self.by_ip.retry_after(ip), self.by_email.retry_after(email.strip().lower()),
+                   int(CONTACT_FLUSH_SECONDS) + 1)
+
+    async def flush_batch(self) -> int:
+        """Writes up to CONTACT_BATCH_SIZE buffered messages in one
+        transaction. When the write fails they go back to the buffer."""
+        batch = [self.pending.popleft() for _ in range(min(CONTACT_BATCH_SIZE, len(self.pending)))]
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        try:
+            async with new_session() as db:
+                written = await db.run_sync(write_messages, batch)
+                await db.commit()
+        except Exception:
+            logger.exception("Writing %d contact messages failed", len(batch))
+            self.pending.extendleft(reversed(batch))
+            self.counters["write_errors"] += 1
+            raise
+        self.counters["written"] += len(written)
+        self.counters["batches"] += 1
+        self.counters["write_ms"] += round((time.perf_counter() - started) * 1000)
+        for message in written:
+            publish_message(message, "created")
+        return len(written)
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), CONTACT_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while self.pending:
+                    await self.flush_batch()
+            except Exception:
+                # messages stay buffered, next attempt after CONTACT_FLUSH_SECONDS
+                await asyncio.sleep(CONTACT_FLUSH_SECONDS)
+
+    def start(self):
+        """Starts the writer, messages spooled by the last stop() are
+        buffered again first"""
+        spooled = take_spooled_messages()
+        if spooled:
+            logger.info("%d spooled contact messages buffered again", len(spooled))
+            self.pending.extend(spooled)
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.writer = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops accepting and writes all buffered messages. The writer is
+        not cancelled, a batch being written is finished first. Messages
+        which can not be written are spooled to CONTACT_SPOOL_FILE."""
+        self.closed = True
+        self.wakeup.set()
+        if self.writer is not None:
+            await self.writer
+            self.writer = None
+        try:
+            while self.pending:
+                await self.flush_batch()
+        except Exception:
+            try:
+                spool_messages(list(self.pending))
+                logger.error("%d contact messages not saved, spooled to %s",
+                             len(self.pending), CONTACT_SPOOL_FILE)
+            except OSError:
+                logger.exception("%d contact messages not saved, spooling failed", len(self.pending))
+            self.pending.clear()
+
+    def stats(self) -> dict:
+        """Load shedding metrics of this worker"""
+        return {"buffered": len(self.pending), "buffer_size": CONTACT_BUFFER_SIZE,
+                "accepted": self.counters[ACCEPTED], "shed": self.counters[SHED],
+                "too_long": self.counters[TOO_LONG],
+                "rate_limited_ip": self.counters["rate_limited_ip"],
+                "rate_limited_email": self.counters["rate_limited_email"],
+                "written": self.counters["written"], "batches": self.counters["batches"],
+                "write_errors": self.counters["write_errors"],
+                "write_ms": self.counters["write_ms"],
+                "tracked_ips": len(self.by_ip.buckets), "tracked_emails": len(self.by_email.buckets)}
+
+
+inbox = ContactInbox()
@@ -1,24 +1,53 @@
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from starlette.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
-from starlette.staticfiles import StaticFiles
+import os
+from contextlib import asynccontextmanager
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from starlette.responses import RedirectResponse, Response
 from fastapi import FastAPI, Depends, Request, status
-import models
-from database import engine
+import migrations
+from assets import static_files
+from database import engine, async_engine, log_settings
+from events import broker, MAX_EVENT_CLIENTS
+from inbox import inbox
+from metrics import MetricsMiddleware, render_metrics, METRICS_TOKEN, CONTENT_TYPE
+from passwords import password_pool_stats
 from routers import auth, customer, mechanic, admin, contact
-from utils import get_db, get_current_user
+from throttle import login_throttle
+from templating import templates, compile_templates
+from utils import get_current_user, Principal
 from fastapi.exceptions import HTTPException
 from fastapi.responses import FileResponse
 
-app = FastAPI()
-favicon_path = 'favicon.ico'
+# "0" when schema is upgraded before workers start (`python manage.py migrate`),
+# so several workers do not run migrations at the same time
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "1") == "1"
+
 
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs once per worker process around serving requests"""
+    if MIGRATE_ON_STARTUP:
+        migrations.upgrade(engine)
+    log_settings()
+    compile_templates()
+    broker.open()
+    inbox.start()
+    yield
+    # uvicorn gets here only after running requests finished, event streams
+    # end by themselves within EVENT_STREAM_SECONDS; run it with
+    # --timeout-graceful-shutdown to bound the wait for other slow requests
+    broker.close()
+    # buffered contact messages are written before connections are closed
+    await inbox.stop()
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
 
-templates = Jinja2Templates(directory="templates")
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+favicon_path = 'favicon.ico'
+
+app.mount("/static", static_files(), name="static")
 
 
 app.include_router(auth.router)
@@ -33,22 +62,60 @@ async def favicon():
     return FileResponse(favicon_path)
 
 
+def runtime_metrics() -> list:
+    """Password pool, contact inbox, login throttle and event stream state
+    of this worker, in the format of render_metrics"""
+    pool = password_pool_stats()
+    contact_stats = inbox.stats()
+    login_stats = login_throttle.stats()
+    return [
+        ("popcorn_password_queued", "gauge", "Password jobs waiting or running", [({}, pool["queued"])]),
+        ("popcorn_password_queue_limit", "gauge", "Password jobs accepted at once",
+         [({}, pool["queue_limit"])]),
+        ("popcorn_password_jobs_total", "counter", "Password hashes and verifications",
+         [({"result": "completed"}, pool["completed"]), ({"result": "rejected"}, pool["rejected"])]),
+        ("popcorn_password_seconds_total", "counter", "Time spent hashing passwords",
+         [({}, pool["seconds_total"])]),
+        ("popcorn_contact_buffered", "gauge", "Contact messages waiting to be written",
+         [({}, contact_stats["buffered"])]),
+        ("popcorn_contact_messages_total", "counter", "Contact messages by outcome",
+         [({"result": result}, contact_stats[result])
+          for result in ("accepted", "shed", "too_long", "rate_limited_ip", "rate_limited_email",
+                         "written")]),
+        ("popcorn_contact_write_errors_total", "counter", "Failed contact message batches",
+         [({}, contact_stats["write_errors"])]),
+        ("popcorn_login_attempts_total", "counter", "Failed and throttled login attempts",
+         [({"result": "failed"}, login_stats["failures"]),
+          ({"result": "throttled"}, login_stats["throttled"])]),
+        ("popcorn_login_lockouts_total", "counter", "Login lockouts",
+         [({"key": "user"}, login_stats["user_lockouts"]), ({"key": "ip"}, login_stats["ip_lockouts"])]),
+        ("popcorn_event_clients", "gauge", "Open event streams", [({}, len(broker.subscribers))]),
+        ("popcorn_event_clients_limit", "gauge", "Event streams accepted at once",
+         [({}, MAX_EVENT_CLIENTS)]),
+    ]
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Prometheus scrape endpoint. Values are per worker process, each
+    worker has to be scraped (or the numbers summed) separately."""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+    return PlainTextResponse(render_metrics(runtime_metrics()), media_type=CONTENT_TYPE)
+
+
 @app.get("/", response_class=HTMLResponse)
-async def home_page(request: Request, db: Session = Depends(get_db)):
+async def home_page(request: Request, user: Principal | None = Depends(get_current_user)):
     """Get request of the home page. If user is logged in it will redirect
     him to his starting page, so home screen is available only for
     not logged in users."""
 
-    user = get_current_user(request)
-
     if user:
-        user_model = db.query(models.User).filter(
-            models.User.username == user['username']).first()
-        if user_model.role == "customer":
+        if user.role == "customer":
             return RedirectResponse(url="/customer", status_code=status.HTTP_302_FOUND)
-        if user_model.role == "mechanic":
+        if user.role == "mechanic":
             return RedirectResponse(url="/mechanic", status_code=status.HTTP_302_FOUND)
-        if user_model.role == "admin":
+        if user.role == "admin":
             return RedirectResponse(url="/admin", status_code=status.HTTP_302_FOUND)
 
     return templates.TemplateResponse("home.html", {"request": request, "user": user})
@@ -0,0 +1,143 @@
+"""Maintenance commands, run from the project directory:
+
+    python manage.py migrate              brings database schema up to date
+    python manage.py compile-templates    fills template bytecode cache (deploy step)
+    python manage.py build-static         fingerprints, compresses and resizes static files
+    python manage.py import-parts FILE    imports parts from CSV / JSON lines (.jsonl)
+    python manage.py export-parts [FILE]  exports parts as CSV / JSON lines (stdout without FILE)
+    python manage.py reconcile-totals     checks Repair.money against line items and fixes drift
+                                          (--dry-run only reports, exit code 1 on drift)
+    python manage.py rebuild-analytics    recomputes admin dashboard statistics from all repairs
+    python manage.py set-role USERNAME --role ROLE
+                                          changes role of a user and logs him out everywhere
+"""
+import argparse
+import json
+import sys
+import migrations
+from database import engine, SessionLocal
+from templating import compile_templates, TEMPLATE_CACHE_DIRECTORY
+from assets import build_static, STATIC_BUILD_DIRECTORY
+from parts_io import import_parts, export_parts, FORMATS
+from repairs import reconcile_repair_totals
+from analytics import rebuild_analytics
+from sqlalchemy import select
+import models
+from utils import revoke_user_tokens
+
+
+def migrate(args):
+    migrations.upgrade(engine)
+    print("Database is up to date")
+
+
+def compile_all_templates(args):
+    count = compile_templates()
+    print(f"Compiled {count} templates into {TEMPLATE_CACHE_DIRECTORY}")
+
+
+def build_static_files(args):
+    manifest = build_static()
+    print(f"Built {len(manifest)} static files into {STATIC_BUILD_DIRECTORY}")
+
+
+def file_format(args) -> str:
+    if args.format:
+        return args.format
+    if args.file and args.file.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def import_parts_file(args):
+    if not args.file:
+        sys.exit("import-parts needs a FILE")
+    db = SessionLocal()
+    try:
+        with open(args.file, encoding="utf-8-sig", newline="") as file:
+            report = import_parts(db, file, file_format(args))
+    finally:
+        db.close()
+    print(json.dumps(report.as_dict(), indent=2, ensure_ascii=False))
+
+
+def export_parts_file(args):
+    db = SessionLocal()
+    output = open(args.file, "w", encoding="utf-8", newline="") if args.file else sys.stdout
+    try:
+        for chunk in export_parts(db, file_format(args)):
+            output.write(chunk)
+    finally:
+        db.close()
+        if args.file:
+            output.close()
+
+
+def reconcile_totals(args):
+    db = SessionLocal()
+    try:
+        drifted = reconcile_repair_totals(db, fix=not args.dry_run)
+        db.commit()
+    finally:
+        db.close()
+    for repair_id, stored, actual in drifted:
+        print(f"repair {repair_id}: stored {stored}, line items {actual}")
+    if args.dry_run:
+        print(f"{len(drifted)} repairs with drifted totals")
+        sys.exit(1 if drifted else 0)
+    print(f"Fixed totals of {len(drifted)} repairs")
+
+
+def rebuild_all_analytics(args):
+    db = SessionLocal()
+    try:
+        rebuild_analytics(db)
+        db.commit()
+    finally:
+        db.close()
+    print("Statistics rebuilt")
+
+
+def set_role(args):
+    if not args.file or not args.role:
+        sys.exit("set-role needs USERNAME and --role")
+    db = SessionLocal()
+    try:
+        user = db.scalar(select(models.User).where(models.User.username == args.file))
+        if user is None:
+            sys.exit(f"No user {args.file}")
+        user.role = args.role
+        # tokens carry the old role in their claims
+        revoke_user_tokens(db, user.id)
+        db.commit()
+    finally:
+        db.close()
+    print(f"{args.file} is now {args.role}, his sessions were ended")
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "compile-templates": compile_all_templates,
+    "build-static": build_static_files,
+    "import-parts": import_parts_file,
+    "export-parts": export_parts_file,
+    "reconcile-totals": reconcile_totals,
+    "rebuild-analytics": rebuild_all_analytics,
+    "set-role": set_role,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Popcorn works maintenance commands")
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("file", nargs="?",
+                        help="file of import-parts / export-parts, username of set-role")
+    parser.add_argument("--format", choices=FORMATS, help="file format, from extension by default")
+    parser.add_argument("--role", choices=["customer", "mechanic", "admin"], help="new role of set-role")
+    parser.add_argument("--dry-run", action="store_true", help="reconcile-totals only reports drift")
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Tuple
+
+# upper bounds of request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# when set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (name, type, help, samples), a sample is (labels, value) or, for histogram
+# series, (labels, value, name suffix)
+Family = Tuple[str, str, str, List[tuple]]
+
+
+class RequestStats:
+    """Database and template time of the request being served. One object
+    per request, shared with worker threads through the context variable."""
+    __slots__ = ("queries", "db_seconds", "template_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+class RouteMetrics:
+    __slots__ = ("buckets", "count", "seconds", "statuses", "queries", "db_seconds",
+                 "template_seconds")
+
+    def __init__(self):
+        # last bucket is +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.statuses: Dict[int, int] = {}
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class MetricsRegistry:
+    """Counters of this worker process. Updates take one lock for a few
+    additions, rendering copies everything under the same lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.template_renders = 0
+        self.template_seconds = 0.0
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float,
+                        stats: RequestStats):
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics()
+            metrics.buckets[bucket] += 1
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.queries += stats.queries
+            metrics.db_seconds += stats.db_seconds
+            metrics.template_seconds += stats.template_seconds
+
+    def observe_query(self, seconds: float):
+        with self.lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def observe_template(self, seconds: float):
+        with self.lock:
+            self.template_renders += 1
+            self.template_seconds += seconds
+
+    def families(self) -> List[Family]:
+        with self.lock:
+            routes = [(key, metrics.buckets.copy(), metrics.count, metrics.seconds,
+                       dict(metrics.statuses), metrics.queries, metrics.db_seconds,
+                       metrics.template_seconds)
+                      for key, metrics in sorted(self.routes.items())]
+            totals = (self.db_queries, self.db_seconds, self.template_renders, self.template_seconds)
+
+        requests, duration, queries, db_seconds, template_seconds = [], [], [], [], []
+        for (method, route), buckets, count, seconds, statuses, route_queries, route_db, route_templates in routes:
+            labels = {"method": method, "route": route}
+            for status, number in sorted(statuses.items()):
+                requests.append(({**labels, "status": str(status)}, number))
+            cumulative = 0
+            for bound, number in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += number
+                duration.append(({**labels, "le": str(bound)}, cumulative, "_bucket"))
+            duration.append((labels, seconds, "_sum"))
+            duration.append((labels, count, "_count"))
+            queries.append((labels, route_queries))
+            db_seconds.append((labels, route_db))
+            template_seconds.append((labels, route_templates))
+
+        return [
+            ("popcorn_http_requests_total", "counter", "Finished HTTP requests", requests),
+            ("popcorn_http_request_duration_seconds", "histogram",
+             "HTTP request latency, until the response is sent", duration),
+            ("popcorn_http_db_queries_total", "counter", "SQL statements run by requests", queries),
+            ("popcorn_http_db_seconds_total", "counter", "Time of SQL statements run by requests",
+             db_seconds),
+            ("popcorn_http_template_seconds_total", "counter", "Template render time of requests",
+             template_seconds),
+            ("popcorn_db_queries_total", "counter", "SQL statements, including background work",
+             [({}, totals[0])]),
+            ("popcorn_db_seconds_total", "counter", "Time of SQL statements, including background work",
+             [({}, totals[1])]),
+            ("popcorn_template_renders_total", "counter", "Rendered templates", [({}, totals[2])]),
+            ("popcorn_template_seconds_total", "counter", "Template render time", [({}, totals[3])]),
+        ]
+
+
+registry = MetricsRegistry()
+
+
+def query_finished(seconds: float):
+    """Called by the engine event hooks after every SQL statement"""
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+    registry.observe_query(seconds)
+
+
+def template_rendered(seconds: float):
+    stats = current_request.get()
+    if stats is not None:
+        stats.template_seconds += seconds
+    registry.observe_template(seconds)
+
+
+def route_label(scope: dict) -> str:
+    """Path template of the matched route, so /mechanic/repairs/1 and
+    /mechanic/repairs/2 are one series. Mounted apps are labelled with the
+    mount path, requests matching nothing with "unmatched"."""
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unmatched")
+    return scope.get("root_path") or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, from the first byte in to
+    the last byte of the response out. Cost per request is two clock reads,
+    a context variable and one locked update."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            registry.observe_request(scope["method"], route_label(scope), status_code, elapsed, stats)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: dict, value: float) -> str:
+    if labels:
+        pairs = ",".join(f'{key}="{escape_label(str(label))}"' for key, label in labels.items())
+        name = f"{name}{{{pairs}}}"
+    return f"{name} {value:.10g}" if isinstance(value, float) else f"{name} {value}"
+
+
+def render_metrics(extra: Iterable[Family] = ()) -> str:
+    """Prometheus text exposition of the request metrics and extra families
+    (gauges and counters collected by the caller)"""
+    lines = []
+    for name, kind, description, samples in [*registry.families(), *extra]:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample in samples:
+            labels, value, suffix = sample if len(sample) == 3 else (*sample, "")
+            lines.append(format_sample(name + suffix, labels, value))
+    return "\n".join(lines) + "\n"
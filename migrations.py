@@ -0,0 +1,169 @@
+from datetime import date, datetime
+from sqlalchemy import inspect, text, Table, Column, String, MetaData
+from sqlalchemy.orm import Session
+import models
+from search import create_part_search_index, uses_fts, PART_FTS_DDL
+from busy import rebuild_busy, rebuild_occupancy
+from repairs import reconcile_repair_totals
+from analytics import rebuild_analytics
+from versions import bump_versions, TRACKED_TABLES
+
+# bookkeeping of data migrations which already ran on this database
+migration_metadata = MetaData()
+schema_migration = Table(
+    "schema_migration", migration_metadata,
+    Column("name", String(100), primary_key=True),
+)
+
+DATE_FORMATS = ["%Y-%m-%d", "%d.%m.%Y", "%d-%m-%Y", "%Y/%m/%d", "%d/%m/%Y"]
+
+
+def parse_date(value) -> date | None:
+    """Parses date stored as text by older versions, None when not possible"""
+    if value is None or isinstance(value, date):
+        return value
+    value = str(value).strip()
+    # datetime strings like '2024-03-26 00:00:00' or '2024-03-26T10:00'
+    if len(value) > 10 and value[:4].isdigit() and value[4] == "-":
+        value = value[:10]
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def create_missing_indexes(bind):
+    """create_all creates indexes only together with new tables, so indexes
+    added to models later have to be created on existing tables here"""
+    inspector = inspect(bind)
+    for table in models.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=bind)
+
+
+def convert_repair_dates(connection):
+    """Repair dates used to be stored as strings straight from the form.
+    Rewrites them as ISO dates (empty or unreadable values become NULL) and
+    changes column type on backends with strict column types."""
+    rows = connection.execute(
+        text("SELECT id, start_date, end_date FROM repair")).all()
+    for repair_id, start_date, end_date in rows:
+        new_start, new_end = parse_date(start_date), parse_date(end_date)
+        if (new_start, new_end) != (start_date, end_date):
+            connection.execute(
+                text("UPDATE repair SET start_date = :start, end_date = :end WHERE id = :id"),
+                {"start": new_start.isoformat() if new_start else None,
+                 "end": new_end.isoformat() if new_end else None, "id": repair_id})
+
+    # SQLite keeps ISO text in any column, type affinity needs no change there
+    dialect = connection.dialect.name
+    for column_name in ("start_date", "end_date"):
+        if dialect == "mysql":
+            connection.execute(
+                text(f"ALTER TABLE repair MODIFY {column_name} DATE"))
+        elif dialect == "postgresql":
+            connection.execute(text(
+                f"ALTER TABLE repair ALTER COLUMN {column_name} TYPE DATE "
+                f"USING {column_name}::date"))
+
+
+def fill_busy_ranges(connection):
+    """Busy ranges are maintained on every repair change, existing repairs
+    have to be merged once"""
+    db = Session(bind=connection)
+    rebuild_busy(db)
+    db.flush()
+
+
+def create_entity_versions(connection):
+    """Counter rows exist before first change, so concurrent first changes
+    do not race to insert them"""
+    bump_versions(connection, TRACKED_TABLES)
+
+
+def fill_repair_totals(connection):
+    """Repair.money is maintained on every line item and price change,
+    existing repairs get their totals once"""
+    db = Session(bind=connection)
+    reconcile_repair_totals(db)
+    db.flush()
+
+
+def fill_analytics(connection):
+    """Statistics are maintained on every repair and line item change,
+    history has to be summed up once"""
+    db = Session(bind=connection)
+    rebuild_analytics(db)
+    db.flush()
+
+
+def fill_bay_occupancy(connection):
+    """Bay occupancy is maintained on every repair change, existing repairs
+    have to be counted once"""
+    db = Session(bind=connection)
+    rebuild_occupancy(db)
+    db.flush()
+
+
+def add_user_token_cutoff(connection):
+    """create_all does not add columns to existing tables"""
+    columns = {column["name"] for column in inspect(connection).get_columns("user")}
+    if "tokens_not_before" not in columns:
+        table = connection.dialect.identifier_preparer.quote("user")
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN tokens_not_before FLOAT"))
+
+
+def replace_part_fts_update_trigger(connection):
+    """The update trigger of the part search index used to fire on every
+    part update, stock changes included. CREATE TRIGGER IF NOT EXISTS keeps
+    an existing trigger, so it is dropped and created again here."""
+    if not uses_fts(connection):
+        return
+    connection.execute(text("DROP TRIGGER IF EXISTS part_fts_au"))
+    index = connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'part_fts'")).first()
+    # a new database gets the index with its triggers from create_part_search_index
+    if index is not None:
+        for statement in PART_FTS_DDL:
+            connection.execute(text(statement))
+
+
+
+# data migrations, each one runs once per database in this order
+MIGRATIONS = [
+    ("0001_repair_dates", convert_repair_dates),
+    ("0002_busy_ranges", fill_busy_ranges),
+    ("0003_entity_versions", create_entity_versions),
+    ("0004_repair_totals", fill_repair_totals),
+    ("0005_analytics", fill_analytics),
+    ("0006_bay_occupancy", fill_bay_occupancy),
+    ("0007_user_token_cutoff", add_user_token_cutoff),
+    ("0008_part_fts_update_trigger", replace_part_fts_update_trigger),
+]
+
+
+def run_data_migrations(bind):
+    migration_metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        applied = set(connection.execute(
+            schema_migration.select()).scalars().all())
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+        with bind.begin() as connection:
+            migration(connection)
+            connection.execute(schema_migration.insert().values(name=name))
+
+
+def upgrade(bind):
+    """Brings database schema up to date with models"""
+    models.Base.metadata.create_all(bind=bind)
+    run_data_migrations(bind)
+    create_missing_indexes(bind)
+    create_part_search_index(bind)
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Float
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Float, Date, DateTime, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -17,6 +17,9 @@ class User(Base):
     last_name = Column(String)
     hashed_password = Column(String)
     role = Column(String, default='customer')
+    # access tokens issued before this time (epoch seconds) are rejected,
+    # set when role or name changes so stale claims are not trusted
+    tokens_not_before = Column(Float)
 
 
 class Message(Base):
@@ -33,10 +36,10 @@ class Part(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
     amount_left = Column(Integer, default=1)
-    engine_type = Column(String)
+    engine_type = Column(String, index=True)
     price = Column(Float, default=0.00)
-    nr_oem = Column(String)
-    qr_code = Column(String)
+    nr_oem = Column(String, index=True)
+    qr_code = Column(String, index=True)
     repairs = relationship("PartsInRepair", back_populates="part")
 
 
@@ -45,12 +48,16 @@ class Repair(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     car_name = Column(String)
-    start_date = Column(String)
-    end_date = Column(String)
+    start_date = Column(Date)
+    end_date = Column(Date)
     active = Column(Boolean, default=False)
     customer_id = Column(Integer, ForeignKey("user.id"))
     money = Column(Float, default=0.00)
     parts = relationship("PartsInRepair", back_populates="repair")
+    customer = relationship("User")
+
+    # calendar windows are looked up by date range
+    __table_args__ = (Index("ix_repair_start_end", "start_date", "end_date"),)
 
 
 class PartsInRepair(Base):
@@ -61,3 +68,64 @@ class PartsInRepair(Base):
     quantity = Column(Integer)
     part = relationship("Part", back_populates="repairs")
     repair = relationship("Repair", back_populates="parts")
+
+
+class BusyRange(Base):
+    """Disjoint date ranges (end inclusive) in which at least one active repair
+    takes place. Overlapping and adjacent repairs are merged into one range."""
+    __tablename__ = "busy_range"
+
+    id = Column(Integer, primary_key=True, index=True)
+    start_date = Column(Date)
+    end_date = Column(Date)
+
+    __table_args__ = (Index("ix_busy_range_start_end", "start_date", "end_date"),)
+
+
+class BayOccupancy(Base):
+    """Active repairs taking place on a day, days without repairs have no row.
+    Kept up to date by busy.py together with busy ranges."""
+    __tablename__ = "bay_occupancy"
+
+    day = Column(Date, primary_key=True)
+    repairs = Column(Integer, default=0, nullable=False)
+
+
+class EntityVersion(Base):
+    """Change counter of one table, bumped in the transaction of every change
+    to its rows. Pages are validated (ETag / Last-Modified) against it."""
+    __tablename__ = "entity_version"
+
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime)
+
+
+class MonthlyRepairStats(Base):
+    """Repairs starting in a month ("YYYY-MM"). Kept up to date by analytics.py
+    on every repair and line item change, duration and revenue count only
+    confirmed (active) repairs."""
+    __tablename__ = "monthly_repair_stats"
+
+    month = Column(String(7), primary_key=True)
+    repairs = Column(Integer, default=0, nullable=False)
+    confirmed = Column(Integer, default=0, nullable=False)
+    duration_days = Column(Integer, default=0, nullable=False)
+    revenue = Column(Float, default=0.0, nullable=False)
+
+
+class PartUsageStats(Base):
+    """Pieces of a part used in all repairs, kept up to date by analytics.py"""
+    __tablename__ = "part_usage_stats"
+
+    part_id = Column(Integer, primary_key=True)
+    quantity = Column(Integer, default=0, nullable=False)
+
+
+class RevokedToken(Base):
+    """Access tokens rejected before they expire (logout), shared by all
+    workers. Rows are removed once the token would have expired anyway."""
+    __tablename__ = "revoked_token"
+
+    token_id = Column(String(64), primary_key=True)
+    expires_at = Column(Integer, nullable=False, index=True)
@@ -0,0 +1,98 @@
+import base64
+import json
+from typing import Any, List
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class Page:
+    """One page of keyset paginated rows with cursors of neighbouring pages"""
+
+    def __init__(self, items: List[Any], next_cursor: str | None, prev_cursor: str | None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(value, row_id: int) -> str:
+    """Encodes sort value and id of the boundary row into url safe token"""
+    raw = json.dumps([value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Decodes cursor created by encode_cursor, returns None when invalid"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def clamp_page_size(page_size: int) -> int:
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def after_boundary(sort_column, id_column, value, row_id: int, flip: bool):
+    """WHERE condition of rows following the boundary row. NULL sorts before
+    every value (NULLS FIRST ascending, last descending), as in SQLite and
+    MySQL, and can not be compared with < or =, so it is handled apart."""
+    if not flip:
+        if value is None:
+            return or_(and_(sort_column.is_(None), id_column > row_id), sort_column.is_not(None))
+        return or_(sort_column > value, and_(sort_column == value, id_column > row_id))
+    if value is None:
+        return and_(sort_column.is_(None), id_column < row_id)
+    return or_(sort_column < value, and_(sort_column == value, id_column < row_id),
+               sort_column.is_(None))
+
+
+def keyset_page(query, sort_column, id_column, descending: bool = False,
+                page_size: int = DEFAULT_PAGE_SIZE, after: str | None = None,
+                before: str | None = None) -> Page:
+    """Fetches one page of query ordered by (sort_column, id_column).
+
+    Instead of OFFSET the boundary row of the previous page (cursor) is used
+    in WHERE clause, so every page costs the same index range scan no matter
+    how deep into the listing it is."""
+    page_size = clamp_page_size(page_size)
+    sort_name = sort_column.key
+    boundary = decode_cursor(before or after or "")
+    backwards = before is not None and boundary is not None
+
+    # walking backwards means flipping the order and reversing fetched rows
+    flip = descending != backwards
+    if boundary is not None:
+        value, row_id = boundary
+        query = query.filter(after_boundary(sort_column, id_column, value, row_id, flip))
+
+    if flip:
+        order = sort_column.desc()
+        # PostgreSQL puts NULLs first in descending order by default
+        if query.session.get_bind().dialect.name == "postgresql":
+            order = order.nulls_last()
+        query = query.order_by(order, id_column.desc())
+    else:
+        order = sort_column.asc()
+        if query.session.get_bind().dialect.name == "postgresql":
+            order = order.nulls_first()
+        query = query.order_by(order, id_column.asc())
+
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = None
+    prev_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        if has_more or backwards:
+            next_cursor = encode_cursor(getattr(last, sort_name), last.id)
+        if boundary is not None and (has_more or not backwards):
+            prev_cursor = encode_cursor(getattr(first, sort_name), first.id)
+    return Page(rows, next_cursor, prev_cursor)
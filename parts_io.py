@@ -0,0 +1,251 @@
+import codecs
+import csv
+import io
+import json
+from typing import Dict, Iterable, Iterator, List, Tuple
+from sqlalchemy import select, insert, update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import models
+from versions import bump_versions
+from repairs import add_price_changes
+
+# rows written in one transaction
+IMPORT_BATCH_SIZE = 500
+# rows fetched from DB at once while exporting
+EXPORT_BATCH_SIZE = 1000
+# errors kept in the report, the rest is only counted
+MAX_REPORTED_ERRORS = 1000
+
+PART_FIELDS = ["name", "amount_left", "engine_type", "price", "nr_oem", "qr_code"]
+FORMATS = ("csv", "jsonl")
+
+# (line number, parsed row or None, error or None)
+ParsedRow = Tuple[int, Dict | None, str | None]
+
+
+class ImportReport:
+    """Outcome of an import, errors are (line number, message) pairs"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def add_error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self) -> dict:
+        return {"inserted": self.inserted, "updated": self.updated,
+                "error_count": self.error_count,
+                "errors": [{"line": line, "error": message} for line, message in self.errors]}
+
+
+class RowParser:
+    """Turns lines of CSV (with header) or JSON lines into raw rows. Lines are
+    fed one by one, so uploads are parsed while they are received."""
+
+    def __init__(self, file_format: str):
+        if file_format not in FORMATS:
+            raise ValueError(f"unknown format {file_format}, use one of {', '.join(FORMATS)}")
+        self.file_format = file_format
+        self.header = None
+        self.line_number = 0
+
+    def parse(self, line: str) -> ParsedRow | None:
+        self.line_number += 1
+        if not line.strip():
+            return None
+        if self.file_format == "jsonl":
+            try:
+                row = json.loads(line)
+            except ValueError as err:
+                return self.line_number, None, f"invalid JSON: {err}"
+            if not isinstance(row, dict):
+                return self.line_number, None, "JSON object expected"
+            return self.line_number, row, None
+
+        values = next(csv.reader([line]))
+        if self.header is None:
+            self.header = [value.strip() for value in values]
+            unknown = set(self.header) - set(PART_FIELDS)
+            if "name" not in self.header or unknown:
+                self.header = None
+                return self.line_number, None, (
+                    f"header has to contain name and only columns: {', '.join(PART_FIELDS)}")
+            return None
+        if len(values) != len(self.header):
+            return self.line_number, None, f"expected {len(self.header)} columns, got {len(values)}"
+        return self.line_number, dict(zip(self.header, values)), None
+
+
+class LineSplitter:
+    """Splits uploaded bytes into text lines as chunks arrive"""
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        self.pending = ""
+
+    def feed(self, chunk: bytes) -> List[str]:
+        self.pending += self.decoder.decode(chunk)
+        *lines, self.pending = self.pending.split("\n")
+        return [line.rstrip("\r") for line in lines]
+
+    def close(self) -> List[str]:
+        rest = (self.pending + self.decoder.decode(b"", final=True)).rstrip("\r")
+        self.pending = ""
+        return [rest] if rest else []
+
+
+def validate_row(row: dict) -> dict:
+    """Converts raw row into Part column values, raises ValueError"""
+    values = {}
+    name = str(row.get("name") or "").strip()
+    if not name:
+        raise ValueError("name is required")
+    values["name"] = name
+    for field in ("engine_type", "nr_oem", "qr_code"):
+        if field in row:
+            values[field] = str(row[field]).strip() if row[field] is not None else None
+    if row.get("amount_left") not in (None, ""):
+        try:
+            values["amount_left"] = int(str(row["amount_left"]).strip())
+        except ValueError:
+            raise ValueError(f"amount_left is not a whole number: {row['amount_left']}")
+        if values["amount_left"] < 0:
+            raise ValueError("amount_left can not be negative")
+    if row.get("price") not in (None, ""):
+        try:
+            values["price"] = float(str(row["price"]).replace(",", ".").strip())
+        except ValueError:
+            raise ValueError(f"price is not a number: {row['price']}")
+        if values["price"] < 0:
+            raise ValueError("price can not be negative")
+    return values
+
+
+def match_existing(db: Session, rows: List[Tuple[int, dict]]) -> Tuple[dict, dict, dict]:
+    """Existing parts matching batch rows: nr_oem -> ids, name -> id and
+    id -> price"""
+    oems = {values["nr_oem"] for _, values in rows if values.get("nr_oem")}
+    names = {values["name"] for _, values in rows}
+    by_oem, by_name, prices = {}, {}, {}
+    found = db.execute(select(models.Part.id, models.Part.name, models.Part.nr_oem,
+                              models.Part.price).where(
+        or_(models.Part.nr_oem.in_(oems), models.Part.name.in_(names)))).all()
+    for part_id, name, nr_oem, price in found:
+        if nr_oem in oems:
+            by_oem.setdefault(nr_oem, []).append(part_id)
+        by_name[name] = part_id
+        prices[part_id] = price or 0
+    return by_oem, by_name, prices
+
+
+def write_batch(db: Session, rows: List[Tuple[int, dict]], report: ImportReport):
+    """Upserts one batch of valid rows in one transaction: rows with known
+    nr_oem (or, without it, known name) update that part, others are inserted.
+    Inserts and updates are sent as executemany statements."""
+    by_oem, by_name, prices = match_existing(db, rows)
+    inserts, updates, errors = {}, {}, []
+    for line, values in rows:
+        oem_ids = by_oem.get(values.get("nr_oem"), [])
+        if len(oem_ids) > 1:
+            errors.append((line, f"nr_oem {values['nr_oem']} is used by {len(oem_ids)} parts"))
+            continue
+        part_id = oem_ids[0] if oem_ids else by_name.get(values["name"])
+        # later line of the same part wins
+        if part_id is None:
+            inserts[values.get("nr_oem") or values["name"]] = (line, values)
+        else:
+            updates[part_id] = (line, dict(values, id=part_id))
+
+    if inserts:
+        db.execute(insert(models.Part), [values for _, values in inserts.values()])
+    if updates:
+        # bulk UPDATE by primary key, rows are grouped by their set of columns
+        by_columns = {}
+        for _, values in updates.values():
+            by_columns.setdefault(tuple(sorted(values)), []).append(values)
+        for group in by_columns.values():
+            db.execute(update(models.Part), group)
+        # totals of repairs using repriced parts
+        add_price_changes(db, {part_id: values["price"] - prices[part_id]
+                               for _, values in updates.values() if "price" in values})
+    bump_versions(db.connection(), ["part"])
+    db.commit()
+    report.inserted += len(inserts)
+    report.updated += len(updates)
+    for line, message in errors:
+        report.add_error(line, message)
+
+
+def import_batch(db: Session, parsed_rows: List[ParsedRow], report: ImportReport):
+    """Validates and writes one batch. When the batch breaks a constraint
+    (e.g. a name used by another part) rows are retried one by one, so only
+    the offending rows are reported."""
+    valid = []
+    for line, row, error in parsed_rows:
+        if error is None:
+            try:
+                valid.append((line, validate_row(row)))
+            except ValueError as err:
+                error = str(err)
+        if error is not None:
+            report.add_error(line, error)
+    if not valid:
+        return
+    try:
+        write_batch(db, valid, report)
+    except IntegrityError:
+        db.rollback()
+        for line, values in valid:
+            try:
+                write_batch(db, [(line, values)], report)
+            except IntegrityError as err:
+                db.rollback()
+                report.add_error(line, f"conflicts with existing part: {err.orig}")
+
+
+def import_parts(db: Session, lines: Iterable[str], file_format: str,
+                 batch_size: int = IMPORT_BATCH_SIZE) -> ImportReport:
+    """Imports parts from lines of CSV / JSON lines, batch by batch"""
+    parser = RowParser(file_format)
+    report = ImportReport()
+    batch = []
+    for line in lines:
+        parsed = parser.parse(line.rstrip("\r\n"))
+        if parsed is not None:
+            batch.append(parsed)
+        if len(batch) >= batch_size:
+            import_batch(db, batch, report)
+            batch = []
+    if batch:
+        import_batch(db, batch, report)
+    return report
+
+
+def export_parts(db: Session, file_format: str) -> Iterator[str]:
+    """Yields all parts as CSV (with header) or JSON lines. Rows are fetched
+    EXPORT_BATCH_SIZE at a time, so memory does not grow with the catalogue."""
+    if file_format not in FORMATS:
+        raise ValueError(f"unknown format {file_format}, use one of {', '.join(FORMATS)}")
+    columns = [getattr(models.Part, field) for field in PART_FIELDS]
+    result = db.execute(select(*columns).order_by(models.Part.id).execution_options(
+        yield_per=EXPORT_BATCH_SIZE))
+    if file_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(PART_FIELDS)
+        for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for partition in result.partitions():
+            yield "".join(json.dumps(dict(zip(PART_FIELDS, row)), ensure_ascii=False) + "\n"
+                          for row in partition)
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+
+# bcrypt cost factor, every +1 doubles the time of hashing and verification
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
+# bcrypt releases the GIL, so threads hash in parallel on separate cores
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", min(4, os.cpu_count() or 1)))
+
+# hashes waiting or running at once, above that requests are told to retry
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", PASSWORD_WORKERS * 8))
+
+# seconds client is asked to wait before retrying when the pool is full
+PASSWORD_RETRY_AFTER = 2
+
+# answer delay of a login with unknown username before the pool timed any job
+REJECT_DEFAULT_SECONDS = 0.25
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                               thread_name_prefix="password")
+_lock = threading.Lock()
+_stats = {"queued": 0, "max_queued": 0, "completed": 0, "rejected": 0,
+          "seconds_total": 0.0, "seconds_max": 0.0}
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed"""
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            _stats["queued"] -= 1
+            _stats["completed"] += 1
+            _stats["seconds_total"] += elapsed
+            _stats["seconds_max"] = max(_stats["seconds_max"], elapsed)
+
+
+async def _submit(fn, *args):
+    with _lock:
+        if _stats["queued"] >= PASSWORD_QUEUE_LIMIT:
+            _stats["rejected"] += 1
+            raise PasswordPoolBusy()
+        _stats["queued"] += 1
+        _stats["max_queued"] = max(_stats["max_queued"], _stats["queued"])
+    return await asyncio.get_running_loop().run_in_executor(_executor, _timed, fn, *args)
+
+
+async def hash_password(password: str) -> str:
+    """Hashes password in the password pool, raises PasswordPoolBusy when full"""
+    return await _submit(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    """Verifies password in the password pool, raises PasswordPoolBusy when full"""
+    return await _submit(pwd_context.verify, password, hashed_password)
+
+
+async def reject_password(password: str) -> bool:
+    """Waits about as long as a password verification takes, without using
+    the password pool, so a login of an unknown username answers in similar
+    time as a wrong password of a known one. Always False.
+
+    The delay is the mean time of pool jobs, not queue wait and real work of
+    this attempt, so careful timing under varying load can still tell which
+    usernames exist. That is accepted: verifying a dummy hash let credential
+    stuffing with random usernames use up the pool real logins need."""
+    with _lock:
+        completed, seconds = _stats["completed"], _stats["seconds_total"]
+    await asyncio.sleep(seconds / completed if completed else REJECT_DEFAULT_SECONDS)
+    return False
+
+
+def password_pool_stats() -> dict:
+    """Snapshot of pool counters: current and highest queue depth, finished
+    and rejected jobs, total and slowest hashing time in seconds"""
+    with _lock:
+        stats = dict(_stats)
+    stats["workers"] = PASSWORD_WORKERS
+    stats["queue_limit"] = PASSWORD_QUEUE_LIMIT
+    stats["rounds"] = BCRYPT_ROUNDS
+    return stats
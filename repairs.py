@@ -0,0 +1,304 @@
+from datetime import date
+from typing import Dict, List, NamedTuple, Tuple
+from sqlalchemy import func, select, update, insert, delete, bindparam
+from sqlalchemy.orm import Session, joinedload
+import models
+from versions import bump_versions
+from analytics import add_repair_revenue, add_price_revenue, add_part_usage
+
+# attempts of a line item change when another request changed it meanwhile
+LINE_ITEM_ATTEMPTS = 3
+# operations accepted in one batch of line item changes
+MAX_LINE_ITEM_OPERATIONS = 200
+# difference of Repair.money and the sum of its lines treated as drift
+MONEY_TOLERANCE = 0.005
+
+
+class LineItem(NamedTuple):
+    """Part used in a repair with its quantity and price of the whole line"""
+    part: models.Part
+    quantity: int
+    line_total: float
+
+
+class RepairDetail:
+    """Repair together with its customer, line items and total price"""
+
+    def __init__(self, repair: models.Repair, line_items: List[LineItem], total_price: float):
+        self.repair = repair
+        self.customer = repair.customer
+        self.line_items = line_items
+        self.total_price = total_price
+
+
+def overlapping(query, start: date, end: date):
+    """Filters repairs query to repairs overlapping [start, end) window.
+    Range condition on start_date is served by ix_repair_start_end index."""
+    return query.filter(models.Repair.start_date < end,
+                        models.Repair.end_date >= start)
+
+
+def load_repair_detail(db: Session, repair_id: int) -> RepairDetail | None:
+    """Loads repair with customer in one query and its line items with line
+    and total prices computed in SQL in second one. Only line items of this
+    repair are read, no matter how often the parts were used elsewhere."""
+    repair = db.query(models.Repair).options(joinedload(models.Repair.customer)).filter(
+        models.Repair.id == repair_id).first()
+    if repair is None:
+        return None
+
+    line_total = models.PartsInRepair.quantity * models.Part.price
+    rows = db.query(models.Part, models.PartsInRepair.quantity,
+                    line_total.label("line_total"),
+                    func.sum(line_total).over().label("total_price")).join(
+        models.PartsInRepair, models.Part.id == models.PartsInRepair.part_id).filter(
+        models.PartsInRepair.repair_id == repair_id).order_by(models.Part.name).all()
+
+    line_items = [LineItem(part, quantity, line_total or 0)
+                  for part, quantity, line_total, _ in rows]
+    total_price = (rows[0].total_price or 0) if rows else 0
+    return RepairDetail(repair, line_items, total_price)
+
+
+class LineItemError(ValueError):
+    """Line item change that can not be applied, message is shown to the user"""
+
+
+class InsufficientStock(LineItemError):
+    """Not enough pieces of a part left in storage"""
+
+    def __init__(self, part_id: int, requested: int, available: int):
+        self.part_id = part_id
+        self.requested = requested
+        self.available = available
+        super().__init__(f"Brak części na magazynie (id {part_id}): "
+                         f"potrzeba {requested}, dostępne {available}")
+
+
+def take_stock(db: Session, part_id: int, quantity: int):
+    """Takes quantity pieces of part from storage (gives them back when
+    negative) with one conditional UPDATE, so two requests can not both take
+    the last pieces. Raises InsufficientStock, the caller rolls back."""
+    part = models.Part.__table__
+    if quantity == 0:
+        return
+    statement = update(part).where(part.c.id == part_id).values(
+        amount_left=func.coalesce(part.c.amount_left, 0) - quantity)
+    if quantity > 0:
+        statement = statement.where(func.coalesce(part.c.amount_left, 0) >= quantity)
+    if db.execute(statement).rowcount == 1:
+        return
+    available = db.execute(select(part.c.amount_left).where(part.c.id == part_id)).first()
+    if available is None:
+        raise LineItemError(f"Nie ma części o id {part_id}")
+    raise InsufficientStock(part_id, quantity, available[0] or 0)
+
+
+def line_item_quantity(db: Session, repair_id: int, part_id: int) -> int | None:
+    """Quantity of a used part, None when the part is not used in repair"""
+    line = models.PartsInRepair.__table__
+    return db.execute(select(func.coalesce(line.c.quantity, 0)).with_for_update().where(
+        line.c.repair_id == repair_id, line.c.part_id == part_id)).scalar()
+
+
+def changed_stock(db: Session):
+    bump_versions(db.connection(), ["part", "parts_in_repair", "repair"])
+
+
+def add_to_repair_total(db: Session, repair_id: int, quantities: Dict[int, int]):
+    """Adds part_id -> quantity pieces (negative when removed) at current part
+    prices to Repair.money, statistics of revenue and part usage follow"""
+    repair = models.Repair.__table__
+    part = models.Part.__table__
+    quantities = {part_id: quantity for part_id, quantity in quantities.items() if quantity}
+    if not quantities:
+        return
+    prices = dict(db.execute(select(part.c.id, func.coalesce(part.c.price, 0)).where(
+        part.c.id.in_(quantities))).all())
+    change = sum(quantity * prices.get(part_id, 0) for part_id, quantity in quantities.items())
+    updated = db.execute(update(repair).where(repair.c.id == repair_id).values(
+        money=func.coalesce(repair.c.money, 0) + change)).rowcount
+    if not updated:
+        raise LineItemError(f"Nie ma naprawy o id {repair_id}")
+    add_repair_revenue(db, repair_id, change)
+    add_part_usage(db, quantities)
+
+
+def add_price_changes(db: Session, price_changes: Dict[int, float]):
+    """Moves Repair.money of every repair using a part by part_id -> price
+    difference times used quantity. Called in the transaction changing prices."""
+    repair = models.Repair.__table__
+    line = models.PartsInRepair.__table__
+    price_changes = {part_id: change for part_id, change in price_changes.items() if change}
+    if not price_changes:
+        return
+    used = select(func.coalesce(func.sum(line.c.quantity), 0)).where(
+        line.c.repair_id == repair.c.id, line.c.part_id == bindparam("b_part_id")).scalar_subquery()
+    db.execute(update(repair).where(repair.c.id.in_(
+        select(line.c.repair_id).where(line.c.part_id == bindparam("b_part_id")))).values(
+        money=func.coalesce(repair.c.money, 0) + bindparam("b_change") * used),
+        [{"b_part_id": part_id, "b_change": change} for part_id, change in price_changes.items()])
+    add_price_revenue(db, price_changes)
+    bump_versions(db.connection(), ["repair"])
+
+
+def reconcile_repair_totals(db: Session, fix: bool = True) -> List[Tuple[int, float | None, float]]:
+    """Compares Repair.money with the sum of its lines, returns drifted
+    (repair_id, stored, actual) and writes actual values when fix is set.
+    Does not commit."""
+    repair = models.Repair.__table__
+    line = models.PartsInRepair.__table__
+    part = models.Part.__table__
+    actual = func.coalesce(func.sum(line.c.quantity * part.c.price), 0)
+    rows = db.execute(select(repair.c.id, repair.c.money, actual).select_from(
+        repair.outerjoin(line, line.c.repair_id == repair.c.id).outerjoin(
+            part, part.c.id == line.c.part_id)).group_by(repair.c.id, repair.c.money)).all()
+    drifted = [(repair_id, money, total) for repair_id, money, total in rows
+               if money is None or abs(money - total) > MONEY_TOLERANCE]
+    if fix and drifted:
+        db.execute(update(repair).where(repair.c.id == bindparam("b_id")).values(
+            money=bindparam("b_money")),
+            [{"b_id": repair_id, "b_money": total} for repair_id, _, total in drifted])
+        for repair_id, money, total in drifted:
+            add_repair_revenue(db, repair_id, total - (money or 0))
+        bump_versions(db.connection(), ["repair"])
+    return drifted
+
+
+def add_line_item(db: Session, repair_id: int, part_id: int, quantity: int) -> int:
+    """Adds quantity pieces of part to repair (to its line when the part is
+    already used) and takes them from storage, Repair.money follows. Returns
+    the new quantity of the line. Does not commit."""
+    if quantity < 1:
+        raise LineItemError("Ilość musi być większa od zera")
+    line = models.PartsInRepair.__table__
+    # line is locked by the write before stock changes, concurrent additions
+    # to the same line are serialised
+    added = db.execute(update(line).where(
+        line.c.repair_id == repair_id, line.c.part_id == part_id).values(
+        quantity=func.coalesce(line.c.quantity, 0) + quantity)).rowcount
+    if not added:
+        db.execute(insert(line).values(repair_id=repair_id, part_id=part_id, quantity=quantity))
+    take_stock(db, part_id, quantity)
+    add_to_repair_total(db, repair_id, {part_id: quantity})
+    changed_stock(db)
+    return line_item_quantity(db, repair_id, part_id)
+
+
+def set_line_item_quantity(db: Session, repair_id: int, part_id: int, quantity: int) -> int:
+    """Sets quantity of a used part, storage is changed by the difference.
+    Quantity 0 removes the line. Does not commit."""
+    if quantity < 0:
+        raise LineItemError("Ilość nie może być ujemna")
+    if quantity == 0:
+        remove_line_item(db, repair_id, part_id)
+        return 0
+    line = models.PartsInRepair.__table__
+    for _ in range(LINE_ITEM_ATTEMPTS):
+        old_quantity = line_item_quantity(db, repair_id, part_id)
+        if old_quantity is None:
+            raise LineItemError(f"Część o id {part_id} nie jest użyta w naprawie")
+        # compare and set, changed line (e.g. by another request between the
+        # read and this write) is read again
+        changed = db.execute(update(line).where(
+            line.c.repair_id == repair_id, line.c.part_id == part_id,
+            func.coalesce(line.c.quantity, 0) == old_quantity).values(quantity=quantity)).rowcount
+        if changed:
+            take_stock(db, part_id, quantity - old_quantity)
+            add_to_repair_total(db, repair_id, {part_id: quantity - old_quantity})
+            changed_stock(db)
+            return quantity
+    raise LineItemError("Pozycja została w międzyczasie zmieniona, spróbuj ponownie")
+
+
+def remove_line_item(db: Session, repair_id: int, part_id: int) -> int:
+    """Removes part from repair and returns its pieces to storage. Returns
+    removed quantity, 0 when the part was not used. Does not commit."""
+    line = models.PartsInRepair.__table__
+    for _ in range(LINE_ITEM_ATTEMPTS):
+        old_quantity = line_item_quantity(db, repair_id, part_id)
+        if old_quantity is None:
+            return 0
+        removed = db.execute(delete(line).where(
+            line.c.repair_id == repair_id, line.c.part_id == part_id,
+            func.coalesce(line.c.quantity, 0) == old_quantity)).rowcount
+        if removed:
+            take_stock(db, part_id, -old_quantity)
+            add_to_repair_total(db, repair_id, {part_id: -old_quantity})
+            changed_stock(db)
+            return old_quantity
+    raise LineItemError("Pozycja została w międzyczasie zmieniona, spróbuj ponownie")
+
+
+def apply_line_item_operations(db: Session, repair_id: int,
+                               operations: List[Tuple[str, int, int | None]]) -> Dict[int, int]:
+    """Applies ("add" | "set" | "remove", part_id, quantity) operations in
+    given order with a few bulk statements, stock included. Returns part_id ->
+    stock taken (negative when returned). Does not commit, nothing is written
+    when any operation is rejected as the caller rolls back."""
+    if len(operations) > MAX_LINE_ITEM_OPERATIONS:
+        raise LineItemError(f"Za dużo operacji, maksymalnie {MAX_LINE_ITEM_OPERATIONS}")
+    if not operations:
+        return {}
+    line = models.PartsInRepair.__table__
+    part = models.Part.__table__
+    # counters are bumped first: it takes the write lock (SQLite) or locks the
+    # counter rows, so no other stock change touches these lines until commit
+    changed_stock(db)
+
+    part_ids = {part_id for _, part_id, _ in operations}
+    current = dict(db.execute(select(line.c.part_id, func.coalesce(line.c.quantity, 0)).where(
+        line.c.repair_id == repair_id, line.c.part_id.in_(part_ids))).all())
+    final = dict(current)
+    for kind, part_id, quantity in operations:
+        if kind == "add":
+            if quantity is None or quantity < 1:
+                raise LineItemError("Ilość musi być większa od zera")
+            final[part_id] = final.get(part_id, 0) + quantity
+        elif kind == "set":
+            if quantity is None or quantity < 0:
+                raise LineItemError("Ilość nie może być ujemna")
+            if not final.get(part_id):
+                raise LineItemError(f"Część o id {part_id} nie jest użyta w naprawie")
+            final[part_id] = quantity
+        elif kind == "remove":
+            final[part_id] = 0
+        else:
+            raise LineItemError(f"Nieznana operacja {kind}")
+
+    taken = {part_id: quantity - current.get(part_id, 0) for part_id, quantity in final.items()
+             if quantity != current.get(part_id, 0)}
+    needed = {part_id: quantity for part_id, quantity in taken.items() if quantity > 0}
+    if needed:
+        available = dict(db.execute(select(part.c.id, func.coalesce(part.c.amount_left, 0)).where(
+            part.c.id.in_(needed))).all())
+        for part_id, quantity in sorted(needed.items()):
+            if part_id not in available:
+                raise LineItemError(f"Nie ma części o id {part_id}")
+            if available[part_id] < quantity:
+                raise InsufficientStock(part_id, quantity, available[part_id])
+
+    removed = [part_id for part_id in taken if final[part_id] == 0 and part_id in current]
+    changed = [{"b_part_id": part_id, "b_quantity": final[part_id]} for part_id in taken
+               if final[part_id] and part_id in current]
+    added = [{"repair_id": repair_id, "part_id": part_id, "quantity": final[part_id]}
+             for part_id in taken if final[part_id] and part_id not in current]
+    if removed:
+        db.execute(delete(line).where(line.c.repair_id == repair_id, line.c.part_id.in_(removed)))
+    if changed:
+        db.execute(update(line).where(line.c.repair_id == repair_id,
+                                      line.c.part_id == bindparam("b_part_id")).values(
+            quantity=bindparam("b_quantity")), changed)
+    if added:
+        db.execute(insert(line), added)
+    if taken:
+        # still conditional, stock checked above can not go below zero here
+        amount_left = func.coalesce(part.c.amount_left, 0)
+        result = db.execute(update(part).where(
+            part.c.id == bindparam("b_part_id"), amount_left >= bindparam("b_quantity")).values(
+            amount_left=amount_left - bindparam("b_quantity")),
+            [{"b_part_id": part_id, "b_quantity": quantity} for part_id, quantity in taken.items()])
+        if db.get_bind().dialect.supports_sane_multi_rowcount and result.rowcount != len(taken):
+            raise LineItemError("Stan magazynu zmienił się w międzyczasie, spróbuj ponownie")
+    add_to_repair_total(db, repair_id, taken)
+    return taken
@@ -1,14 +1,13 @@
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from fastapi.templating import Jinja2Templates
-from fastapi import Depends, APIRouter, Request
+from fastapi.responses import HTMLResponse, JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, APIRouter, Request, status
 import models
-from database import engine
-from utils import get_db, check_user_role_and_redirect, get_current_user
-
-templates = Jinja2Templates(directory="templates")
-
-models.Base.metadata.create_all(bind=engine)
+from templating import templates
+from utils import get_db, check_user_role_and_redirect, get_current_user, Principal
+from passwords import password_pool_stats
+from analytics import load_analytics
+from inbox import inbox
+from throttle import login_throttle
 
 router = APIRouter(
     prefix="/admin",
@@ -18,14 +17,52 @@ router = APIRouter(
 
 
 @router.get("/", response_class=HTMLResponse)
-async def home_page(request: Request, db: Session = Depends(get_db)):
+async def home_page(request: Request, user: Principal | None = Depends(get_current_user),
+                    db: AsyncSession = Depends(get_db)):
     """Get request for starting admin page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'admin')
+    redirection = check_user_role_and_redirect(user, 'admin')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user = get_current_user(request)
+    analytics = await db.run_sync(load_analytics)
+    return templates.TemplateResponse("admin.html", {"request": request, "user": user,
+                                                     "analytics": analytics})
+
+
+@router.get("/stats/passwords")
+async def password_stats(user: Principal | None = Depends(get_current_user)):
+    """Queue depth and hashing time of the password pool"""
+
+    if user is None or user.role != "admin":
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+    return password_pool_stats()
+
+
+@router.get("/stats/login")
+async def login_stats(user: Principal | None = Depends(get_current_user)):
+    """Failed, throttled and locked out logins"""
+
+    if user is None or user.role != "admin":
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+    return login_throttle.stats()
+
+
+@router.get("/stats/contact")
+async def contact_stats(user: Principal | None = Depends(get_current_user)):
+    """Buffered, written, rate limited and shed contact messages"""
+
+    if user is None or user.role != "admin":
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+    return inbox.stats()
+
+
+@router.get("/stats/summary")
+async def summary_stats(user: Principal | None = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
+    """Revenue, repairs and part usage read from the statistics tables"""
 
-    return templates.TemplateResponse("admin.html", {"request": request, "user": user})
+    if user is None or user.role != "admin":
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+    return await db.run_sync(load_analytics)
@@ -1,99 +1,150 @@
+import time
+import uuid
 from starlette.responses import RedirectResponse
 from fastapi.responses import HTMLResponse
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
-from fastapi.templating import Jinja2Templates
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, HTTPException, status, APIRouter, Request, Response, Form
 from fastapi.security import OAuth2PasswordRequestForm
 import models
-from database import engine
-from utils import get_db, SECRET_KEY, ALGORITHM, get_current_user
+from templating import templates
+from utils import get_db, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_SECONDS, get_current_user, revoke_token, \
+    Principal
+from passwords import hash_password, verify_password, reject_password, PasswordPoolBusy, PASSWORD_RETRY_AFTER
+from throttle import login_throttle, LoginThrottled
 from jose import jwt
-from passlib.context import CryptContext
-
-templates = Jinja2Templates(directory="templates")
-
-models.Base.metadata.create_all(bind=engine)
 
 router = APIRouter(
     tags=["auth"],
     responses={401: {"user": "Not authorized"}}
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
-def authenticate_user(username: str, password: str, db):
-    """Checks if user provided right password."""
-    user = db.query(models.User).filter(
-        models.User.username == username).first()
-
-    if not user:
-        return False
-    if not pwd_context.verify(password, user.hashed_password):
-        return False
-    return user
+async def authenticate_user(username: str, password: str, db: AsyncSession, ip: str = ""):
+    """Checks if user provided right password. Password is verified in the
+    password pool, PasswordPoolBusy is raised when the pool is full.
+    LoginThrottled is raised, before the user is looked up, when the username
+    or IP has too many failed attempts (in progress ones included)."""
+    login_throttle.check(username, ip)
 
+    settled = False
+    try:
+        user = await db.scalar(select(models.User).where(
+            models.User.username == username))
+
+        if not user:
+            valid = await reject_password(password)
+        else:
+            valid = await verify_password(password, user.hashed_password)
+        settled = True
+        if not valid:
+            login_throttle.failure(username, ip)
+            return False
+        login_throttle.success(username, ip)
+        return user
+    finally:
+        # reservation of an attempt which was not verified
+        if not settled:
+            login_throttle.release(username, ip)
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else ""
+
+
+def password_pool_busy(request: Request, template: str):
+    """Fast answer when password pool is full, page asks user to try again"""
+    msg = "Server is busy, please try again in a moment"
+    return templates.TemplateResponse(
+        template, {"request": request, "msg": msg},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(PASSWORD_RETRY_AFTER)})
+
+
+def login_throttled(request: Request, err: LoginThrottled):
+    """Answer to a locked out username or IP, nothing was looked up or hashed"""
+    msg = f"Too many failed login attempts, please try again in {err.retry_after} seconds"
+    return templates.TemplateResponse(
+        "login.html", {"request": request, "msg": msg},
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(err.retry_after)})
+
+
+def create_access_token(user: models.User):
+    """Creates signed, expiring access token. Role and display fields are
+    carried in claims, so requests need no DB query to check them."""
+
+    # fractional iat (allowed by RFC 7519), so a token issued right after
+    # revoke_user_tokens is not taken for an older one
+    issued_at = time.time()
+    encode = {"sub": user.username, "id": user.id, "role": user.role,
+              "first_name": user.first_name, "last_name": user.last_name,
+              "iat": issued_at, "exp": int(issued_at) + ACCESS_TOKEN_EXPIRE_SECONDS,
+              "jti": uuid.uuid4().hex}
+    return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def create_access_token(username: str, user_id: int):
-    """Creates access token based on provided user data."""
 
-    encode = {"sub": username, "id": user_id}
-    return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
+def set_access_cookie(response: Response, user: models.User):
+    response.set_cookie(key="access_token", value=create_access_token(user),
+                        httponly=True, max_age=ACCESS_TOKEN_EXPIRE_SECONDS)
 
 
 @router.post("/token")
-async def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm = Depends(),
-                                 db: Session = Depends(get_db)):
+async def login_for_access_token(request: Request, response: Response,
+                                 form_data: OAuth2PasswordRequestForm = Depends(),
+                                 db: AsyncSession = Depends(get_db)):
     """Post request for token fetching."""
-    user = authenticate_user(form_data['username'], form_data['password'], db)
+    try:
+        user = await authenticate_user(form_data.username, form_data.password, db, client_ip(request))
+    except LoginThrottled as err:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many failed login attempts",
+                            headers={"Retry-After": str(err.retry_after)})
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server is busy, retry later",
+                            headers={"Retry-After": str(PASSWORD_RETRY_AFTER)})
     if not user:
         return False
-    token = create_access_token(user.username,
-                                user.id)
-    response.set_cookie(key="access_token", value=token,
-                        httponly=True)
+    set_access_cookie(response, user)
 
     return True
 
 
 @router.get("/login", response_class=HTMLResponse)
-async def login_page(request: Request):
+async def login_page(request: Request, user: Principal | None = Depends(get_current_user)):
     """Get request for login page endpoint."""
 
-    user = get_current_user(request)
     if user != None:
         return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
     return templates.TemplateResponse("login.html", {"request": request})
 
 
 @router.post("/login", response_class=HTMLResponse)
-async def login_user(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+async def login_user(request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
     """Post request for login user."""
     try:
 
-        form_data = {"request": request,
-                     "username": username, "password": password}
-
-        user_model = db.query(models.User).filter(
-            models.User.username == username).first()
-        validate_user_cookie = False
-        if user_model:
-            if user_model.role == 'mechanic':
-                response = RedirectResponse(
-                    url="/mechanic", status_code=status.HTTP_302_FOUND)
-            if user_model.role == 'customer':
-                response = RedirectResponse(
-                    url="/customer", status_code=status.HTTP_302_FOUND)
-            if user_model.role == 'admin':
-                response = RedirectResponse(
-                    url="/admin", status_code=status.HTTP_302_FOUND)
-
-            validate_user_cookie = await login_for_access_token(response=response, form_data=form_data, db=db)
-
-        if not validate_user_cookie:
+        try:
+            user_model = await authenticate_user(username, password, db, client_ip(request))
+        except LoginThrottled as err:
+            return login_throttled(request, err)
+        except PasswordPoolBusy:
+            return password_pool_busy(request, "login.html")
+        if not user_model:
             msg = "Incorrect Username or Password"
-            return templates.TemplateResponse("login.html", {"request": request, "msg": msg, "user": user_model})
+            return templates.TemplateResponse("login.html", {"request": request, "msg": msg})
+
+        if user_model.role == 'mechanic':
+            response = RedirectResponse(
+                url="/mechanic", status_code=status.HTTP_302_FOUND)
+        elif user_model.role == 'admin':
+            response = RedirectResponse(
+                url="/admin", status_code=status.HTTP_302_FOUND)
+        else:
+            response = RedirectResponse(
+                url="/customer", status_code=status.HTTP_302_FOUND)
+        set_access_cookie(response, user_model)
         return response
     except HTTPException:
         msg = "Unknown Error"
@@ -101,10 +152,9 @@ async def login_user(request: Request, username: str = Form(...), password: str
 
 
 @router.get("/register", response_class=HTMLResponse)
-async def login_page(request: Request):
+async def login_page(request: Request, user: Principal | None = Depends(get_current_user)):
     """Get request for register page endpoint."""
 
-    user = get_current_user(request)
     if user != None:
         return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
     return templates.TemplateResponse("register.html", {"request": request})
@@ -114,16 +164,16 @@ async def login_page(request: Request):
 async def register_user(request: Request, email: str = Form(...), username: str = Form(...),
                         firstname: str = Form(...), lastname: str = Form(...),
                         password: str = Form(...), password2: str = Form(...),
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     """Post request for register user."""
 
     # checks if username in DB
-    validation1 = db.query(models.User).filter(
-        models.User.username == username).first()
+    validation1 = await db.scalar(select(models.User).where(
+        models.User.username == username))
 
     # checks if email in DB
-    validation2 = db.query(models.User).filter(
-        models.User.email == email).first()
+    validation2 = await db.scalar(select(models.User).where(
+        models.User.email == email))
 
     if password != password2:
         msg = "Verify password must be the same"
@@ -139,18 +189,26 @@ async def register_user(request: Request, email: str = Form(...), username: str
     user_model.last_name = lastname
 
     # Encrypt the password
-    user_model.hashed_password = pwd_context.hash(password)
+    try:
+        user_model.hashed_password = await hash_password(password)
+    except PasswordPoolBusy:
+        return password_pool_busy(request, "register.html")
 
     db.add(user_model)
-    db.commit()
+    await db.commit()
 
     msg = "User successfully created"
     return templates.TemplateResponse("login.html", {"request": request, "msg": msg})
 
 
 @router.get("/logout")
-async def logout(request: Request):
-    """Get request for logout user endpoint and clear cookie with login session"""
+async def logout(request: Request, user: Principal | None = Depends(get_current_user),
+                 db: AsyncSession = Depends(get_db)):
+    """Get request for logout user endpoint and clear cookie with login session.
+    Token is revoked in DB, so no worker accepts it any more."""
+    if user is not None:
+        await db.run_sync(revoke_token, user)
+        await db.commit()
     msg = "Logout Successful"
     response = templates.TemplateResponse(
         "login.html", {"request": request, "msg": msg})
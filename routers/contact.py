@@ -1,11 +1,12 @@
 from fastapi.responses import HTMLResponse
 from starlette.responses import RedirectResponse
-from sqlalchemy.orm import Session
-from fastapi.templating import Jinja2Templates
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, status, APIRouter, Request, Form
 import models
-from database import engine
-from utils import get_db, get_current_user
+from templating import templates
+from utils import get_db, get_current_user, Principal
+from events import publish_message
+from inbox import inbox, ACCEPTED, RATE_LIMITED, SHED
 
 router = APIRouter(
     prefix="/contact",
@@ -13,24 +14,16 @@ router = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-models.Base.metadata.create_all(bind=engine)
-
-templates = Jinja2Templates(directory="templates")
-
 
 @router.get("/", response_class=HTMLResponse)
-async def contact_page(request: Request, db: Session = Depends(get_db)):
-
-    user = get_current_user(request)
+async def contact_page(request: Request, user: Principal | None = Depends(get_current_user)):
 
     if user:
-        user_model = db.query(models.User).filter(
-            models.User.username == user['username']).first()
-        if user_model.role == "customer":
+        if user.role == "customer":
             return RedirectResponse(url="/customer", status_code=status.HTTP_302_FOUND)
-        if user_model.role == "mechanic":
+        if user.role == "mechanic":
             return RedirectResponse(url="/mechanic", status_code=status.HTTP_302_FOUND)
-        if user_model.role == "admin":
+        if user.role == "admin":
             return RedirectResponse(url="/admin", status_code=status.HTTP_302_FOUND)
 
     return templates.TemplateResponse("contact-form.html", {"request": request})
@@ -38,31 +31,41 @@ async def contact_page(request: Request, db: Session = Depends(get_db)):
 
 @router.post("/", response_class=HTMLResponse)
 async def message_form(request: Request, email: str = Form(...),
-                       message: str = Form(...),
-                       db: Session = Depends(get_db)):
-    """POST request for contact form"""
-
-    message_model = models.Message()
-    message_model.email = email
-    message_model.message = message
-
-    db.add(message_model)
-    db.commit()
-
-    msg = "Message has been sent."
-    return templates.TemplateResponse("contact-form.html",
-                                      {"request": request, "msg": msg})
+                       message: str = Form(...)):
+    """POST request for contact form. Messages are buffered and written in
+    batches by the inbox, bursts are limited per IP and e-mail."""
+
+    ip = request.client.host if request.client else ""
+    result = inbox.offer(ip, email, message)
+
+    status_code = status.HTTP_200_OK
+    headers = {}
+    if result == ACCEPTED:
+        msg = "Message has been sent."
+    elif result == RATE_LIMITED:
+        msg = "Too many messages, please try again later."
+        status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        headers["Retry-After"] = str(inbox.retry_after(ip, email))
+    elif result == SHED:
+        msg = "We are receiving too many messages, please try again later."
+        status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        headers["Retry-After"] = str(inbox.retry_after(ip, email))
+    else:
+        msg = "Message is too long."
+        status_code = status.HTTP_400_BAD_REQUEST
+    return templates.TemplateResponse("contact-form.html", {"request": request, "msg": msg},
+                                      status_code=status_code, headers=headers)
 
 
 @router.get("/delete/{message_id}", response_class=HTMLResponse)
-async def delete_message(request: Request, message_id: str,
-                         db: Session = Depends(get_db)):
+async def delete_message(request: Request, message_id: int,
+                         db: AsyncSession = Depends(get_db)):
     """GET request for deleting specific message from DB"""
 
-    message_model_to_delete = db.query(models.Message).filter(
-        models.Message.id == message_id).first()
+    message_model_to_delete = await db.get(models.Message, message_id)
 
-    db.delete(message_model_to_delete)
-    db.commit()
+    await db.delete(message_model_to_delete)
+    await db.commit()
+    publish_message(message_model_to_delete, "deleted")
 
     return RedirectResponse(url="/mechanic", status_code=status.HTTP_302_FOUND)
@@ -1,16 +1,19 @@
-from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from fastapi.templating import Jinja2Templates
+from datetime import date
+from fastapi.responses import HTMLResponse, JSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.responses import RedirectResponse
 from fastapi import Depends, status, APIRouter, Request, Form
 import models
-from database import engine
-from utils import get_db, get_current_user, check_user_role_and_redirect
+from templating import templates
+from utils import get_db, get_current_user, check_user_role_and_redirect, Principal
 from typing import List
-
-templates = Jinja2Templates(directory="templates")
-
-models.Base.metadata.create_all(bind=engine)
+from repairs import overlapping, load_repair_detail
+from busy import busy_ranges, ONE_DAY
+from scheduling import check_booking, free_slots, next_free_slot, too_long, BookingConflict, MAX_SLOT_DAYS
+from analytics import repair_facts, update_repair_stats
+from versions import page_validators
+from events import publish_repair
 
 router = APIRouter(
     prefix="/customer",
@@ -20,18 +23,17 @@ router = APIRouter(
 
 
 @router.get("/", response_class=HTMLResponse)
-async def customer_home_page(request: Request, db: Session = Depends(get_db)):
+async def customer_home_page(request: Request, user: Principal | None = Depends(get_current_user),
+                             db: AsyncSession = Depends(get_db)):
     """Get request for starting customer page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'customer')
+    redirection = check_user_role_and_redirect(user, 'customer')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user = get_current_user(request)
-
-    customer_repairs = db.query(models.Repair).filter(
-        models.Repair.customer_id == user['id']).all()
+    customer_repairs = (await db.scalars(select(models.Repair).where(
+        models.Repair.customer_id == user.id))).all()
 
     return templates.TemplateResponse("customer.html", {"request": request,
                                                         "user": user,
@@ -39,18 +41,17 @@ async def customer_home_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/repairs", response_class=HTMLResponse)
-async def customer_home_page(request: Request, db: Session = Depends(get_db)):
+async def customer_home_page(request: Request, user: Principal | None = Depends(get_current_user),
+                             db: AsyncSession = Depends(get_db)):
     """Get request for customer/repairs page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'customer')
+    redirection = check_user_role_and_redirect(user, 'customer')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user = get_current_user(request)
-
-    customer_repairs = db.query(models.Repair).filter(
-        models.Repair.customer_id == user['id']).all()
+    customer_repairs = (await db.scalars(select(models.Repair).where(
+        models.Repair.customer_id == user.id))).all()
 
     return templates.TemplateResponse("repairs_customer.html", {"request": request,
                                                                 "user": user,
@@ -58,44 +59,31 @@ async def customer_home_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/repairs/{repair_id}", response_class=HTMLResponse)
-async def repairs_id_page_for_mechanic(request: Request, repair_id: int, db: Session = Depends(get_db)):
+async def repairs_id_page_for_mechanic(request: Request, repair_id: int,
+                                       user: Principal | None = Depends(get_current_user),
+                                       db: AsyncSession = Depends(get_db)):
     """Get request for repair_id page"""
-    redirection = check_user_role_and_redirect(request, db, 'customer')
+    redirection = check_user_role_and_redirect(user, 'customer')
     if redirection["is_needed"]:
         return redirection['redirection']
-    user_decoded = get_current_user(request)
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
-    # redirection if user is trying to reach not his repair
-    all_customers_repair = db.query(models.Repair).filter(
-        models.Repair.customer_id == user.id).all()
-    all_customers_repair_ids = [repair.id for repair in all_customers_repair]
-    if repair_id not in all_customers_repair_ids:
-        return RedirectResponse(url="/customer", status_code=status.HTTP_302_FOUND)
 
-    else:
-        used_parts = db.query(models.Part).join(models.PartsInRepair, models.Part.id == models.PartsInRepair.part_id).filter(
-            models.PartsInRepair.repair_id == repair_id).all()
+    validators = await db.run_sync(page_validators, request, user,
+                                   ["repair", "parts_in_repair", "part"])
+    if validators.matches(request):
+        return validators.not_modified()
 
-    for part in used_parts:
-        for repair in part.repairs:
-            if repair.repair_id != repair_id:
-                repair_index = part.repairs.index(repair)
-                part.repairs.pop(repair_index)
+    detail = await db.run_sync(load_repair_detail, repair_id)
 
-        total_price = 0
-        for part in used_parts:
-            total_price += (part.repairs[0].quantity * part.price)
-
-        repair = db.query(models.Repair).filter(
-            models.Repair.id == repair_id).first()
+    # redirection if user is trying to reach not his repair
+    if detail is None or detail.repair.customer_id != user.id:
+        return RedirectResponse(url="/customer", status_code=status.HTTP_302_FOUND)
 
-        return templates.TemplateResponse("repairs_customer_id.html", {"request": request,
+    response = templates.TemplateResponse("repairs_customer_id.html", {"request": request,
                                                                        "user": user,
-                                                                       "used_parts": used_parts,
-                                                                       "repair": repair,
-                                                                       "total_price": total_price})
+                                                                       "used_parts": detail.line_items,
+                                                                       "repair": detail.repair,
+                                                                       "total_price": detail.total_price})
+    return validators.apply(response)
 
 
 def convert_repairs(repairs: List[models.Repair]):
@@ -120,60 +108,85 @@ def convert_repairs(repairs: List[models.Repair]):
     return repair_dates
 
 
-def get_busy_dates(repairs: List[models.Repair]):
+def get_busy_dates(model_busy_ranges: List[models.BusyRange]):
+    """Busy ranges are shown as background, end is exclusive in the calendar"""
     busy_dates = []
-    for repair in repairs:
-        if repair.active:
-            busy_dates.append({
-                "title": "-",
-                "start": f"{repair.start_date}",
-                "end": f"{repair.end_date}",
-                "color": "red",
-                "url": "",
-            })
+    for busy_range in model_busy_ranges:
+        busy_dates.append({
+            "start": f"{busy_range.start_date}",
+            "end": f"{busy_range.end_date + ONE_DAY}",
+            "color": "red",
+            "rendering": "background",
+        })
     return busy_dates
 
 
 @router.get("/calendar", response_class=HTMLResponse)
-async def get_customer_calendar(request: Request, db: Session = Depends(get_db)):
+async def get_customer_calendar(request: Request,
+                                user: Principal | None = Depends(get_current_user),
+                                db: AsyncSession = Depends(get_db)):
     """Get request for customer/repairs page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'customer')
+    redirection = check_user_role_and_redirect(user, 'customer')
     if redirection["is_needed"]:
         return redirection['redirection']
-    user = get_current_user(request)
+    return templates.TemplateResponse("calendar_customer.html", {"request": request,
+                                                                 "user": user})
+
 
-    model_customer_repairs = db.query(models.Repair).filter(
-        models.Repair.customer_id == user['id']).all()
+@router.get("/calendar/events")
+async def customer_calendar_events(request: Request, start: date, end: date,
+                                   user: Principal | None = Depends(get_current_user),
+                                   db: AsyncSession = Depends(get_db)):
+    """Get request for calendar events overlapping start - end range. Customer
+    sees his own repairs on top of dates when the shop is busy."""
+
+    redirection = check_user_role_and_redirect(user, 'customer')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    validators = await db.run_sync(page_validators, request, user, ["repair", "busy_range"])
+    if validators.matches(request):
+        return validators.not_modified()
+
+    model_customer_repairs = (await db.scalars(overlapping(select(models.Repair), start, end).where(
+        models.Repair.customer_id == user.id))).all()
     customer_repairs = convert_repairs(model_customer_repairs)
 
-    model_all_repairs = db.query(models.Repair).filter(
-        models.Repair.customer_id != user['id']).all()
-    all_repairs = get_busy_dates(model_all_repairs)
+    # merged busy ranges of the whole shop instead of every single repair
+    all_repairs = get_busy_dates(await db.run_sync(busy_ranges, start, end))
 
     all_repairs.extend(customer_repairs)
+    return validators.apply(JSONResponse(all_repairs))
 
-    return templates.TemplateResponse("calendar_customer.html", {"request": request,
-                                                                 "user": user,
-                                                                 "customer_repairs": all_repairs})
+
+@router.get("/calendar/free_slots")
+async def customer_free_slots(days: int = 1, count: int = 5, after: date | None = None,
+                              user: Principal | None = Depends(get_current_user),
+                              db: AsyncSession = Depends(get_db)):
+    """Get request for the earliest count periods of days days the shop has
+    room for a repair in"""
+
+    redirection = check_user_role_and_redirect(user, 'customer')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    slots = await db.run_sync(free_slots, days, count, max(after or date.today(), date.today()))
+    return JSONResponse([{"start": f"{start}", "end": f"{end}"} for start, end in slots])
 
 
 @router.post("/calendar", response_class=HTMLResponse)
 async def add_new_repair(request: Request, car_name: str = Form(...),
-                         start_of_repair: str = Form(...), end_of_repair: str = Form(...),
-                         db: Session = Depends(get_db)):
+                         start_of_repair: date = Form(...), end_of_repair: date = Form(...),
+                         user: Principal | None = Depends(get_current_user),
+                         db: AsyncSession = Depends(get_db)):
     """Post request for adding new not active repair to the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'customer')
+    redirection = check_user_role_and_redirect(user, 'customer')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user_decoded = get_current_user(request)
-
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
     repair_model = models.Repair()
 
     repair_model.car_name = car_name
@@ -182,10 +195,21 @@ async def add_new_repair(request: Request, car_name: str = Form(...),
     repair_model.active = False
     repair_model.customer_id = user.id
 
+    # proposition does not take a bay until confirmed, but has to fit in
+    period = (start_of_repair, max(start_of_repair, end_of_repair))
+    if too_long(period):
+        return templates.TemplateResponse("success.html", {"request": request,
+                                                           "msg": f"Error: a repair can last at most {MAX_SLOT_DAYS} days"})
     try:
+        await db.run_sync(check_booking, period, False)
         db.add(repair_model)
-        db.commit()
+        await db.run_sync(update_repair_stats, None, repair_facts(repair_model))
+        await db.commit()
+        publish_repair(repair_model, "created")
         msg = 'New proposition sent'
+    except BookingConflict as conflict:
+        start, end = await db.run_sync(next_free_slot, period)
+        msg = f"Error: no free bay on {conflict.day}, nearest free term: {start} - {end}"
     except Exception as err:
         msg = f"Error: {err}"
 
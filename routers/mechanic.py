@@ -1,16 +1,31 @@
-from typing import List
-from fastapi.responses import HTMLResponse
+from datetime import date
+from typing import List, Literal
+from urllib.parse import urlencode
+from pydantic import BaseModel, Field
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from starlette.responses import RedirectResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from fastapi.templating import Jinja2Templates
 from fastapi import Depends, status, APIRouter, Request, Form
 import models
-from database import engine
-from utils import get_db, check_user_role_and_redirect, get_current_user
-
-templates = Jinja2Templates(directory="templates")
-
-models.Base.metadata.create_all(bind=engine)
+from database import new_session, SessionLocal
+from templating import templates
+from utils import get_db, check_user_role_and_redirect, get_current_user, Principal
+from search import search_parts, part_search_filter
+from repairs import (overlapping, load_repair_detail, add_line_item, set_line_item_quantity,
+                     remove_line_item, apply_line_item_operations, add_price_changes, LineItemError,
+                     InsufficientStock, MAX_LINE_ITEM_OPERATIONS)
+from busy import busy_period, update_busy
+from scheduling import check_booking, free_slots, next_free_slot, too_long, BookingConflict, MAX_SLOT_DAYS
+from analytics import repair_facts, update_repair_stats
+from forecast import reorder_report, CONSUMPTION_TABLES
+from pagination import Page, keyset_page, clamp_page_size, DEFAULT_PAGE_SIZE
+from versions import page_validators
+from events import broker, event_stream, publish_repair, publish_repair_total
+from catalogue import cached_catalogue, get_catalogue, invalidate_catalogue, Catalogue
+from parts_io import (RowParser, LineSplitter, ImportReport, import_batch, export_parts,
+                      FORMATS, IMPORT_BATCH_SIZE)
 
 router = APIRouter(
     prefix="/mechanic",
@@ -20,65 +35,80 @@ router = APIRouter(
 
 
 @router.get("/", response_class=HTMLResponse)
-async def mechanic_home_page(request: Request, db: Session = Depends(get_db)):
+async def mechanic_home_page(request: Request, user: Principal | None = Depends(get_current_user),
+                             db: AsyncSession = Depends(get_db)):
     """Get request for starting mechanic page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user_decoded = get_current_user(request)
-
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
-    messages = db.query(models.Message).all()
+    messages = (await db.scalars(select(models.Message))).all()
 
-    all_repairs = db.query(models.Repair).all()
+    all_repairs = (await db.scalars(select(models.Repair))).all()
 
     return templates.TemplateResponse("mechanic.html", {"request": request, "user": user,
                                                         "messages": messages, "repairs": all_repairs})
 
 
+@router.get("/events")
+async def mechanic_events(request: Request, user: Principal | None = Depends(get_current_user)):
+    """Server-Sent Events stream of repair, line item and message changes,
+    the dashboard and the calendar update themselves from it"""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+
+    subscription = broker.subscribe(request.headers.get("last-event-id"))
+    if subscription is None:
+        return JSONResponse({"error": "Za dużo połączeń"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": "30"})
+    return StreamingResponse(event_stream(request, subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.get("/repairs", response_class=HTMLResponse)
-async def repairs_page_for_mechanic(request: Request, db: Session = Depends(get_db)):
+async def repairs_page_for_mechanic(request: Request, msg: str = "",
+                                    user: Principal | None = Depends(get_current_user),
+                                    db: AsyncSession = Depends(get_db)):
     """Get request for starting mechanic page after beeing logged in"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user_decoded = get_current_user(request)
-
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
-    found_customers = db.query(models.User).filter(
-        models.User.role == 'customer')
+    found_customers = (await db.scalars(select(models.User).where(
+        models.User.role == 'customer'))).all()
 
-    repairs = db.query(models.Repair).all()
+    repairs = (await db.scalars(select(models.Repair))).all()
 
     return templates.TemplateResponse("repairs_mechanic.html", {"request": request, "user": user,
                                                                 "customers": found_customers,
-                                                                "repairs": repairs})
+                                                                "repairs": repairs, "msg": msg})
+
+
+TOO_LONG_MSG = f"Naprawa może trwać najwyżej {MAX_SLOT_DAYS} dni"
+
+
+async def booking_conflict_message(db: AsyncSession, conflict: BookingConflict, period) -> str:
+    """Rejection message pointing to the nearest period the repair fits in"""
+    start, end = await db.run_sync(next_free_slot, period)
+    return f"Brak wolnego stanowiska w dniu {conflict.day}, najbliższy wolny termin: {start} - {end}"
 
 
 @router.post("/repairs", response_class=HTMLResponse)
 async def add_new_repair(request: Request, car_name: str = Form(...), customer_id: int = Form(...),
-                         start_of_repair: str = Form(...), end_of_repair: str = Form(...),
-                         db: Session = Depends(get_db)):
+                         start_of_repair: date = Form(...), end_of_repair: date = Form(...),
+                         user: Principal | None = Depends(get_current_user),
+                         db: AsyncSession = Depends(get_db)):
     """Post request for adding new repair to the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user_decoded = get_current_user(request)
-
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
     repair_model = models.Repair()
 
     repair_model.car_name = car_name
@@ -87,10 +117,23 @@ async def add_new_repair(request: Request, car_name: str = Form(...), customer_i
     repair_model.active = True
     repair_model.customer_id = customer_id
 
+    period = busy_period(repair_model)
+    if too_long(period):
+        return RedirectResponse(url="/mechanic/repairs?" + urlencode({"msg": TOO_LONG_MSG}),
+                                status_code=status.HTTP_302_FOUND)
     try:
         db.add(repair_model)
-        db.commit()
+        await db.run_sync(update_busy, None, period)
+        await db.run_sync(check_booking, period)
+        await db.run_sync(update_repair_stats, None, repair_facts(repair_model))
+        await db.commit()
+        publish_repair(repair_model, "created")
         msg = 'Dodano nowy termin'
+    except BookingConflict as conflict:
+        await db.rollback()
+        msg = await booking_conflict_message(db, conflict, period)
+        return RedirectResponse(url="/mechanic/repairs?" + urlencode({"msg": msg}),
+                                status_code=status.HTTP_302_FOUND)
     except Exception as err:
         msg = f"błąd podczas dodawania: {err}"
 
@@ -98,98 +141,157 @@ async def add_new_repair(request: Request, car_name: str = Form(...), customer_i
 
 
 @router.get("/repairs/{repair_id}", response_class=HTMLResponse)
-async def repairs_id_page_for_mechanic(request: Request, repair_id: int, filltered_sentance: str = "", db: Session = Depends(get_db)):
+async def repairs_id_page_for_mechanic(request: Request, repair_id: int,
+                                       filltered_sentance: str = "", msg: str = "",
+                                       user: Principal | None = Depends(get_current_user),
+                                       db: AsyncSession = Depends(get_db)):
     """Get request for repair_id page"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
-    user_decoded = get_current_user(request)
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-    all_parts = []
-    found_parts = db.query(models.Part).all()
-    if filltered_sentance == "":
-        all_parts = found_parts
+
+    validators = await db.run_sync(page_validators, request, user,
+                                   ["repair", "parts_in_repair", "part", "user"])
+    if validators.matches(request):
+        return validators.not_modified()
+
+    if filltered_sentance.strip() == "":
+        all_parts = (await db.scalars(select(models.Part).order_by(models.Part.name))).all()
     else:
-        phrases = filltered_sentance.split(' ')
-        searched_phrases = [phrase.casefold() for phrase in phrases]
-        for part in found_parts:
-            part_words: List[str] = part.name.split(' ')
-            part_words = [word.casefold() for word in part_words]
-            if any(phrase in searched_phrases for phrase in part_words):
-                all_parts.append(part)
-    
-
-
-    used_parts = db.query(models.Part).join(models.PartsInRepair, models.Part.id == models.PartsInRepair.part_id).filter(
-        models.PartsInRepair.repair_id == repair_id).all()
-
-    for part in used_parts:
-        for repair in part.repairs:
-            if repair.repair_id != repair_id:
-                repair_index = part.repairs.index(repair)
-                part.repairs.pop(repair_index)
-
-    total_price = 0
-    for part in used_parts:
-        total_price += (part.repairs[0].quantity * part.price)
-
-    repair = db.query(models.Repair).filter(
-        models.Repair.id == repair_id).first()
-    customer = db.query(models.User).filter(
-        models.User.id == repair.customer_id).first()
-
-    return templates.TemplateResponse("repairs_mechanic_id.html", {"request": request,
-                                                                   "user": user,
-                                                                   "all_parts": all_parts,
-                                                                   "used_parts": used_parts,
-                                                                   "customer": customer,
-                                                                   "repair": repair,
-                                                                   "total_price": total_price})
+        all_parts = await db.run_sync(search_parts, filltered_sentance)
+
+    detail = await db.run_sync(load_repair_detail, repair_id)
+    if detail is None:
+        return RedirectResponse(url="/mechanic/repairs", status_code=status.HTTP_302_FOUND)
+
+    response = templates.TemplateResponse("repairs_mechanic_id.html", {"request": request,
+                                                                       "user": user,
+                                                                       "all_parts": all_parts,
+                                                                       "used_parts": detail.line_items,
+                                                                       "customer": detail.customer,
+                                                                       "repair": detail.repair,
+                                                                       "total_price": detail.total_price,
+                                                                       "msg": msg})
+    return validators.apply(response)
+
+
+async def publish_line_items(db: AsyncSession, repair_id: int):
+    """Live dashboards show repair totals, which follow line items"""
+    money = await db.scalar(select(models.Repair.money).where(models.Repair.id == repair_id))
+    publish_repair_total(repair_id, money)
+
+
+def repair_page_url(repair_id: int, error: str | None = None) -> str:
+    """Repair page, with rejection message when line item or date change failed"""
+    url = f"/mechanic/repairs/{repair_id}"
+    if error:
+        url += "?" + urlencode({"msg": error})
+    return url
 
 
 @router.post("/repairs/{repair_id}", response_class=HTMLResponse)
 async def add_new_part_to_repair_id(request: Request, repair_id: int, part_id: int = Form(...),
-                                    quantity: int = Form(...), db: Session = Depends(get_db)):
+                                    quantity: int = Form(...),
+                                    user: Principal | None = Depends(get_current_user),
+                                    db: AsyncSession = Depends(get_db)):
     """Post request for adding to the DB new part used in repair_id or change date"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
    
-    # add new part to repair
-    parts_in_repair_model = models.PartsInRepair()
-    parts_in_repair_model.part_id = part_id
-    parts_in_repair_model.repair_id = repair_id
-    parts_in_repair_model.quantity = quantity
-
+    # add new part to repair, taken from storage
+    error = None
     try:
-        db.add(parts_in_repair_model)
-        db.commit()
+        await db.run_sync(add_line_item, repair_id, part_id, quantity)
+        await db.commit()
+        invalidate_catalogue()
+        await publish_line_items(db, repair_id)
         msg = 'Dodano nową część do rachunku'
+    except LineItemError as err:
+        await db.rollback()
+        error = str(err)
     except Exception as err:
-        msg = f"błąd podczas dodawania: {err}"
+        await db.rollback()
+        error = f"błąd podczas dodawania: {err}"
+
+    return RedirectResponse(url=repair_page_url(repair_id, error), status_code=status.HTTP_302_FOUND)
+
+
+class LineItemOperation(BaseModel):
+    """add: pieces added to the line, set: new quantity (0 removes the line),
+    remove: line removed, quantity is not needed"""
+    op: Literal["add", "set", "remove"]
+    part_id: int
+    quantity: int | None = None
+
+
+class LineItemBatch(BaseModel):
+    operations: List[LineItemOperation] = Field(max_length=MAX_LINE_ITEM_OPERATIONS)
 
-    url = f"/mechanic/repairs/{repair_id}"
-    return RedirectResponse(url=url, status_code=status.HTTP_302_FOUND)
+
+def line_items_json(detail) -> dict:
+    return {"repair_id": detail.repair.id,
+            "line_items": [{"part_id": item.part.id, "name": item.part.name,
+                            "quantity": item.quantity, "price": item.part.price,
+                            "line_total": item.line_total} for item in detail.line_items],
+            "total_price": detail.total_price}
+
+
+@router.post("/repairs/{repair_id}/parts")
+async def change_parts_of_repair(repair_id: int, batch: LineItemBatch,
+                                 user: Principal | None = Depends(get_current_user),
+                                 db: AsyncSession = Depends(get_db)):
+    """Applies list of line item operations (in order) to repair_id in one
+    transaction, storage included. Either all operations are applied or none.
+    Returns line items and total price of the repair."""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+
+    if await db.get(models.Repair, repair_id) is None:
+        return JSONResponse({"error": "Nie ma takiej naprawy"}, status_code=status.HTTP_404_NOT_FOUND)
+
+    operations = [(operation.op, operation.part_id, operation.quantity) for operation in batch.operations]
+    try:
+        await db.run_sync(apply_line_item_operations, repair_id, operations)
+        await db.commit()
+    except InsufficientStock as err:
+        await db.rollback()
+        return JSONResponse({"error": str(err), "part_id": err.part_id, "requested": err.requested,
+                             "available": err.available}, status_code=status.HTTP_409_CONFLICT)
+    except LineItemError as err:
+        await db.rollback()
+        return JSONResponse({"error": str(err)}, status_code=status.HTTP_400_BAD_REQUEST)
+    invalidate_catalogue()
+    await publish_line_items(db, repair_id)
+
+    detail = await db.run_sync(load_repair_detail, repair_id)
+    return JSONResponse(line_items_json(detail))
 
 
 @router.get("/repairs/delete/{repair_id}", response_class=HTMLResponse)
 async def remove_repair(request: Request, repair_id: int,
-                        db: Session = Depends(get_db)):
+                        user: Principal | None = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
     """Post request for removing repair from the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    repair_model = db.query(models.Repair).filter(
-        models.Repair.id == repair_id).first()
+    repair_model = await db.get(models.Repair, repair_id)
 
     try:
-        db.delete(repair_model)
-        db.commit()
+        old_busy = busy_period(repair_model)
+        old_facts = repair_facts(repair_model)
+        await db.delete(repair_model)
+        await db.run_sync(update_busy, old_busy, None)
+        await db.run_sync(update_repair_stats, old_facts, None)
+        await db.commit()
+        publish_repair(repair_model, "deleted")
         msg = 'usunięto'
     except Exception as err:
         msg = f"błąd: {err}"
@@ -198,25 +300,39 @@ async def remove_repair(request: Request, repair_id: int,
 
 
 @router.post("/repairs/{repair_id}/change_date", response_class=HTMLResponse)
-async def change_date_of_repair(request: Request, repair_id: int, start_of_repair: str = Form(...),
-                                end_of_repair: str = Form(...), db: Session = Depends(get_db)):
+async def change_date_of_repair(request: Request, repair_id: int,
+                                start_of_repair: date = Form(...), end_of_repair: date = Form(...),
+                                user: Principal | None = Depends(get_current_user),
+                                db: AsyncSession = Depends(get_db)):
     """Post request for adding to the DB new part used in repair_id or change date"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    repair = db.query(models.Repair).filter(
-        models.Repair.id == repair_id).first()
+    repair = await db.get(models.Repair, repair_id)
 
     # change repair date
+    old_busy = busy_period(repair)
+    old_facts = repair_facts(repair)
     repair.start_date = start_of_repair
     repair.end_date = end_of_repair
+    if too_long((start_of_repair, max(start_of_repair, end_of_repair))):
+        return RedirectResponse(url=repair_page_url(repair_id, TOO_LONG_MSG), status_code=status.HTTP_302_FOUND)
 
+    new_busy = busy_period(repair)
     try:
         db.add(repair)
-        db.commit()
+        await db.run_sync(update_busy, old_busy, new_busy)
+        await db.run_sync(check_booking, new_busy)
+        await db.run_sync(update_repair_stats, old_facts, repair_facts(repair))
+        await db.commit()
+        publish_repair(repair, "updated")
         msg = 'Zmieniono datę'
+    except BookingConflict as conflict:
+        await db.rollback()
+        msg = await booking_conflict_message(db, conflict, new_busy)
+        return RedirectResponse(url=repair_page_url(repair_id, msg), status_code=status.HTTP_302_FOUND)
     except Exception as err:
         msg = f"błąd podczas dodawania: {err}"
 
@@ -225,23 +341,38 @@ async def change_date_of_repair(request: Request, repair_id: int, start_of_repai
 
 
 @router.post("/repairs/{repair_id}/activate", response_class=HTMLResponse)
-async def change_date_of_repair(request: Request, repair_id: int, db: Session = Depends(get_db)):
+async def change_date_of_repair(request: Request, repair_id: int,
+                                user: Principal | None = Depends(get_current_user),
+                                db: AsyncSession = Depends(get_db)):
     """Post request for adding to the DB new part used in repair_id or change date"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    repair = db.query(models.Repair).filter(
-        models.Repair.id == repair_id).first()
+    repair = await db.get(models.Repair, repair_id)
 
     # change repair active status
+    old_busy = busy_period(repair)
+    old_facts = repair_facts(repair)
     repair.active = not repair.active
 
+    new_busy = busy_period(repair)
+    # proposals sent before the limit existed can be longer
+    if too_long(new_busy):
+        return RedirectResponse(url=repair_page_url(repair_id, TOO_LONG_MSG), status_code=status.HTTP_302_FOUND)
     try:
         db.add(repair)
-        db.commit()
+        await db.run_sync(update_busy, old_busy, new_busy)
+        await db.run_sync(check_booking, new_busy)
+        await db.run_sync(update_repair_stats, old_facts, repair_facts(repair))
+        await db.commit()
+        publish_repair(repair, "updated")
         msg = 'Zaktualizowano naprawę'
+    except BookingConflict as conflict:
+        await db.rollback()
+        msg = await booking_conflict_message(db, conflict, new_busy)
+        return RedirectResponse(url=repair_page_url(repair_id, msg), status_code=status.HTTP_302_FOUND)
     except Exception as err:
         msg = f"błąd podczas zmiany: {err}"
 
@@ -251,110 +382,183 @@ async def change_date_of_repair(request: Request, repair_id: int, db: Session =
 
 @router.post("/repairs/{repair_id}/{used_part_id}", response_class=HTMLResponse)
 async def change_amount_of_used_parts(request: Request, repair_id: int, used_part_id: int,
-                                      new_amount: int = Form(...), db: Session = Depends(get_db)):
+                                      new_amount: int = Form(...),
+                                      user: Principal | None = Depends(get_current_user),
+                                      db: AsyncSession = Depends(get_db)):
     """Post request for changing amount of used parts in specific repair"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    part_in_repair = db.query(models.PartsInRepair).filter(
-        models.PartsInRepair.repair_id == repair_id).filter(models.PartsInRepair.part_id == used_part_id).first()
-
-    # change repair date
-    part_in_repair.quantity = new_amount
-
+    # change amount, storage changes by the difference
+    error = None
     try:
-        db.add(part_in_repair)
-        db.commit()
+        await db.run_sync(set_line_item_quantity, repair_id, used_part_id, new_amount)
+        await db.commit()
+        invalidate_catalogue()
+        await publish_line_items(db, repair_id)
         msg = 'Zmieniono'
+    except LineItemError as err:
+        await db.rollback()
+        error = str(err)
     except Exception as err:
-        msg = f"błąd: {err}"
+        await db.rollback()
+        error = f"błąd: {err}"
 
-    url = f"/mechanic/repairs/{repair_id}"
-    return RedirectResponse(url=url, status_code=status.HTTP_302_FOUND)
+    return RedirectResponse(url=repair_page_url(repair_id, error), status_code=status.HTTP_302_FOUND)
 
 
 @router.post("/repairs/{repair_id}/delete_part/{used_part_id}", response_class=HTMLResponse)
-async def remove_part_from_repair(request: Request, repair_id: int, used_part_id: int, db: Session = Depends(get_db)):
+async def remove_part_from_repair(request: Request, repair_id: int, used_part_id: int,
+                                  user: Principal | None = Depends(get_current_user),
+                                  db: AsyncSession = Depends(get_db)):
     """Post request removing used part in specific repair"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    part_in_repair = db.query(models.PartsInRepair).filter(
-        models.PartsInRepair.repair_id == repair_id).filter(models.PartsInRepair.part_id == used_part_id).first()
-
+    # removed pieces go back to storage
+    error = None
     try:
-        db.delete(part_in_repair)
-        db.commit()
+        await db.run_sync(remove_line_item, repair_id, used_part_id)
+        await db.commit()
+        invalidate_catalogue()
+        await publish_line_items(db, repair_id)
         msg = 'Zmieniono'
     except Exception as err:
-        msg = f"błąd: {err}"
+        await db.rollback()
+        error = f"błąd: {err}"
 
-    url = f"/mechanic/repairs/{repair_id}"
-    return RedirectResponse(url=url, status_code=status.HTTP_302_FOUND)
+    return RedirectResponse(url=repair_page_url(repair_id, error), status_code=status.HTTP_302_FOUND)
+
+
+# parts to reorder listed above the storage listing
+REORDER_SHOWN = 10
+
+# columns the storage listing can be sorted by
+STORAGE_SORT_COLUMNS = {
+    "name": models.Part.name,
+    "amount_left": models.Part.amount_left,
+    "engine_type": models.Part.engine_type,
+    "price": models.Part.price,
+    "nr_oem": models.Part.nr_oem,
+    "id": models.Part.id,
+}
+
+
+def list_storage_parts(db: Session, nr_oem: str | None, qr_code: str | None,
+                       search_name: str | None, engine_type: str | None, sort: str,
+                       direction: str, page_size: int, after: str | None,
+                       before: str | None) -> Page:
+    """Filters parts in SQL and returns requested page of the storage listing"""
+    query = db.query(models.Part)
+    if nr_oem is not None:
+        query = query.filter(models.Part.nr_oem == nr_oem)
+    elif qr_code is not None:
+        query = query.filter(models.Part.qr_code == qr_code)
+
+    # full-text search over name, nr oem and engine type
+    elif search_name is not None:
+        query = query.filter(part_search_filter(db.get_bind(), search_name))
+    if engine_type is not None:
+        query = query.filter(models.Part.engine_type == engine_type)
+
+    return keyset_page(query, STORAGE_SORT_COLUMNS[sort], models.Part.id,
+                       descending=direction == "desc", page_size=page_size,
+                       after=after, before=before)
+
+
+def find_storage_parts(catalogue: Catalogue, nr_oem: str | None, qr_code: str | None,
+                       engine_type: str | None, sort: str, direction: str,
+                       page_size: int) -> Page | None:
+    """Lookup by scanned code served from the catalogue snapshot. None when
+    matches do not fit on one page, those are listed by SQL with cursors."""
+    entries = [entry for entry in catalogue.find(qr_code=qr_code, nr_oem=nr_oem)
+               if engine_type is None or entry.engine_type == engine_type]
+    if len(entries) > clamp_page_size(page_size):
+        return None
+    def sort_key(entry):
+        # NULL sorts first, as in SQLite
+        value = getattr(entry, sort)
+        return value is not None, value if value is not None else 0, entry.id
+
+    entries.sort(key=sort_key, reverse=direction == "desc")
+    return Page(entries, None, None)
 
 
 @router.get("/storage", response_class=HTMLResponse)
-async def storage_page(request: Request, nr_oem: str | None = None,
-                       qr_code: str | None = None, search_name: str | None = None,
-                       db: Session = Depends(get_db)):
-    """Get request for starting mechanic page after beeing logged in"""
+async def storage_page(request: Request, nr_oem: str | None = None, qr_code: str | None = None,
+                       search_name: str | None = None, engine_type: str | None = None,
+                       sort: str = "name", direction: str = "asc",
+                       page_size: int = DEFAULT_PAGE_SIZE, after: str | None = None,
+                       before: str | None = None,
+                       user: Principal | None = Depends(get_current_user),
+                       db: AsyncSession = Depends(get_db)):
+    """Get request for storage page, parts are filtered in SQL and listed
+    page by page using keyset cursors (after / before)"""
 
     # redirection if not authorized user is trying to reach endpoint
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
-    user_decoded = get_current_user(request)
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
-    # fetch all parts from DB
-    found_parts = db.query(models.Part).all()
-    parts = []
 
     # query parameters filtering
-    if search_name == '':
-        search_name = None
+    search_name = (search_name or "").strip() or None
     if nr_oem == '':
         nr_oem = None
     if qr_code == '':
         qr_code = None
-
-    if nr_oem is not None:
-        for part in found_parts:
-            if part.nr_oem == nr_oem:
-                parts.append(part)
-    elif qr_code is not None:
-        for part in found_parts:
-            if part.qr_code == qr_code:
-                parts.append(part)
-
-    # filtering name in search
-    elif search_name is not None:
-        phrases = search_name.split(' ')
-        searched_phrases = [phase.casefold() for phase in phrases]
-        for part in found_parts:
-            part_words: List[str] = part.name.split(' ')
-            part_words = [word.casefold() for word in part_words]
-            if any(phrase in searched_phrases for phrase in part_words):
-                parts.append(part)
-    else:
-        parts = found_parts
-
-    return templates.TemplateResponse("storage.html", {"request": request, "user": user, "parts": parts})
+    if engine_type == '':
+        engine_type = None
+    if sort not in STORAGE_SORT_COLUMNS:
+        sort = "name"
+    if direction not in ("asc", "desc"):
+        direction = "asc"
+
+    # reorder suggestions depend on the date too
+    validators = await db.run_sync(page_validators, request, user, ["part"] + CONSUMPTION_TABLES,
+                                   date.today())
+    if validators.matches(request):
+        return validators.not_modified()
+
+    page = None
+    if (nr_oem is not None or qr_code is not None) and after is None and before is None:
+        catalogue = cached_catalogue() or await db.run_sync(get_catalogue)
+        page = find_storage_parts(catalogue, nr_oem, qr_code, engine_type, sort, direction,
+                                  page_size)
+    if page is None:
+        page = await db.run_sync(list_storage_parts, nr_oem, qr_code, search_name, engine_type,
+                                 sort, direction, page_size, after, before)
+
+    # filters kept in links to neighbouring pages
+    listing_params = {"nr_oem": nr_oem, "qr_code": qr_code, "search_name": search_name,
+                      "engine_type": engine_type, "sort": sort, "direction": direction,
+                      "page_size": clamp_page_size(page_size)}
+    listing_params = {key: value for key, value in listing_params.items()
+                      if value is not None}
+
+    reorder = await db.run_sync(reorder_report)
+
+    response = templates.TemplateResponse("storage.html", {"request": request, "user": user,
+                                                           "parts": page.items, "page": page,
+                                                           "listing_params": listing_params,
+                                                           "sort": sort, "direction": direction,
+                                                           "reorder": reorder[:REORDER_SHOWN]})
+    return validators.apply(response)
 
 
 @router.post("/storage", response_class=HTMLResponse)
 async def add_new_part(request: Request, new_part_name: str = Form(...),
                        new_part_amount: int = Form(...), new_part_engine_type: str = Form(...),
                        new_part_price: float = Form(...), new_part_nr_oem: str = Form(...),
-                       new_part_qr_code: str = Form(''), db: Session = Depends(get_db)):
+                       new_part_qr_code: str = Form(''),
+                       user: Principal | None = Depends(get_current_user),
+                       db: AsyncSession = Depends(get_db)):
     """Post request for adding new parts to the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
@@ -369,7 +573,8 @@ async def add_new_part(request: Request, new_part_name: str = Form(...),
 
     try:
         db.add(part_model)
-        db.commit()
+        await db.commit()
+        invalidate_catalogue()
         msg = 'Dodano część'
     except Exception as err:
         msg = f"błąd podczas dodawania: {err}"
@@ -377,20 +582,74 @@ async def add_new_part(request: Request, new_part_name: str = Form(...),
     return RedirectResponse(url="/mechanic/storage", status_code=status.HTTP_302_FOUND)
 
 
+@router.get("/storage/reorder")
+async def reorder_parts(all: bool = False, user: Principal | None = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_db)):
+    """Parts running out within the reorder lead time at forecast consumption
+    (all used parts with all=true), soonest first"""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    report = await db.run_sync(reorder_report, not all)
+    return JSONResponse([suggestion._asdict() for suggestion in report])
+
+
+@router.post("/storage/import")
+async def import_storage_parts(request: Request, format: str = "csv",
+                               user: Principal | None = Depends(get_current_user),
+                               db: AsyncSession = Depends(get_db)):
+    """Imports parts from CSV (with header) or JSON lines sent as request body,
+    e.g. `curl --data-binary @parts.csv /mechanic/storage/import?format=csv`.
+    Body is parsed while it is received and written in batches, parts are
+    matched by nr_oem or name. Returns counts and per-line errors."""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse({}, status_code=status.HTTP_401_UNAUTHORIZED)
+    if format not in FORMATS:
+        return JSONResponse({"error": f"format has to be one of: {', '.join(FORMATS)}"},
+                            status_code=status.HTTP_400_BAD_REQUEST)
+
+    parser = RowParser(format)
+    splitter = LineSplitter()
+    report = ImportReport()
+    batch = []
+    async for chunk in request.stream():
+        for line in splitter.feed(chunk):
+            parsed = parser.parse(line)
+            if parsed is not None:
+                batch.append(parsed)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await db.run_sync(import_batch, batch, report)
+            batch = []
+    for line in splitter.close():
+        parsed = parser.parse(line)
+        if parsed is not None:
+            batch.append(parsed)
+    if batch:
+        await db.run_sync(import_batch, batch, report)
+    invalidate_catalogue()
+    return JSONResponse(report.as_dict())
+
+
 @router.post("/storage/{part_id}", response_class=HTMLResponse)
 async def change_part(request: Request, part_id: int, change_part_name: str = Form(...),
                       change_part_left: int = Form(...), change_part_engine: str = Form(...),
                       change_part_price: float = Form(...), change_part_oem: str = Form(...),
-                      db: Session = Depends(get_db)):
+                      user: Principal | None = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_db)):
     """Post request for changing part in the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    part_model = db.query(models.Part).filter(
-        models.Part.id == part_id).first()
+    part_model = await db.get(models.Part, part_id)
 
+    # totals of repairs using the part follow its price
+    price_change = change_part_price - (part_model.price or 0)
     part_model.name = change_part_name
     part_model.amount_left = change_part_left
     part_model.engine_type = change_part_engine
@@ -399,7 +658,9 @@ async def change_part(request: Request, part_id: int, change_part_name: str = Fo
 
     try:
         db.add(part_model)
-        db.commit()
+        await db.run_sync(add_price_changes, {part_id: price_change})
+        await db.commit()
+        invalidate_catalogue()
         msg = 'Dodano część'
     except Exception as err:
         msg = f"błąd podczas dodawania: {err}"
@@ -409,19 +670,20 @@ async def change_part(request: Request, part_id: int, change_part_name: str = Fo
 
 @router.post("/storage/delete/{part_id}", response_class=HTMLResponse)
 async def change_part(request: Request, part_id: int,
-                      db: Session = Depends(get_db)):
+                      user: Principal | None = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_db)):
     """Post request removing part from the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    part_model = db.query(models.Part).filter(
-        models.Part.id == part_id).first()
+    part_model = await db.get(models.Part, part_id)
 
     try:
-        db.delete(part_model)
-        db.commit()
+        await db.delete(part_model)
+        await db.commit()
+        invalidate_catalogue()
         msg = 'Dodano część'
     except Exception as err:
         msg = f"błąd: {err}"
@@ -429,6 +691,47 @@ async def change_part(request: Request, part_id: int,
     return RedirectResponse(url="/mechanic/storage", status_code=status.HTTP_302_FOUND)
 
 
+@router.get("/storage/scan")
+async def scan_part(code: str, user: Principal | None = Depends(get_current_user)):
+    """Parts with scanned QR code or OEM number, answered from the catalogue
+    snapshot. Session is opened only when the snapshot has to be checked."""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    catalogue = cached_catalogue()
+    if catalogue is None:
+        async with new_session() as db:
+            catalogue = await db.run_sync(get_catalogue)
+    return JSONResponse([entry._asdict() for entry in catalogue.scan(code.strip())])
+
+
+@router.get("/storage/export")
+async def export_storage_parts(format: str = "csv",
+                               user: Principal | None = Depends(get_current_user)):
+    """Streams all parts as CSV or JSON lines"""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return redirection['redirection']
+    if format not in FORMATS:
+        return JSONResponse({"error": f"format has to be one of: {', '.join(FORMATS)}"},
+                            status_code=status.HTTP_400_BAD_REQUEST)
+
+    def stream():
+        # own session, the response is sent after request dependencies close
+        db = SessionLocal()
+        try:
+            yield from export_parts(db, format)
+        finally:
+            db.close()
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="parts.{format}"'})
+
+
 def convert_repairs(repairs: List[models.Repair]):
     repair_dates = []
     for repair in repairs:
@@ -452,42 +755,71 @@ def convert_repairs(repairs: List[models.Repair]):
 
 
 @router.get("/calendar", response_class=HTMLResponse)
-async def mechanic_calendar(request: Request, db: Session = Depends(get_db)):
+async def mechanic_calendar(request: Request, user: Principal | None = Depends(get_current_user),
+                            db: AsyncSession = Depends(get_db)):
     """Get request for customer/repairs page after beeing logged in"""
 
     # checks if customer is logged in (if different role then redirection)
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
-    user = get_current_user(request)
 
-    model_repairs = db.query(models.Repair).all()
-    all_repairs = convert_repairs(model_repairs)
+    validators = await db.run_sync(page_validators, request, user, ["user"])
+    if validators.matches(request):
+        return validators.not_modified()
 
-    found_customers = db.query(models.User).filter(
-        models.User.role == 'customer')
+    found_customers = (await db.scalars(select(models.User).where(
+        models.User.role == 'customer'))).all()
 
-    return templates.TemplateResponse("calendar_mechanic.html", {"request": request,
-                                                                 "user": user,
-                                                                 "customers": found_customers,
-                                                                 "customer_repairs": all_repairs})
+    response = templates.TemplateResponse("calendar_mechanic.html", {"request": request,
+                                                                     "user": user,
+                                                                     "customers": found_customers})
+    return validators.apply(response)
+
+
+@router.get("/calendar/events")
+async def mechanic_calendar_events(request: Request, start: date, end: date,
+                                   user: Principal | None = Depends(get_current_user),
+                                   db: AsyncSession = Depends(get_db)):
+    """Get request for calendar events, returns repairs overlapping start - end range"""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    validators = await db.run_sync(page_validators, request, user, ["repair"])
+    if validators.matches(request):
+        return validators.not_modified()
+
+    model_repairs = (await db.scalars(overlapping(select(models.Repair), start, end))).all()
+    return validators.apply(JSONResponse(convert_repairs(model_repairs)))
+
+
+@router.get("/calendar/free_slots")
+async def mechanic_free_slots(days: int = 1, count: int = 5, after: date | None = None,
+                              user: Principal | None = Depends(get_current_user),
+                              db: AsyncSession = Depends(get_db)):
+    """Get request for the earliest count periods of days days with a free bay"""
+
+    redirection = check_user_role_and_redirect(user, 'mechanic')
+    if redirection["is_needed"]:
+        return JSONResponse([], status_code=status.HTTP_401_UNAUTHORIZED)
+
+    slots = await db.run_sync(free_slots, days, count, after)
+    return JSONResponse([{"start": f"{start}", "end": f"{end}"} for start, end in slots])
 
 
 @router.post("/calendar", response_class=HTMLResponse)
 async def add_new_repair(request: Request, car_name: str = Form(...), customer_id: int = Form(...),
-                         start_of_repair: str = Form(...), end_of_repair: str = Form(...),
-                         db: Session = Depends(get_db)):
+                         start_of_repair: date = Form(...), end_of_repair: date = Form(...),
+                         user: Principal | None = Depends(get_current_user),
+                         db: AsyncSession = Depends(get_db)):
     """Post request for adding new repair to the DB"""
 
-    redirection = check_user_role_and_redirect(request, db, 'mechanic')
+    redirection = check_user_role_and_redirect(user, 'mechanic')
     if redirection["is_needed"]:
         return redirection['redirection']
 
-    user_decoded = get_current_user(request)
-
-    user = db.query(models.User).filter(
-        models.User.username == user_decoded['username']).first()
-
     repair_model = models.Repair()
 
     repair_model.car_name = car_name
@@ -496,10 +828,21 @@ async def add_new_repair(request: Request, car_name: str = Form(...), customer_i
     repair_model.active = True
     repair_model.customer_id = customer_id
 
+    period = busy_period(repair_model)
+    if too_long(period):
+        return templates.TemplateResponse("success.html", {"request": request, "user": user,
+                                                           "msg": TOO_LONG_MSG})
     try:
         db.add(repair_model)
-        db.commit()
+        await db.run_sync(update_busy, None, period)
+        await db.run_sync(check_booking, period)
+        await db.run_sync(update_repair_stats, None, repair_facts(repair_model))
+        await db.commit()
+        publish_repair(repair_model, "created")
         msg = 'Dodano nową naprawę'
+    except BookingConflict as conflict:
+        await db.rollback()
+        msg = await booking_conflict_message(db, conflict, period)
     except Exception as err:
         msg = f"błąd podczas dodawania: {err}"
 
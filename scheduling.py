@@ -0,0 +1,92 @@
+import os
+from datetime import date, timedelta
+from typing import List
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import models
+from busy import Interval, ONE_DAY
+
+# repairs the workshop can work on at the same day
+BAY_CAPACITY = int(os.environ.get("BAY_CAPACITY", 2))
+# limits of the free slot finder, MAX_SLOT_DAYS is also the longest repair
+MAX_FREE_SLOTS = 50
+MAX_SLOT_DAYS = 365
+# days with full bays read from DB at once while looking for free slots
+FULL_DAYS_BATCH = 500
+
+
+class BookingConflict(ValueError):
+    """Period of a booking contains a day without free bay"""
+
+    def __init__(self, day: date):
+        super().__init__(f"no free bay on {day}")
+        self.day = day
+
+
+def too_long(period: Interval | None) -> bool:
+    """True for periods longer than MAX_SLOT_DAYS. Bay occupancy has a row
+    per day, a typo in the year would write tens of thousands of them."""
+    return period is not None and (period[1] - period[0]).days >= MAX_SLOT_DAYS
+
+
+def first_full_day(db: Session, start: date, end: date, extra: int = 1,
+                   capacity: int = BAY_CAPACITY) -> date | None:
+    """First day of [start, end] without room for extra more repairs. Days are
+    read through the primary key index, cost depends on the length of the
+    period, not on the number of repairs."""
+    table = models.BayOccupancy.__table__
+    return db.execute(select(table.c.day).where(
+        table.c.day.between(start, end), table.c.repairs + extra > capacity).order_by(
+        table.c.day).limit(1)).scalar()
+
+
+def check_booking(db: Session, period: Interval | None, counted: bool = True,
+                  capacity: int = BAY_CAPACITY):
+    """Raises BookingConflict when period does not fit into free bays.
+    counted - repair is already in the occupancy (active repair after
+    update_busy), otherwise there has to be room for one more repair"""
+    if period is None:
+        return
+    day = first_full_day(db, *period, 0 if counted else 1, capacity)
+    if day is not None:
+        raise BookingConflict(day)
+
+
+def free_slots(db: Session, length_days: int, count: int = 1, after: date | None = None,
+               capacity: int = BAY_CAPACITY) -> List[Interval]:
+    """Earliest count periods of length_days days (end inclusive, not
+    overlapping each other) starting on or after after, with a free bay on
+    every day. Only days with full bays are read, in date order, until enough
+    gaps between them are found."""
+    length_days = max(1, min(length_days, MAX_SLOT_DAYS))
+    count = max(1, min(count, MAX_FREE_SLOTS))
+    cursor = after or date.today()
+    length = timedelta(days=length_days)
+    slots: List[Interval] = []
+
+    table = models.BayOccupancy.__table__
+    result = db.execute(select(table.c.day).where(
+        table.c.day >= cursor, table.c.repairs >= capacity).order_by(
+        table.c.day).execution_options(yield_per=FULL_DAYS_BATCH))
+    try:
+        for full_day in result.scalars():
+            while full_day - cursor >= length and len(slots) < count:
+                slots.append((cursor, cursor + length - ONE_DAY))
+                cursor += length
+            if len(slots) == count:
+                break
+            cursor = max(cursor, full_day + ONE_DAY)
+    finally:
+        result.close()
+    # after the last full day every day is free
+    while len(slots) < count:
+        slots.append((cursor, cursor + length - ONE_DAY))
+        cursor += length
+    return slots
+
+
+def next_free_slot(db: Session, period: Interval) -> Interval:
+    """Earliest free period as long as the requested one, starting on or
+    after its start"""
+    start, end = period
+    return free_slots(db, (end - start).days + 1, 1, start)[0]
@@ -0,0 +1,122 @@
+from typing import List
+from sqlalchemy import text, or_, func, column, false, Integer
+from sqlalchemy.orm import Session
+import models
+
+# Maximum number of parts returned for a single search
+SEARCH_LIMIT = 200
+
+# Relative weight of name, nr_oem and engine_type when ranking matches
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+PART_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS part_fts USING fts5(
+        name, nr_oem, engine_type,
+        content='part', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS part_fts_ai AFTER INSERT ON part BEGIN
+        INSERT INTO part_fts(rowid, name, nr_oem, engine_type)
+        VALUES (new.id, new.name, new.nr_oem, new.engine_type);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS part_fts_ad AFTER DELETE ON part BEGIN
+        INSERT INTO part_fts(part_fts, rowid, name, nr_oem, engine_type)
+        VALUES ('delete', old.id, old.name, old.nr_oem, old.engine_type);
+    END""",
+    # only changes of indexed columns touch the index, not stock or price
+    """CREATE TRIGGER IF NOT EXISTS part_fts_au AFTER UPDATE OF name, nr_oem, engine_type
+    ON part BEGIN
+        INSERT INTO part_fts(part_fts, rowid, name, nr_oem, engine_type)
+        VALUES ('delete', old.id, old.name, old.nr_oem, old.engine_type);
+        INSERT INTO part_fts(rowid, name, nr_oem, engine_type)
+        VALUES (new.id, new.name, new.nr_oem, new.engine_type);
+    END""",
+]
+
+# escape character of LIKE patterns in the fallback search
+LIKE_ESCAPE = "\\"
+
+
+def uses_fts(bind) -> bool:
+    """FTS5 index is only available on SQLite, other backends use LIKE fallback"""
+    return bind.dialect.name == "sqlite"
+
+
+def create_part_search_index(bind):
+    """Creates FTS5 index over parts together with triggers keeping it in sync
+    with the part table. Index is filled from existing rows when created."""
+    if not uses_fts(bind):
+        return
+    with bind.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'part_fts'")).first()
+        for statement in PART_FTS_DDL:
+            connection.execute(text(statement))
+        if exists is None:
+            connection.execute(
+                text("INSERT INTO part_fts(part_fts) VALUES ('rebuild')"))
+
+
+def split_phrases(sentence: str) -> List[str]:
+    """Splits searched sentence into casefolded words"""
+    return [phrase.casefold() for phrase in sentence.split() if phrase]
+
+
+def escape_like(phrase: str) -> str:
+    """Escapes LIKE wildcards, so '%' or '_' in a searched word match literally"""
+    for character in (LIKE_ESCAPE, "%", "_"):
+        phrase = phrase.replace(character, LIKE_ESCAPE + character)
+    return phrase
+
+
+def fts_query(phrases: List[str]) -> str:
+    """Builds FTS5 MATCH expression. Every word is quoted (so characters like
+    '-' or '.' in OEM numbers are not treated as operators) and used as a prefix."""
+    quoted = ['"{}"*'.format(phrase.replace('"', '""')) for phrase in phrases]
+    return " OR ".join(quoted)
+
+
+def search_parts(db: Session, sentence: str, limit: int | None = SEARCH_LIMIT) -> List[models.Part]:
+    """Returns parts matching any word of the sentence, best matches first"""
+    phrases = split_phrases(sentence)
+    if not phrases:
+        return []
+
+    if uses_fts(db.get_bind()):
+        ranked = text(
+            "SELECT rowid FROM part_fts WHERE part_fts MATCH :query "
+            "ORDER BY bm25(part_fts, :w_name, :w_oem, :w_engine) LIMIT :limit")
+        part_ids = db.execute(ranked, {"query": fts_query(phrases),
+                                       "w_name": RANK_WEIGHTS[0],
+                                       "w_oem": RANK_WEIGHTS[1],
+                                       "w_engine": RANK_WEIGHTS[2],
+                                       "limit": -1 if limit is None else limit}).scalars().all()
+        if not part_ids:
+            return []
+        found_parts = db.query(models.Part).filter(
+            models.Part.id.in_(part_ids)).all()
+        order = {part_id: index for index, part_id in enumerate(part_ids)}
+        return sorted(found_parts, key=lambda part: order[part.id])
+
+    # fallback for backends without FTS5
+    query = db.query(models.Part).filter(
+        part_search_filter(db.get_bind(), sentence)).order_by(models.Part.name)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def part_search_filter(bind, sentence: str):
+    """Returns SQL condition selecting parts matching any word of the sentence,
+    to be combined with other filters of a parts query. A sentence without
+    words matches nothing."""
+    phrases = split_phrases(sentence)
+    if not phrases:
+        return false()
+    if uses_fts(bind):
+        matching_ids = text("SELECT rowid FROM part_fts WHERE part_fts MATCH :query").bindparams(
+            query=fts_query(phrases)).columns(column("rowid", Integer))
+        return models.Part.id.in_(matching_ids)
+
+    columns = [models.Part.name, models.Part.nr_oem, models.Part.engine_type]
+    return or_(*[func.lower(column).like(f"%{escape_like(phrase)}%", escape=LIKE_ESCAPE)
+                 for phrase in phrases for column in columns])
@@ -1,28 +1,25 @@
-document.addEventListener('DOMContentLoaded', function () {
-    var calendarEl = document.getElementById('calendar');
-
-    var calendar = new FullCalendar.Calendar(calendarEl, {
-        initialView: 'dayGridMonth',
-        events: function (fetchInfo, successCallback, failureCallback) {
-            fetch('/your-endpoint-url')
-                .then(function (response) {
-                    return response.json();
-                })
-                .then(function (jsonData) {
-                    var events = jsonData.map(function (item) {
-                        return {
-                            id: item.repair_id,
-                            start: item.start_date,
-                            end: item.end_date
-                        };
-                    });
-                    successCallback(events);
-                })
-                .catch(function () {
-                    failureCallback();
-                });
-        }
-    });
-
-    calendar.render();
-});
+/*
+ * Event source for FullCalendar fetching only repairs of the visible range
+ * from a JSON events endpoint (start / end are sent as YYYY-MM-DD).
+ */
+function repairEventSource(url) {
+    return function (start, end, timezone, callback) {
+        var params = new URLSearchParams({
+            start: start.format('YYYY-MM-DD'),
+            end: end.format('YYYY-MM-DD')
+        });
+        fetch(url + '?' + params.toString(), { credentials: 'same-origin' })
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            })
+            .then(function (events) {
+                callback(events);
+            })
+            .catch(function () {
+                callback([]);
+            });
+    };
+}
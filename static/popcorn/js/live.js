@@ -0,0 +1,110 @@
+/*
+ * Live updates of mechanic pages from the Server-Sent Events stream of
+ * repair, line item and message changes. "resync" means events were lost
+ * (slow client, server restart) and the page has to reload its data.
+ */
+function liveEvents(url, handlers) {
+    if (!window.EventSource) {
+        return null;
+    }
+    var source = new EventSource(url);
+    Object.keys(handlers).forEach(function (kind) {
+        source.addEventListener(kind, function (event) {
+            handlers[kind](JSON.parse(event.data));
+        });
+    });
+    return source;
+}
+
+function roundMoney(value) {
+    return Math.round(value * 100) / 100;
+}
+
+/* copy of a <template> element of the page, filled by the caller */
+function cloneTemplate(id) {
+    return document.getElementById(id).content.firstElementChild.cloneNode(true);
+}
+
+function repairItem(repair) {
+    var item = cloneTemplate(repair.active ? 'repair-active-template' : 'repair-proposed-template');
+    item.href = '/mechanic/repairs/' + repair.id;
+    item.dataset.repairId = repair.id;
+    item.querySelector('.repair-car').textContent = repair.car_name;
+    item.querySelector('.repair-start').textContent = repair.start_date;
+    item.querySelector('.repair-end').textContent = repair.end_date;
+    item.querySelector('.repair-money').textContent = roundMoney(repair.money);
+    return item;
+}
+
+function messageItem(message) {
+    var item = cloneTemplate('message-template');
+    item.dataset.messageId = message.id;
+    item.querySelector('.message-email').textContent = message.email;
+    item.querySelector('.message-text').textContent = message.message;
+    item.querySelector('.message-delete').href = '/contact/delete/' + message.id;
+    return item;
+}
+
+/* keeps one element per id in the list, in order of arrival */
+function replaceItem(list, attribute, id, item) {
+    var old = list.querySelector('[' + attribute + '="' + id + '"]');
+    if (item === null) {
+        if (old) {
+            old.remove();
+        }
+    } else if (old) {
+        old.replaceWith(item);
+    } else {
+        list.appendChild(item);
+    }
+}
+
+function liveDashboard(url) {
+    var repairs = document.getElementById('live-repairs');
+    var messages = document.getElementById('live-messages');
+    return liveEvents(url, {
+        repair: function (data) {
+            replaceItem(repairs, 'data-repair-id', data.repair.id,
+                data.action === 'deleted' ? null : repairItem(data.repair));
+        },
+        line_item: function (data) {
+            var item = repairs.querySelector('[data-repair-id="' + data.repair_id + '"]');
+            if (item) {
+                item.querySelector('.repair-money').textContent = roundMoney(data.money);
+            }
+        },
+        message: function (data) {
+            replaceItem(messages, 'data-message-id', data.message.id,
+                data.action === 'deleted' ? null : messageItem(data.message));
+        },
+        resync: function () {
+            window.location.reload();
+        }
+    });
+}
+
+/* same colours as /mechanic/calendar/events */
+function repairCalendarEvent(repair) {
+    return {
+        id: String(repair.id),
+        title: repair.car_name,
+        start: repair.start_date,
+        end: repair.end_date,
+        color: repair.active ? 'red' : 'grey',
+        textColor: repair.active ? 'white' : 'black'
+    };
+}
+
+function liveCalendar(url, calendar) {
+    return liveEvents(url, {
+        repair: function (data) {
+            calendar.fullCalendar('removeEvents', String(data.repair.id));
+            if (data.action !== 'deleted') {
+                calendar.fullCalendar('renderEvent', repairCalendarEvent(data.repair));
+            }
+        },
+        resync: function () {
+            calendar.fullCalendar('refetchEvents');
+        }
+    });
+}
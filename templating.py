@@ -0,0 +1,50 @@
+import os
+import time
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, Template
+from assets import static_url
+from metrics import template_rendered
+
+TEMPLATE_DIRECTORY = "templates"
+
+# compiled templates are kept on disk, so a restarted worker loads bytecode
+# instead of parsing every template again
+TEMPLATE_CACHE_DIRECTORY = os.environ.get("TEMPLATE_CACHE_DIR", ".template_cache")
+
+# checking template files for changes on every render is only useful while
+# templates are edited, "1" turns it on for development
+TEMPLATE_AUTO_RELOAD = os.environ.get("TEMPLATE_AUTO_RELOAD", "0") == "1"
+
+os.makedirs(TEMPLATE_CACHE_DIRECTORY, exist_ok=True)
+
+
+class TimedTemplate(Template):
+    """Template reporting its render time to /metrics. Included templates
+    and macros render inside the outer render() and are not counted twice."""
+
+    def render(self, *args, **kwargs) -> str:
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_rendered(time.perf_counter() - started)
+
+
+# one Jinja environment shared by all routers, so templates are loaded and
+# compiled once per worker
+templates = Jinja2Templates(directory=TEMPLATE_DIRECTORY,
+                            bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIRECTORY),
+                            auto_reload=TEMPLATE_AUTO_RELOAD)
+templates.env.template_class = TimedTemplate
+templates.env.globals["static_url"] = static_url
+
+
+def compile_templates() -> int:
+    """Loads every template into the environment (and bytecode cache), so the
+    first request after start renders as fast as later ones. Returns number
+    of compiled templates."""
+    environment = templates.env
+    names = environment.list_templates(extensions=["html"])
+    for name in names:
+        environment.get_template(name)
+    return len(names)
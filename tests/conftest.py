@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# settings are read when modules are imported, so they are set before the app
+_directory = tempfile.mkdtemp(prefix="popcorn-tests-")
+os.environ.setdefault("SECRET_KEY", "tests")
+os.environ["DATABASE_URL"] = f"sqlite:///{_directory}/tests.db"
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("TEMPLATE_CACHE_DIR", os.path.join(_directory, "templates"))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import httpx
+import pytest
+import pytest_asyncio
+
+import migrations
+import models
+from database import SessionLocal, engine
+from passwords import pwd_context
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    migrations.upgrade(engine)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def make_user(db):
+    def make(username: str, password: str = "secret", role: str = "customer") -> models.User:
+        user = models.User(username=username, email=f"{username}@popcorn", first_name=username,
+                           last_name=username, role=role,
+                           hashed_password=pwd_context.hash(password))
+        db.add(user)
+        db.commit()
+        return user
+    return make
+
+
+@pytest_asyncio.fixture
+async def client():
+    from main import app
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
@@ -0,0 +1,34 @@
+import logging
+
+import pytest
+
+import inbox
+import models
+from inbox import ContactInbox
+
+
+@pytest.mark.asyncio
+async def test_unsaved_messages_are_spooled_and_written_on_start(db, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(inbox, "CONTACT_SPOOL_FILE", str(tmp_path / "spool.jsonl"))
+    failing = ContactInbox()
+    failing.start()
+    assert failing.offer("10.0.0.1", "jan@popcorn", "Kiedy odbiór auta?") == inbox.ACCEPTED
+
+    def broken(db, messages):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(inbox, "write_messages", broken)
+    with caplog.at_level(logging.ERROR, logger="uvicorn.error"):
+        await failing.stop()
+    assert not failing.pending
+    assert (tmp_path / "spool.jsonl").exists()
+    assert "jan@popcorn" not in caplog.text and "odbiór" not in caplog.text
+    assert "1 contact messages not saved" in caplog.text
+
+    monkeypatch.undo()
+    monkeypatch.setattr(inbox, "CONTACT_SPOOL_FILE", str(tmp_path / "spool.jsonl"))
+    restarted = ContactInbox()
+    restarted.start()
+    await restarted.stop()
+    assert restarted.counters["written"] == 1
+    assert not list(tmp_path.iterdir())
+    assert db.query(models.Message).filter_by(email="jan@popcorn").one().message == "Kiedy odbiór auta?"
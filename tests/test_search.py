@@ -0,0 +1,58 @@
+from sqlalchemy import create_engine, text
+
+import migrations
+import models
+import search
+
+
+def test_like_fallback_matches_wildcards_literally(db, monkeypatch):
+    db.add_all([models.Part(name="Filtr 100% oleju", nr_oem="A_1", engine_type="1.9 TDI"),
+                models.Part(name="Filtr 1000 oleju", nr_oem="AB1", engine_type="1.9 TDI"),
+                models.Part(name="Pasek\\klinowy", nr_oem="B2", engine_type="1.6")])
+    db.commit()
+    monkeypatch.setattr(search, "uses_fts", lambda bind: False)
+
+    def names(sentence):
+        return sorted(part.name for part in search.search_parts(db, sentence))
+
+    assert names("100%") == ["Filtr 100% oleju"]
+    assert names("a_1") == ["Filtr 100% oleju"]
+    assert names("pasek\\k") == ["Pasek\\klinowy"]
+    assert names("%") == ["Filtr 100% oleju"]
+
+
+def test_stock_change_does_not_touch_search_index(db):
+    part = models.Part(name="Świeca zapłonowa", nr_oem="SP-7", engine_type="1.4", amount_left=3)
+    db.add(part)
+    db.commit()
+
+    def changes(update):
+        before = db.execute(text("SELECT total_changes()")).scalar()
+        update()
+        db.commit()
+        return db.execute(text("SELECT total_changes()")).scalar() - before
+
+    # both update the part and its version counter, only renaming writes the index
+    stock = changes(lambda: setattr(part, "amount_left", 2))
+    rename = changes(lambda: setattr(part, "name", "Świeca żarowa"))
+    assert stock < rename
+    assert [found.id for found in search.search_parts(db, "żarowa")] == [part.id]
+    assert search.search_parts(db, "zapłonowa") == []
+
+
+def test_migration_replaces_update_trigger(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TRIGGER part_fts_au"))
+        connection.execute(text(
+            "CREATE TRIGGER part_fts_au AFTER UPDATE ON part BEGIN SELECT 1; END"))
+        connection.execute(migrations.schema_migration.delete().where(
+            migrations.schema_migration.c.name == "0008_part_fts_update_trigger"))
+
+    migrations.upgrade(engine)
+    with engine.connect() as connection:
+        trigger = connection.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'part_fts_au'")).scalar()
+    engine.dispose()
+    assert "UPDATE OF name, nr_oem, engine_type" in trigger
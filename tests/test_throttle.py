@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import passwords
+import routers.auth
+from passwords import PasswordPoolBusy
+from throttle import LOGIN_MAX_FAILURES_PER_USER, LoginThrottle, LoginThrottled, SlidingWindowThrottle
+
+
+@pytest.fixture(autouse=True)
+def login_throttle(monkeypatch):
+    throttle = LoginThrottle()
+    monkeypatch.setattr(routers.auth, "login_throttle", throttle)
+    return throttle
+
+
+def test_reservations_count_against_limit():
+    throttle = SlidingWindowThrottle(limit=2)
+    assert throttle.reserve("key", 0)
+    assert throttle.reserve("key", 0)
+    assert not throttle.reserve("key", 0)
+    throttle.release("key")
+    assert throttle.reserve("key", 0)
+    throttle.failure("key", 0)
+    assert not throttle.reserve("key", 0)
+
+
+def test_released_key_is_forgotten():
+    throttle = SlidingWindowThrottle(limit=2)
+    throttle.reserve("key", 0)
+    throttle.release("key")
+    assert "key" not in throttle.keys
+
+
+@pytest.mark.asyncio
+async def test_concurrent_logins_verify_at_most_limit(client, make_user):
+    make_user("burst", password="right")
+    attempts = LOGIN_MAX_FAILURES_PER_USER * 3
+    completed = passwords.password_pool_stats()["completed"]
+
+    responses = await asyncio.gather(*[
+        client.post("/login", data={"username": "burst", "password": f"wrong{number}"})
+        for number in range(attempts)])
+
+    verified = passwords.password_pool_stats()["completed"] - completed
+    codes = [response.status_code for response in responses]
+    assert verified <= LOGIN_MAX_FAILURES_PER_USER
+    assert codes.count(200) == verified
+    assert codes.count(429) == attempts - verified
+
+
+@pytest.mark.asyncio
+async def test_busy_pool_releases_reservation(client, make_user, login_throttle, monkeypatch):
+    make_user("busy", password="right")
+
+    async def busy(password, hashed_password):
+        raise PasswordPoolBusy()
+    monkeypatch.setattr(routers.auth, "verify_password", busy)
+
+    for _ in range(LOGIN_MAX_FAILURES_PER_USER + 1):
+        response = await client.post("/login", data={"username": "busy", "password": "right"})
+        assert response.status_code == 503
+    assert not login_throttle.by_user.keys
+    assert not login_throttle.by_ip.keys
+
+
+@pytest.mark.asyncio
+async def test_success_keeps_other_reservations(login_throttle):
+    login_throttle.check("user", "ip")
+    login_throttle.check("user", "ip")
+    login_throttle.success("user", "ip")
+    assert login_throttle.by_user.keys["user"].pending == 1
+    assert login_throttle.by_ip.keys["ip"].pending == 1
+    login_throttle.failure("user", "ip")
+    assert login_throttle.by_user.keys["user"].pending == 0
+    with pytest.raises(LoginThrottled):
+        for _ in range(LOGIN_MAX_FAILURES_PER_USER):
+            login_throttle.check("user", "ip")
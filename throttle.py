@@ -0,0 +1,185 @@
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Deque
+
+# failed logins allowed in the window, per username and per client IP
+LOGIN_WINDOW_SECONDS = float(os.environ.get("LOGIN_WINDOW_SECONDS", 300))
+LOGIN_MAX_FAILURES_PER_USER = int(os.environ.get("LOGIN_MAX_FAILURES_PER_USER", 5))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get("LOGIN_MAX_FAILURES_PER_IP", 20))
+# first lockout, every next one without a quiet window in between is twice as long
+LOGIN_BACKOFF_SECONDS = float(os.environ.get("LOGIN_BACKOFF_SECONDS", 30))
+LOGIN_MAX_BACKOFF_SECONDS = float(os.environ.get("LOGIN_MAX_BACKOFF_SECONDS", 3600))
+# keys remembered by each throttle, the least recently used are forgotten
+LOGIN_TRACKED_KEYS = int(os.environ.get("LOGIN_TRACKED_KEYS", 10000))
+# wait advised when the limit is taken by attempts still being verified
+PENDING_RETRY_SECONDS = 1
+
+
+class LoginThrottled(Exception):
+    """Raised before a login attempt is checked, when its username or IP is
+    locked out"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"locked out for {retry_after} s")
+        self.retry_after = retry_after
+
+
+class KeyState:
+    __slots__ = ("failures", "locked_until", "lockouts", "pending")
+
+    def __init__(self, limit: int):
+        # at most limit timestamps, memory per key is bounded
+        self.failures: Deque[float] = deque(maxlen=limit)
+        self.locked_until = 0.0
+        self.lockouts = 0
+        # attempts being verified right now, they count against limit as if
+        # they failed, so a parallel burst can not run more verifications
+        self.pending = 0
+
+
+class SlidingWindowThrottle:
+    """Failures per key in the last window seconds, in an LRU table of at
+    most max_keys keys. A key reaching limit failures is locked out for
+    backoff seconds, doubled with every lockout until the key stays quiet
+    for a whole window after the last one. An attempt reserves its place
+    before it is verified and ends as a failure or a release."""
+
+    def __init__(self, limit: int, window: float = LOGIN_WINDOW_SECONDS,
+                 backoff: float = LOGIN_BACKOFF_SECONDS, max_backoff: float = LOGIN_MAX_BACKOFF_SECONDS,
+                 max_keys: int = LOGIN_TRACKED_KEYS):
+        self.limit = limit
+        self.window = window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_keys = max_keys
+        self.keys: OrderedDict[str, KeyState] = OrderedDict()
+
+    def retry_after(self, key: str, now: float) -> float:
+        """Seconds key is still locked out for, 0 when it is not"""
+        state = self.keys.get(key)
+        if state is None or state.locked_until <= now:
+            return 0
+        return state.locked_until - now
+
+    def state(self, key: str) -> KeyState:
+        """State of key, marked as the most recently used"""
+        state = self.keys.pop(key, None) or KeyState(self.limit)
+        self.keys[key] = state
+        if len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+        return state
+
+    def expire(self, state: KeyState, now: float):
+        while state.failures and state.failures[0] <= now - self.window:
+            state.failures.popleft()
+
+    def reserve(self, key: str, now: float) -> bool:
+        """Reserves an attempt, False when recent failures and attempts
+        still being verified already reach limit"""
+        state = self.state(key)
+        self.expire(state, now)
+        if len(state.failures) + state.pending >= self.limit:
+            return False
+        state.pending += 1
+        return True
+
+    def release(self, key: str):
+        """Ends a reserved attempt which did not fail, a key with nothing
+        left to remember is forgotten"""
+        state = self.keys.get(key)
+        if state is None:
+            return
+        if state.pending > 0:
+            state.pending -= 1
+        if not state.pending and not state.failures and not state.lockouts:
+            del self.keys[key]
+
+    def failure(self, key: str, now: float) -> bool:
+        """Records a failure of a reserved attempt, True when it locked the
+        key out"""
+        state = self.state(key)
+        if state.pending > 0:
+            state.pending -= 1
+
+        self.expire(state, now)
+        if not state.failures and now - state.locked_until > self.window:
+            state.lockouts = 0
+        state.failures.append(now)
+        if len(state.failures) < self.limit:
+            return False
+        state.locked_until = now + min(self.max_backoff, self.backoff * 2 ** state.lockouts)
+        state.lockouts += 1
+        state.failures.clear()
+        return True
+
+    def success(self, key: str):
+        """Forgets failures of key, attempts of it still being verified
+        keep their reservation"""
+        state = self.keys.get(key)
+        if state is None:
+            return
+        state.failures.clear()
+        state.lockouts = 0
+        self.release(key)
+
+
+class LoginThrottle:
+    """Locks out usernames and client IPs with too many failed logins. check()
+    runs before the user is looked up or any password is hashed."""
+
+    def __init__(self):
+        self.by_user = SlidingWindowThrottle(LOGIN_MAX_FAILURES_PER_USER)
+        self.by_ip = SlidingWindowThrottle(LOGIN_MAX_FAILURES_PER_IP)
+        self.counters = Counter()
+
+    @staticmethod
+    def user_key(username: str) -> str:
+        return username.strip().lower()
+
+    def check(self, username: str, ip: str):
+        """Reserves an attempt of the username and of the IP. Raises
+        LoginThrottled when either is locked out or has limit failures and
+        attempts in progress already. A reserved attempt has to end with
+        failure(), success() or release()."""
+        now = time.monotonic()
+        user_key = self.user_key(username)
+        wait = max(self.by_user.retry_after(user_key, now), self.by_ip.retry_after(ip, now))
+        if wait <= 0:
+            if not self.by_user.reserve(user_key, now):
+                wait = PENDING_RETRY_SECONDS
+            elif not self.by_ip.reserve(ip, now):
+                self.by_user.release(user_key)
+                wait = PENDING_RETRY_SECONDS
+        if wait > 0:
+            self.counters["throttled"] += 1
+            raise LoginThrottled(int(wait) + 1)
+
+    def release(self, username: str, ip: str):
+        """Ends a reserved attempt which was not verified (e.g. the password
+        pool was busy)"""
+        self.by_user.release(self.user_key(username))
+        self.by_ip.release(ip)
+
+    def failure(self, username: str, ip: str):
+        now = time.monotonic()
+        self.counters["failures"] += 1
+        if self.by_user.failure(self.user_key(username), now):
+            self.counters["user_lockouts"] += 1
+        if self.by_ip.failure(ip, now):
+            self.counters["ip_lockouts"] += 1
+
+    def success(self, username: str, ip: str):
+        """Failures of the username are forgotten, the IP keeps its own, so
+        one valid account does not reset a guessing client"""
+        self.by_user.success(self.user_key(username))
+        self.by_ip.release(ip)
+
+    def stats(self) -> dict:
+        return {"throttled": self.counters["throttled"], "failures": self.counters["failures"],
+                "user_lockouts": self.counters["user_lockouts"],
+                "ip_lockouts": self.counters["ip_lockouts"],
+                "tracked_users": len(self.by_user.keys), "tracked_ips": len(self.by_ip.keys)}
+
+
+login_throttle = LoginThrottle()
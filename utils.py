@@ -1,66 +1,186 @@
 import os
-from fastapi import HTTPException, Request, status
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request, status
+from sqlalchemy import select, delete, update
+from sqlalchemy.orm import Session
 from starlette.responses import RedirectResponse
 from jose import jwt, JWTError
-from database import SessionLocal, engine
 import models
+from database import new_session, SessionLocal
 
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_SECONDS = int(os.environ.get("ACCESS_TOKEN_EXPIRE_SECONDS", 8 * 60 * 60))
 
-models.Base.metadata.create_all(bind=engine)
+# how many verified tokens are kept so signature is not checked on every request
+TOKEN_CACHE_SIZE = 1024
+# seconds a worker uses its copy of revoked tokens, logout or role change
+# made through another worker is noticed within this time
+TOKEN_REVOCATION_REFRESH_SECONDS = float(os.environ.get("TOKEN_REVOCATION_REFRESH_SECONDS", 2))
 
 
-def get_db():
-    """Connection with DB"""
-    try:
-        db = SessionLocal()
+async def get_db():
+    """Connection with DB, AsyncSession or its thread backed equivalent
+    depending on DATABASE_ASYNC setting"""
+    async with new_session() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_current_user(request: Request):
-    """Fetches data of user, data is based on the current session cookie"""
-    try:
-        token = request.cookies.get("access_token")
-        if token is None:
+class Principal:
+    """Logged in user as described by claims of his access token"""
+
+    def __init__(self, id: int, username: str, role: str, first_name: str | None,
+                 last_name: str | None, token_id: str | None, issued_at: float, expires_at: int):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.first_name = first_name
+        self.last_name = last_name
+        self.token_id = token_id
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+
+
+_verified_tokens: "OrderedDict[str, Principal]" = OrderedDict()
+# sync dependencies run in threadpool threads, which share the cache
+_verified_tokens_lock = threading.Lock()
+
+
+class Revocations:
+    """Copy of revoked tokens (revoked_token table) and per user cut-off
+    times (User.tokens_not_before) kept by each worker. It is read again from
+    the database at most every TOKEN_REVOCATION_REFRESH_SECONDS, so requests
+    do not query it and all workers agree within that time."""
+
+    def __init__(self):
+        self.token_ids: set = set()
+        # user id -> time before which all his tokens are rejected
+        self.not_before: dict = {}
+        self.loaded_at: float | None = None
+        self.lock = threading.Lock()
+
+    def load(self, db: Session):
+        now = time.time()
+        self.token_ids = set(db.scalars(select(models.RevokedToken.token_id).where(
+            models.RevokedToken.expires_at > now)))
+        self.not_before = dict(db.execute(select(models.User.id, models.User.tokens_not_before).where(
+            models.User.tokens_not_before > now - ACCESS_TOKEN_EXPIRE_SECONDS)).tuples().all())
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        """Reloads when the copy is too old. Only the first load waits for
+        another thread, later ones use the current copy meanwhile."""
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < TOKEN_REVOCATION_REFRESH_SECONDS:
+            return
+        if not self.lock.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= TOKEN_REVOCATION_REFRESH_SECONDS:
+                with SessionLocal() as db:
+                    self.load(db)
+        finally:
+            self.lock.release()
+
+    def is_revoked(self, principal: Principal) -> bool:
+        self.refresh()
+        if principal.token_id in self.token_ids:
+            return True
+        return principal.issued_at < self.not_before.get(principal.id, 0)
+
+
+revocations = Revocations()
+
+
+def revoke_token(db: Session, principal: Principal):
+    """Rejects given token until it expires (used on logout), the caller
+    commits. Rows of tokens which expired meanwhile are removed."""
+    if principal.token_id is None:
+        return
+    db.execute(delete(models.RevokedToken).where(models.RevokedToken.expires_at <= time.time()))
+    db.merge(models.RevokedToken(token_id=principal.token_id, expires_at=principal.expires_at))
+    revocations.token_ids.add(principal.token_id)
+
+
+def revoke_user_tokens(db: Session, user_id: int):
+    """Rejects all tokens issued to the user so far, has to be called when
+    role or name of the user changes so stale claims are not trusted. The
+    caller commits."""
+    now = time.time()
+    db.execute(update(models.User).where(models.User.id == user_id).values(tokens_not_before=now))
+    revocations.not_before[user_id] = now
+
+
+def is_token_valid(principal: Principal) -> bool:
+    if principal.expires_at <= time.time():
+        return False
+    return not revocations.is_revoked(principal)
+
+
+def decode_access_token(token: str) -> Principal | None:
+    """Verifies token signature and expiration, verified tokens are kept in
+    LRU cache so following requests with same cookie skip decoding"""
+    with _verified_tokens_lock:
+        principal = _verified_tokens.get(token)
+        if principal is not None:
+            _verified_tokens.move_to_end(token)
+    if principal is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
             return None
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        user_id: int = payload.get("id")
-        if username is None or user_id is None:
+        # tokens without expiration are never accepted
+        if payload.get("sub") is None or payload.get("id") is None or payload.get("role") is None \
+                or payload.get("exp") is None:
             return None
-        return {"username": username, "id": user_id}
-    except JWTError:
-        raise HTTPException(status_code=404, detail="Not found")
+        principal = Principal(id=payload["id"], username=payload["sub"], role=payload["role"],
+                              first_name=payload.get("first_name"),
+                              last_name=payload.get("last_name"),
+                              token_id=payload.get("jti"), issued_at=payload.get("iat", 0),
+                              expires_at=payload["exp"])
+        with _verified_tokens_lock:
+            _verified_tokens[token] = principal
+            if len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                _verified_tokens.popitem(last=False)
+
+    if not is_token_valid(principal):
+        with _verified_tokens_lock:
+            _verified_tokens.pop(token, None)
+        return None
+    return principal
+
+
+def get_current_user(request: Request) -> Principal | None:
+    """Fetches data of user, data is based on the current session cookie.
+    Token is decoded once per request, can be used as a dependency."""
+    if not hasattr(request.state, "principal"):
+        token = request.cookies.get("access_token")
+        request.state.principal = decode_access_token(token) if token else None
+    return request.state.principal
 
 
-def check_user_role_and_redirect(request: Request, db, role: str):
+def check_user_role_and_redirect(user: Principal | None, role: str):
     """Checks if the endpoint tried to be connected to is allowed to be fetches
     by current user. If endpoint is not allowed, it redirects user to his
     staring page."""
-    user = get_current_user(request)
 
     redirection = {"is_needed": False, 'redirection': None}
     if user is None:
         redirection['redirection'] = RedirectResponse(
             url="/login", status_code=status.HTTP_302_FOUND)
         redirection["is_needed"] = True
-    else:
-        user_model = db.query(models.User).filter(
-            models.User.username == user['username']).first()
-        if user_model.role != role:
-            if user_model.role == "customer":
-                redirection['redirection'] = RedirectResponse(
-                    url="/customer", status_code=status.HTTP_302_FOUND)
-                redirection["is_needed"] = True
-            if user_model.role == "mechanic":
-                redirection['redirection'] = RedirectResponse(
-                    url="/mechanic", status_code=status.HTTP_302_FOUND)
-                redirection["is_needed"] = True
-            if user_model.role == "admin":
-                redirection['redirection'] = RedirectResponse(
-                    url="/admin", status_code=status.HTTP_302_FOUND)
-                redirection["is_needed"] = True
+    elif user.role != role:
+        if user.role == "customer":
+            redirection['redirection'] = RedirectResponse(
+                url="/customer", status_code=status.HTTP_302_FOUND)
+            redirection["is_needed"] = True
+        if user.role == "mechanic":
+            redirection['redirection'] = RedirectResponse(
+                url="/mechanic", status_code=status.HTTP_302_FOUND)
+            redirection["is_needed"] = True
+        if user.role == "admin":
+            redirection['redirection'] = RedirectResponse(
+                url="/admin", status_code=status.HTTP_302_FOUND)
+            redirection["is_needed"] = True
     return redirection
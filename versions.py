@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+from datetime import date, datetime, time, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from itertools import chain
+from typing import Iterable
+from fastapi import Request, Response, status
+from sqlalchemy import event, select, update, insert
+from sqlalchemy.orm import Session
+import models
+from assets import manifest
+from templating import TEMPLATE_DIRECTORY
+
+# tables whose changes are counted in entity_version
+TRACKED_TABLES = {"user", "part", "repair", "parts_in_repair", "busy_range"}
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def release_fingerprint() -> str:
+    """Changes when templates or static files change, so pages rendered by
+    previous release are not validated"""
+    digest = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode())
+    for root, _, files in sorted(os.walk(TEMPLATE_DIRECTORY)):
+        for name in sorted(files):
+            stat_result = os.stat(os.path.join(root, name))
+            digest.update(f"{root}/{name}:{stat_result.st_mtime_ns}:{stat_result.st_size}".encode())
+    return digest.hexdigest()[:12]
+
+
+RELEASE = release_fingerprint()
+
+
+def bump_versions(connection, names: Iterable[str]):
+    """Increments change counters of given tables. Has to be called by code
+    writing with Core statements, ORM changes are counted on flush."""
+    table = models.EntityVersion.__table__
+    now = utcnow()
+    for name in sorted(set(names)):
+        result = connection.execute(update(table).where(table.c.name == name).values(
+            version=table.c.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(name=name, version=1, updated_at=now))
+
+
+@event.listens_for(Session, "before_flush")
+def collect_changed_tables(session, flush_context, instances):
+    changed = session.info.setdefault("changed_tables", set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        name = getattr(type(instance), "__tablename__", None)
+        if name in TRACKED_TABLES and name not in changed:
+            if instance in session.dirty and not session.is_modified(instance):
+                continue
+            changed.add(name)
+
+
+@event.listens_for(Session, "after_flush")
+def bump_changed_tables(session, flush_context):
+    changed = session.info.pop("changed_tables", None)
+    if changed:
+        bump_versions(session.connection(), changed)
+
+
+def read_versions(db: Session, names: Iterable[str]) -> dict:
+    """name -> (version, updated_at), tables without changes are left out"""
+    rows = db.execute(select(models.EntityVersion).where(
+        models.EntityVersion.name.in_(list(names)))).scalars().all()
+    return {row.name: (row.version, row.updated_at) for row in rows}
+
+
+class Validators:
+    """ETag and Last-Modified of a page. Checked against request before the
+    page is rendered, added to the response after."""
+
+    def __init__(self, etag: str, last_modified: datetime | None):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def headers(self) -> dict:
+        headers = {"ETag": self.etag, "Cache-Control": "private, no-cache"}
+        if self.last_modified is not None:
+            headers["Last-Modified"] = format_datetime(
+                self.last_modified.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+        return headers
+
+    def matches(self, request: Request) -> bool:
+        """True when copy cached by the client is still current"""
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag.removeprefix("W/") in tags
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is None or self.last_modified is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        modified = self.last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+        return modified <= since
+
+    def not_modified(self) -> Response:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=self.headers())
+
+    def apply(self, response: Response) -> Response:
+        response.headers.update(self.headers())
+        return response
+
+
+def page_validators(db: Session, request: Request, user, tables: Iterable[str],
+                    today: date | None = None) -> Validators:
+    """Validators of a page showing rows of given tables. Page is the same as
+    long as the URL, the logged in user, the release and versions of the
+    tables are the same. Pages computed relative to the current date pass
+    today, they change at midnight as well."""
+    versions = read_versions(db, tables)
+    key = [RELEASE, request.url.path, sorted(request.query_params.multi_items()),
+           [user.id, user.role, user.first_name, user.last_name] if user else None,
+           sorted([name, version] for name, (version, _) in versions.items()), today]
+    digest = hashlib.sha1(json.dumps(key, default=str).encode()).hexdigest()
+    updated = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+    if today is not None:
+        # local midnight in UTC, like updated_at
+        updated.append(datetime.combine(today, time.min).astimezone(timezone.utc).replace(tzinfo=None))
+    return Validators(f'W/"{digest}"', max(updated) if updated else None)